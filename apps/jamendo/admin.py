@@ -4,7 +4,8 @@
 from django.contrib import admin
 
 from jamendo.models import Artist, Album, Track, License, Language,\
-    Country, State, City, Playlist, Radio, JamendoUser, Genre, Review
+    Country, State, City, Playlist, Radio, JamendoUser, Genre, Review,\
+    ImportCheckpoint
 
 admin.site.register(Artist)
 admin.site.register(Album)
@@ -19,4 +20,5 @@ admin.site.register(Radio)
 admin.site.register(JamendoUser)
 admin.site.register(Genre)
 admin.site.register(Review)
+admin.site.register(ImportCheckpoint)
 
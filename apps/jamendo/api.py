@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Client for the Jamendo get2 webservice, ie:
+http://api.jamendo.com/get2/id+name+image/album/xml/?id=33+34&n=all
+
+Many uids are asked in a single request using the same id=a+b+c form used
+by Album.get_playlist_url and Artist.get_mp3_m3u, persistent HTTP
+connections are kept in a small pool and requests are throttled to a
+configurable rate. Responses are parsed incrementally while they are read.
+"""
+
+import httplib
+import socket
+import threading
+import time
+import urlparse
+from datetime import datetime
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+from django.conf import settings
+from django.db import transaction
+
+from jamendo.bulk import chunks, update_rows
+from jamendo.responses import invalidate_responses
+
+
+API_URL = getattr(settings, "JAMENDO_API_URL", "http://api.jamendo.com/get2/")
+# max requests per second, None means no limit
+API_RATE_LIMIT = getattr(settings, "JAMENDO_API_RATE_LIMIT", 1)
+# max uids per request
+API_BATCH_SIZE = getattr(settings, "JAMENDO_API_BATCH_SIZE", 100)
+API_TIMEOUT = getattr(settings, "JAMENDO_API_TIMEOUT", 30)
+
+
+def _text(elem):
+    return (elem.text or u"").strip() or None
+
+def _int(elem):
+    try:
+        return int(elem.text)
+    except (TypeError, ValueError):
+        return None
+
+def _date(elem):
+    try:
+        return datetime.strptime(elem.text.strip()[:19], "%Y-%m-%dT%H:%M:%S")
+    except (AttributeError, ValueError):
+        return None
+
+# model field -> (get2 field, value parser) of the refreshable fields
+REFRESHABLE_FIELDS = {
+    "album": {
+        "name": ("name", _text),
+        "image": ("image", _text),
+        "url": ("url", _text),
+        "release_date": ("releasedate", _date),
+        "duration": ("duration", _int),
+    },
+    "artist": {
+        "name": ("name", _text),
+        "image": ("image", _text),
+        "url": ("url", _text),
+    },
+    "track": {
+        "name": ("name", _text),
+        "duration": ("duration", _int),
+        "numalbum": ("numalbum", _int),
+    },
+}
+
+
+class JamendoAPIError(Exception):
+    pass
+
+
+class JamendoClient(object):
+    """
+    Thread safe get2 client. Connections are reused between requests (and
+    threads) and requests are spaced to honor rate_limit requests/second.
+    """
+
+    def __init__(self, base_url=API_URL, rate_limit=API_RATE_LIMIT,
+        batch_size=API_BATCH_SIZE, timeout=API_TIMEOUT):
+        bits = urlparse.urlsplit(base_url)
+        self.host = bits[1]
+        self.path = bits[2].rstrip("/") + "/"
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.interval = rate_limit and 1.0 / rate_limit or 0
+        self.next_request = 0
+        self.lock = threading.Lock()
+        self.connections = []
+        self.requests = 0
+
+    def _acquire(self, fresh=False):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            wait = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.interval
+            if self.connections and not fresh:
+                connection = self.connections.pop()
+            else:
+                connection = None
+            self.requests += 1
+        finally:
+            self.lock.release()
+        if wait > 0:
+            time.sleep(wait)
+        if connection is None:
+            connection = httplib.HTTPConnection(self.host)
+            connection.connect()
+            connection.sock.settimeout(self.timeout)
+        return connection
+
+    def _release(self, connection):
+        self.lock.acquire()
+        try:
+            self.connections.append(connection)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        finally:
+            self.lock.release()
+
+    def get_url(self, unit, fields, uids):
+        return "%s%s/%s/xml/?id=%s&n=all" % (self.path, "+".join(fields),
+            unit, "+".join(map(str, uids)))
+
+    def fetch(self, unit, fields, uids):
+        """
+        Yields a dict of get2 field -> element for every unit (album,
+        artist, track) returned for the given uids, in a single request.
+        """
+        url = self.get_url(unit, fields, uids)
+        for fresh in (False, True):
+            connection = self._acquire(fresh)
+            try:
+                connection.request("GET", url)
+                response = connection.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                # the server may have closed a kept-alive connection
+                connection.close()
+                if fresh:
+                    raise
+        try:
+            if response.status != 200:
+                response.read()
+                raise JamendoAPIError("%s returned %d" % (url, response.status))
+            for event, elem in ElementTree.iterparse(response):
+                if elem.tag == unit:
+                    yield dict([(child.tag, child) for child in elem])
+                    elem.clear()
+        finally:
+            if response.will_close:
+                connection.close()
+            else:
+                response.read()
+                self._release(connection)
+
+    def iter_units(self, unit, fields, uids):
+        """
+        Same as fetch, for any number of uids, batch_size uids per request.
+        """
+        for uids_chunk in chunks(uids, self.batch_size):
+            for record in self.fetch(unit, fields, uids_chunk):
+                yield record
+
+
+def fetch_fields(client, model, fields, uids):
+    """
+    Returns a dict of uid -> list of the given fields values, as returned
+    by Jamendo for the given uids of model (Album, Artist or Track), using
+    a single request.
+    """
+    unit = model._meta.module_name
+    api_fields = [REFRESHABLE_FIELDS[unit][field] for field in fields]
+    records = {}
+    for record in client.fetch(unit, ["id"] + [name for name, parser in
+        api_fields], uids):
+        values = []
+        for name, parser in api_fields:
+            if name in record:
+                values.append(parser(record[name]))
+            else:
+                values.append(None)
+        records[_int(record["id"])] = values
+    return records
+
+def refresh(model, fields, uids, client=None):
+    """
+    Updates the given fields of the rows of model (Album, Artist or Track)
+    with the given uids from Jamendo webservice. updated_at is set on every
+    refreshed row, modified_at only on the ones that changed.
+
+    Returns the number of refreshed rows.
+    """
+    client = client or JamendoClient()
+    refreshed = 0
+    for uids_chunk in chunks(uids, client.batch_size):
+        records = fetch_fields(client, model, fields, uids_chunk)
+        refreshed += write_refreshed(model, fields, records)
+    transaction.commit_unless_managed()
+    invalidate_responses(model)
+    return refreshed
+
+def write_refreshed(model, fields, records):
+    """
+    Writes records, a dict of uid -> list of fields values, into model
+    rows with one UPDATE batch. Missing (None) values keep the current
+    ones.
+    """
+    now = datetime.now()
+    rows = []
+    for values in model.objects.filter(uid__in=records.keys()).values_list(
+        "uid", "pk", "modified_at", *fields):
+        uid, pk, modified_at, current = values[0], values[1], values[2], \
+            list(values[3:])
+        new = [old if value is None else value
+            for value, old in zip(records[uid], current)]
+        if new != current:
+            modified_at = now
+        rows.append(tuple(new) + (modified_at, now, pk))
+    return update_rows(model, tuple(fields) + ("modified_at", "updated_at"),
+        rows)
@@ -28,8 +28,11 @@
 # THE SOFTWARE.
 # 
 
+import sys
 from xml.sax.saxutils import XMLGenerator
 from datetime import datetime
+from StringIO import StringIO
+from types import MethodType
 
 
 GENERATOR_TEXT = 'django-atompub'
@@ -69,11 +72,38 @@ def get_tag_uri(url, date):
 
 
 
+## (add_item keyword, Feed attribute, default factory, called with the item)
+ITEM_ATTRIBUTES = (
+    ('atom_id', 'item_id', None, True),
+    ('title', 'item_title', None, True),
+    ('updated', 'item_updated', None, True),
+    ('content', 'item_content', None, True),
+    ('published', 'item_published', None, True),
+    ('rights', 'item_rights', None, True),
+    ('source', 'item_source', None, True),
+    ('summary', 'item_summary', None, True),
+    ('authors', 'item_authors', list, True),
+    ('categories', 'item_categories', list, True),
+    ('contributors', 'item_contributors', list, True),
+    ('links', 'item_links', list, True),
+    ('extra_attrs', 'item_extra_attrs', dict, False),
+)
+
+# kinds of item attributes in a dispatch plan
+MISSING, CONSTANT, METHOD, DYNAMIC = range(4)
+
+
+
 ## based on django.contrib.syndication.feeds.Feed
 class Feed(object):
     
     
     VALIDATE = True
+    # if True, get_feed returns a StreamingAtomFeed, reading items while written
+    STREAM = False
+    # if True, item attributes are looked up once per class (see get_item_plan)
+    # instead of once per item
+    COMPILE_PLAN = True
     
     
     def __init__(self, slug, feed_url):
@@ -102,17 +132,114 @@ class Feed(object):
         return attr
     
     
-    def get_feed(self, extra_params=None):
-        
+    @classmethod
+    def get_item_plan(cls):
+        """
+        Returns the dispatch plan of the item attributes of the class: a
+        (keyword, attribute, default factory, called with the item, kind,
+        takes an argument) tuple per ITEM_ATTRIBUTES entry. It is compiled
+        on first use, with the reflection __get_dynamic_attr does per item.
+        """
+        if '_item_plan' not in cls.__dict__:
+            plan = []
+            for keyword, attname, default, pass_item in ITEM_ATTRIBUTES:
+                takes_argument = False
+                try:
+                    attr = getattr(cls, attname)
+                except AttributeError:
+                    kind = MISSING
+                else:
+                    if isinstance(attr, MethodType) and attr.im_self is None:
+                        kind = METHOD
+                        takes_argument = attr.im_func.func_code.co_argcount == 2
+                    elif callable(attr):
+                        # ie: staticmethods or callable objects
+                        kind = DYNAMIC
+                    else:
+                        kind = CONSTANT
+                plan.append((keyword, attname, default, pass_item, kind,
+                    takes_argument))
+            cls._item_plan = tuple(plan)
+        return cls._item_plan
+    
+    
+    def __dynamic_accessor(self, attname, default, pass_item):
+        # resolved per item, the way get_feed always did
+        def accessor(item):
+            if not pass_item:
+                item = None
+            return self.__get_dynamic_attr(attname, item,
+                default and default())
+        return accessor
+    
+    
+    def __get_item_accessors(self):
+        """
+        Returns (keyword, accessor) pairs, accessor(item) being the value of
+        keyword for item, bound to this feed according to the class plan.
+        """
+        accessors = []
+        for keyword, attname, default, pass_item, kind, takes_argument in \
+            self.get_item_plan():
+            if attname in self.__dict__ or not self.COMPILE_PLAN:
+                kind = DYNAMIC
+            if kind == METHOD:
+                method = getattr(self, attname)
+                if not takes_argument:
+                    accessor = lambda item, method=method: method()
+                elif pass_item:
+                    accessor = method
+                else:
+                    accessor = lambda item, method=method: method(None)
+            elif kind == CONSTANT:
+                accessor = lambda item, value=getattr(self, attname): value
+            elif kind == MISSING:
+                accessor = lambda item, default=default: default and default()
+            else:
+                accessor = self.__dynamic_accessor(attname, default, pass_item)
+            accessors.append((keyword, accessor))
+        return accessors
+    
+    
+    def get_item_params(self, item):
+        """
+        Returns the add_item keyword arguments of item.
+        """
+        accessors = self.__dict__.get('_item_accessors')
+        if accessors is None:
+            accessors = self._item_accessors = self.__get_item_accessors()
+        params = {}
+        for keyword, accessor in accessors:
+            params[keyword] = accessor(item)
+        return params
+    
+    
+    def get_feed(self, extra_params=None, stream=None):
+        return self.make_feed(self.get_feed_object(extra_params), stream)
+    
+    
+    def get_feed_object(self, extra_params=None):
+        """
+        Returns the object the feed is about, given the url bits after its
+        slug, or None.
+        """
         if extra_params:
             try:
-                obj = self.get_object(extra_params.split('/'))
+                return self.get_object(extra_params.split('/'))
             except (AttributeError, LookupError):
                 raise LookupError('Feed does not exist')
-        else:
-            obj = None
+        return None
+    
+    
+    def make_feed(self, obj=None, stream=None):
         
-        feed = AtomFeed(
+        if stream is None:
+            stream = self.STREAM
+        if stream:
+            feed_class = StreamingAtomFeed
+        else:
+            feed_class = AtomFeed
+        feed = feed_class(
             atom_id = self.__get_dynamic_attr('feed_id', obj),
             title = self.__get_dynamic_attr('feed_title', obj),
             updated = self.__get_dynamic_attr('feed_updated', obj),
@@ -132,22 +259,12 @@ class Feed(object):
         if items is None:
             raise LookupError('Feed has no items field')
         
-        for item in items:
-            feed.add_item(
-                atom_id = self.__get_dynamic_attr('item_id', item), 
-                title = self.__get_dynamic_attr('item_title', item),
-                updated = self.__get_dynamic_attr('item_updated', item),
-                content = self.__get_dynamic_attr('item_content', item),
-                published = self.__get_dynamic_attr('item_published', item),
-                rights = self.__get_dynamic_attr('item_rights', item),
-                source = self.__get_dynamic_attr('item_source', item),
-                summary = self.__get_dynamic_attr('item_summary', item),
-                authors = self.__get_dynamic_attr('item_authors', item, default=[]),
-                categories = self.__get_dynamic_attr('item_categories', item, default=[]),
-                contributors = self.__get_dynamic_attr('item_contributors', item, default=[]),
-                links = self.__get_dynamic_attr('item_links', item, default=[]),
-                extra_attrs = self.__get_dynamic_attr('item_extra_attrs', None, default={}),
-            )
+        if stream:
+            feed.set_items((self.get_item_params(item) for item in items),
+                validate=self.VALIDATE)
+        else:
+            for item in items:
+                feed.add_item(**self.get_item_params(item))
         
         if self.VALIDATE:
             feed.validate()
@@ -160,6 +277,17 @@ class ValidationError(Exception):
 
 
 
+def validate_text_construct(obj):
+    if isinstance(obj, tuple):
+        if obj[0] not in ['text', 'html', 'xhtml']:
+            return False
+    # @@@ no validation is done that 'html' text constructs are valid HTML
+    # @@@ no validation is done that 'xhtml' text constructs are well-formed XML or valid XHTML
+    
+    return True
+
+
+
 ## based on django.utils.feedgenerator.SyndicationFeed and django.utils.feedgenerator.Atom1Feed
 class AtomFeed(object):
     
@@ -193,7 +321,11 @@ class AtomFeed(object):
         self.items = []
     
     
-    def add_item(self, atom_id, title, updated, content=None, published=None, rights=None, source=None, summary=None,
+    def add_item(self, **kwargs):
+        self.items.append(self.make_item(**kwargs))
+    
+    
+    def make_item(self, atom_id, title, updated, content=None, published=None, rights=None, source=None, summary=None,
         authors=[], categories=[], contributors=[], links=[], extra_attrs={}):
         if atom_id is None:
             raise LookupError('Feed has no item_id method')
@@ -201,7 +333,7 @@ class AtomFeed(object):
             raise LookupError('Feed has no item_title method')
         if updated is None:
             raise LookupError('Feed has no item_updated method')
-        self.items.append({
+        return {
             'id': atom_id,
             'title': title,
             'updated': updated,
@@ -215,7 +347,7 @@ class AtomFeed(object):
             'contributors': contributors,
             'links': links,
             'extra_attrs': extra_attrs,
-        })
+        }
     
     
     def latest_updated(self):
@@ -305,6 +437,47 @@ class AtomFeed(object):
     
     def write(self, outfile, encoding):
         handler = SimplerXMLGenerator(outfile, encoding)
+        self.write_head(handler)
+        self.write_items(handler)
+        handler.endElement(u'feed')
+    
+    
+    def iter_write(self, encoding):
+        """
+        Same as write, but yields the document in pieces, one per entry,
+        instead of writing it to a file. If an entry fails (ie: it does not
+        validate), the document is ended before it and the error raised.
+        """
+        buffer = StringIO()
+        handler = SimplerXMLGenerator(buffer, encoding)
+        
+        def flush():
+            data = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return data
+        
+        self.write_head(handler)
+        yield flush()
+        try:
+            for item in self.items:
+                self.write_item(handler, item)
+                yield flush()
+        except Exception:
+            # the pieces sent so far must still make a well-formed document
+            exc_info = sys.exc_info()
+            flush()
+            handler.endElement(u'feed')
+            yield flush()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        handler.endElement(u'feed')
+        yield flush()
+    
+    
+    def write_head(self, handler):
+        """
+        Writes the document up to the first entry.
+        """
         handler.startDocument()
         feed_attrs = {u'xmlns': self.ns}
         if self.feed.get('extra_attrs'):
@@ -334,53 +507,50 @@ class AtomFeed(object):
             self.write_text_construct(handler, u'rights', self.feed['rights'])
         if not self.feed.get('hide_generator'):
             handler.addQuickElement(u'generator', GENERATOR_TEXT, GENERATOR_ATTR)
-        
-        self.write_items(handler)
-        
-        handler.endElement(u'feed')
     
     
     def write_items(self, handler):
         for item in self.items:
-            entry_attrs = item.get('extra_attrs', {})
-            handler.startElement(u'entry', entry_attrs)
-            
-            handler.addQuickElement(u'id', item['id'])
-            self.write_text_construct(handler, u'title', item['title'])
-            handler.addQuickElement(u'updated', rfc3339_date(item['updated']))
-            if item.get('published'):
-                handler.addQuickElement(u'published', rfc3339_date(item['published']))
-            if item.get('rights'):
-                self.write_text_construct(handler, u'rights', item['rights'])
-            if item.get('source'):
-                self.write_source(handler, item['source'])
-            
-            for author in item['authors']:
-                self.write_person_construct(handler, u'author', author)
-            for contributor in item['contributors']:
-                self.write_person_construct(handler, u'contributor', contributor)
-            for category in item['categories']:
-                self.write_category_construct(handler, category)
-            for link in item['links']:
-                self.write_link_construct(handler, link)
-            if item.get('summary'):
-                self.write_text_construct(handler, u'summary', item['summary'])
-            if item.get('content'):
-                self.write_content(handler, item['content'])
-            
-            handler.endElement(u'entry')
+            self.write_item(handler, item)
     
     
-    def validate(self):
+    def write_item(self, handler, item):
+        entry_attrs = item.get('extra_attrs', {})
+        handler.startElement(u'entry', entry_attrs)
+        
+        handler.addQuickElement(u'id', item['id'])
+        self.write_text_construct(handler, u'title', item['title'])
+        handler.addQuickElement(u'updated', rfc3339_date(item['updated']))
+        if item.get('published'):
+            handler.addQuickElement(u'published', rfc3339_date(item['published']))
+        if item.get('rights'):
+            self.write_text_construct(handler, u'rights', item['rights'])
+        if item.get('source'):
+            self.write_source(handler, item['source'])
+        
+        for author in item['authors']:
+            self.write_person_construct(handler, u'author', author)
+        for contributor in item['contributors']:
+            self.write_person_construct(handler, u'contributor', contributor)
+        for category in item['categories']:
+            self.write_category_construct(handler, category)
+        for link in item['links']:
+            self.write_link_construct(handler, link)
+        if item.get('summary'):
+            self.write_text_construct(handler, u'summary', item['summary'])
+        if item.get('content'):
+            self.write_content(handler, item['content'])
         
-        def validate_text_construct(obj):
-            if isinstance(obj, tuple):
-                if obj[0] not in ['text', 'html', 'xhtml']:
-                    return False
-            # @@@ no validation is done that 'html' text constructs are valid HTML
-            # @@@ no validation is done that 'xhtml' text constructs are well-formed XML or valid XHTML
-            
-            return True
+        handler.endElement(u'entry')
+    
+    
+    def validate(self):
+        self.validate_feed()
+        for item in self.items:
+            self.validate_item(item)
+    
+    
+    def validate_feed(self):
         
         if not validate_text_construct(self.feed['title']):
             raise ValidationError('feed title has invalid type')
@@ -398,77 +568,116 @@ class AtomFeed(object):
                 if key in alternate_links:
                     raise ValidationError('alternate links must have unique type/hreflang')
                 alternate_links[key] = link
+    
+    
+    def validate_item(self, item):
+        feed_author = bool(self.feed.get('authors'))
+        if not feed_author and not item.get('authors'):
+            if item.get('source') and item['source'].get('authors'):
+                pass
+            else:
+                raise ValidationError('if no feed author, all entries must have author (possibly in source)')
         
-        if self.feed.get('authors'):
-            feed_author = True
-        else:
-            feed_author = False
+        if not validate_text_construct(item['title']):
+            raise ValidationError('entry title has invalid type')
+        if item.get('rights'):
+            if not validate_text_construct(item['rights']):
+                raise ValidationError('entry rights has invalid type')
+        if item.get('summary'):
+            if not validate_text_construct(item['summary']):
+                raise ValidationError('entry summary has invalid type')
+        source = item.get('source')
+        if source:
+            if source.get('title'):
+                if not validate_text_construct(source['title']):
+                    raise ValidationError('source title has invalid type')
+            if source.get('subtitle'):
+                if not validate_text_construct(source['subtitle']):
+                    raise ValidationError('source subtitle has invalid type')
+            if source.get('rights'):
+                if not validate_text_construct(source['rights']):
+                    raise ValidationError('source rights has invalid type')
         
-        for item in self.items:
-            if not feed_author and not item.get('authors'):
-                if item.get('source') and item['source'].get('authors'):
-                    pass
-                else:
-                    raise ValidationError('if no feed author, all entries must have author (possibly in source)')
-            
-            if not validate_text_construct(item['title']):
-                raise ValidationError('entry title has invalid type')
-            if item.get('rights'):
-                if not validate_text_construct(item['rights']):
-                    raise ValidationError('entry rights has invalid type')
-            if item.get('summary'):
-                if not validate_text_construct(item['summary']):
-                    raise ValidationError('entry summary has invalid type')
-            source = item.get('source')
-            if source:
-                if source.get('title'):
-                    if not validate_text_construct(source['title']):
-                        raise ValidationError('source title has invalid type')
-                if source.get('subtitle'):
-                    if not validate_text_construct(source['subtitle']):
-                        raise ValidationError('source subtitle has invalid type')
-                if source.get('rights'):
-                    if not validate_text_construct(source['rights']):
-                        raise ValidationError('source rights has invalid type')
-            
-            alternate_links = {}
-            for link in item.get('links'):
-                if link.get('rel') == 'alternate' or link.get('rel') == None:
-                    key = (link.get('type'), link.get('hreflang'))
-                    if key in alternate_links:
-                        raise ValidationError('alternate links must have unique type/hreflang')
-                    alternate_links[key] = link
-            
-            if not item.get('content'):
-                if not alternate_links:
-                    raise ValidationError('if no content, entry must have alternate link')
-            
-            if item.get('content') and isinstance(item.get('content'), tuple):
-                content_type = item.get('content')[0].get('type')
-                if item.get('content')[0].get('src'):
-                    if item.get('content')[1]:
-                        raise ValidationError('content with src should be empty')
-                    if not item.get('summary'):
-                        raise ValidationError('content with src requires a summary too')
-                    if content_type in ['text', 'html', 'xhtml']:
-                        raise ValidationError('content with src cannot have type of text, html or xhtml')
-                if content_type:
-                    if '/' in content_type and \
-                        not content_type.startswith('text/') and \
-                        not content_type.endswith('/xml') and not content_type.endswith('+xml') and \
-                        not content_type in ['application/xml-external-parsed-entity', 'application/xml-dtd']:
-                        # @@@ check content is Base64
-                        if not item.get('summary'):
-                            raise ValidationError('content in Base64 requires a summary too')
-                    if content_type not in ['text', 'html', 'xhtml'] and '/' not in content_type:
-                        raise ValidationError('content type does not appear to be valid')
-                    
-                    # @@@ no validation is done that 'html' text constructs are valid HTML
-                    # @@@ no validation is done that 'xhtml' text constructs are well-formed XML or valid XHTML
-                    
-                    return
+        alternate_links = {}
+        for link in item.get('links'):
+            if link.get('rel') == 'alternate' or link.get('rel') == None:
+                key = (link.get('type'), link.get('hreflang'))
+                if key in alternate_links:
+                    raise ValidationError('alternate links must have unique type/hreflang')
+                alternate_links[key] = link
+        
+        if not item.get('content'):
+            if not alternate_links:
+                raise ValidationError('if no content, entry must have alternate link')
         
-        return
+        if item.get('content') and isinstance(item.get('content'), tuple):
+            content_type = item.get('content')[0].get('type')
+            if item.get('content')[0].get('src'):
+                if item.get('content')[1]:
+                    raise ValidationError('content with src should be empty')
+                if not item.get('summary'):
+                    raise ValidationError('content with src requires a summary too')
+                if content_type in ['text', 'html', 'xhtml']:
+                    raise ValidationError('content with src cannot have type of text, html or xhtml')
+            if content_type:
+                if '/' in content_type and \
+                    not content_type.startswith('text/') and \
+                    not content_type.endswith('/xml') and not content_type.endswith('+xml') and \
+                    not content_type in ['application/xml-external-parsed-entity', 'application/xml-dtd']:
+                    # @@@ check content is Base64
+                    if not item.get('summary'):
+                        raise ValidationError('content in Base64 requires a summary too')
+                if content_type not in ['text', 'html', 'xhtml'] and '/' not in content_type:
+                    raise ValidationError('content type does not appear to be valid')
+                
+                # @@@ no validation is done that 'html' text constructs are valid HTML
+                # @@@ no validation is done that 'xhtml' text constructs are well-formed XML or valid XHTML
+
+
+
+class StreamingAtomFeed(AtomFeed):
+    """
+    An AtomFeed whose items are an iterable of make_item keyword arguments,
+    read one at a time while the feed is written, so only the current one
+    is ever in memory. Use it with iter_write.
+    """
+    
+    
+    validate_items = False
+    
+    
+    def set_items(self, item_params, validate=True):
+        self.items = item_params
+        self.validate_items = validate
+    
+    
+    def add_item(self, **kwargs):
+        raise TypeError('StreamingAtomFeed items are given with set_items')
+    
+    
+    def _get_items(self):
+        for params in self.item_params:
+            item = self.make_item(**params)
+            if self.validate_items:
+                self.validate_item(item)
+            yield item
+    
+    def _set_items(self, item_params):
+        self.item_params = item_params
+    items = property(_get_items, _set_items)
+    
+    
+    def latest_updated(self):
+        """
+        Items are not known before the head is written, so the feed must
+        define its updated, or it will be the current time.
+        """
+        return datetime.now()
+    
+    
+    def validate(self):
+        # items are validated while written
+        self.validate_feed()
 
 
 
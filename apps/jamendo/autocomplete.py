@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-memory prefix indexes for search-as-you-type.
+
+Every process keeps, per kind of object (artists, albums, tags), a sorted
+list of (normalized word sequence, pk) keys: a name like "Both Ways" is
+found by "bo" and by "wa". Lookups are two bisects plus a scan of the
+matching range, the most popular matches first, and never touch the
+database.
+
+Indexes are built on first use and refreshed, at most every
+JAMENDO_AUTOCOMPLETE_REFRESH seconds, with the rows modified since the
+last refresh. Rows deleted meanwhile go away with the full rebuild done
+every JAMENDO_AUTOCOMPLETE_REBUILD seconds. Refreshes run in a thread of
+their own, lookups keep using the current lists until new ones are built
+and swapped in. Tags are weighted by their jamendo.clouds counts.
+"""
+
+import heapq
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+
+from jamendo.models import Artist, Album, CloudTag
+
+
+AUTOCOMPLETE_LIMIT = getattr(settings, "JAMENDO_AUTOCOMPLETE_LIMIT", 10)
+AUTOCOMPLETE_REFRESH = getattr(settings, "JAMENDO_AUTOCOMPLETE_REFRESH", 60)
+AUTOCOMPLETE_REBUILD = getattr(settings, "JAMENDO_AUTOCOMPLETE_REBUILD", 3600)
+
+# matches of prefixes with more than this many keys are memoized until the
+# next refresh, so one letter queries do not scan half the index
+MEMOIZE_THRESHOLD = 1000
+
+
+def normalize(name):
+    """
+    Lowercases name, strips its accents and collapses whitespace, ie:
+    u"  Béla  Fleck" -> u"bela fleck".
+    """
+    name = unicodedata.normalize("NFKD", unicode(name or u""))
+    name = u"".join([char for char in name if not unicodedata.combining(char)])
+    return u" ".join(name.lower().split())
+
+def index_keys(name):
+    """
+    Returns the keys name is indexed by: its normalized form and every
+    word suffix of it, ie: u"Both Ways" -> [u"both ways", u"ways"].
+    """
+    words = normalize(name).split()
+    return [u" ".join(words[index:]) for index in range(len(words))]
+
+
+class PrefixIndex(object):
+    """
+    Sorted (key, pk) list of the rows returned by load, with their name and
+    weight. Subclasses define load(since), returning (pk, name, weight)
+    tuples of the rows modified after since (all of them if it is None).
+    """
+
+    def __init__(self, refresh_interval=AUTOCOMPLETE_REFRESH,
+        rebuild_interval=AUTOCOMPLETE_REBUILD):
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.lock = threading.Lock()
+        # (keys, rows, memo), swapped as a whole
+        self.data = None
+        self.refreshed_at = self.rebuilt_at = 0
+        self.since = None
+
+    def load(self, since):
+        raise NotImplementedError
+
+    def _build(self, rows, keys=()):
+        """
+        Returns the keys of rows (a dict of pk -> (name, weight)) merged
+        with the given, already sorted, keys of other rows. Keys of the pks
+        in rows are replaced.
+        """
+        new_keys = []
+        for pk, (name, weight) in rows.iteritems():
+            for key in index_keys(name):
+                new_keys.append((key, pk))
+        new_keys.sort()
+        keys = [key for key in keys if key[1] not in rows]
+        return list(heapq.merge(keys, new_keys))
+
+    def stale(self):
+        return self.data is None or \
+            time.time() - self.refreshed_at >= self.refresh_interval
+
+    def refresh(self, force=False):
+        if not force and not self.stale():
+            return
+        if not self.lock.acquire(False):
+            # another thread is at it, the current data is good enough
+            if self.data is not None:
+                return
+            self.lock.acquire()
+        try:
+            self._refresh(force)
+        finally:
+            self.lock.release()
+
+    def refresh_later(self):
+        """
+        Refreshes the index in a new thread, unless one is at it already.
+        """
+        if not self.lock.acquire(False):
+            return
+        thread = threading.Thread(target=self._refresh_in_thread)
+        thread.setDaemon(True)
+        try:
+            thread.start()
+        except:
+            self.lock.release()
+            raise
+
+    def _refresh_in_thread(self):
+        try:
+            self._refresh()
+        finally:
+            self.lock.release()
+            # the connection of this thread
+            connection.close()
+
+    def _refresh(self, force=False):
+        now = time.time()
+        started = datetime.now()
+        if self.data is None or force or \
+            now - self.rebuilt_at >= self.rebuild_interval:
+            rows = dict([(pk, (name, weight))
+                for pk, name, weight in self.load(None)])
+            self.data = (self._build(rows), rows, {})
+            self.rebuilt_at = now
+        else:
+            changed = dict([(pk, (name, weight))
+                for pk, name, weight in self.load(self.since)])
+            if changed:
+                keys, rows, memo = self.data
+                new_rows = rows.copy()
+                new_rows.update(changed)
+                self.data = (self._build(changed, keys), new_rows, {})
+        self.since = started
+        self.refreshed_at = now
+
+    def lookup(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        """
+        Returns up to limit (pk, name) tuples of the rows with a key
+        starting by prefix, the heaviest first. Only the first lookup waits
+        for the index to be built.
+        """
+        if self.data is None:
+            self.refresh()
+        elif self.stale():
+            self.refresh_later()
+        keys, rows, memo = self.data
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        memo_key = (prefix, limit)
+        if memo_key in memo:
+            return memo[memo_key]
+
+        start = bisect_left(keys, (prefix, ))
+        end = bisect_left(keys, (prefix + u"\uffff", ), start)
+        pks = set([pk for key, pk in keys[start:end]])
+        matches = heapq.nsmallest(limit, pks, key=lambda pk: (-rows[pk][1],
+            pk))
+        results = [(pk, rows[pk][0]) for pk in matches]
+        if end - start > MEMOIZE_THRESHOLD:
+            memo[memo_key] = results
+        return results
+
+
+class ModelPrefixIndex(PrefixIndex):
+    """
+    Index of the names of model rows, weighted by the weight field.
+    """
+
+    def __init__(self, model, weight, *args, **kwargs):
+        super(ModelPrefixIndex, self).__init__(*args, **kwargs)
+        self.model = model
+        self.weight = weight
+
+    def load(self, since):
+        queryset = self.model.objects.exclude(name=u"")
+        if since is not None:
+            queryset = queryset.filter(modified_at__gte=since)
+        return queryset.values_list("pk", "name", self.weight).iterator()
+
+
+class TagPrefixIndex(PrefixIndex):
+    """
+    Index of tag names weighted by how many objects they tag, the sum of
+    their CloudTag counts. Those are recounted with every tag write, so
+    the tags recounted since the last refresh are the changed ones.
+    """
+
+    def load(self, since):
+        cloud = CloudTag.objects.order_by()
+        if since is not None:
+            cloud = cloud.filter(tag__in=list(CloudTag.objects.filter(
+                modified_at__gte=since).values_list("tag", flat=True)))
+        cloud = cloud.values("tag", "name").annotate(weight=Sum("count"))
+        return cloud.values_list("tag", "name", "weight").iterator()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+INDEX_FACTORIES = {
+    "artists": lambda: ModelPrefixIndex(Artist, "album_count"),
+    "albums": lambda: ModelPrefixIndex(Album, "track_count"),
+    "tags": lambda: TagPrefixIndex(),
+}
+
+def get_index(kind):
+    """
+    Returns the PrefixIndex of this process for kind (see INDEX_FACTORIES).
+    """
+    if kind not in _indexes:
+        _indexes_lock.acquire()
+        try:
+            if kind not in _indexes:
+                _indexes[kind] = INDEX_FACTORIES[kind]()
+        finally:
+            _indexes_lock.release()
+    return _indexes[kind]
+
+def autocomplete(kind, prefix, limit=AUTOCOMPLETE_LIMIT):
+    return get_index(kind).lookup(prefix, limit)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Synthetic Jamendo dumps and an import benchmark to measure them with.
+
+write_dump writes a dump in the format of the real one (see jamendo.dump)
+with a given number of tracks. Sizes are skewed the way the real catalog
+is: most artists have one or two albums and a few have dozens, album
+lengths follow a log-normal distribution and tag popularity a Zipf-like
+one. The same seed always gives the same dump.
+
+benchmark_import imports a dump timing every DumpImporter stage and
+returns the results as a dict, ready to be dumped as json.
+
+benchmark_feed times building the entries of a large in-memory feed with
+the item attributes looked up per item and through the compiled dispatch
+plan of atom.Feed.
+"""
+
+import gzip
+import random
+import resource
+import time
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+from tagging.models import TaggedItem
+
+from jamendo.atom import Feed
+from jamendo.dump import ID3_GENRES
+from jamendo.importer import DumpImporter, DEFAULT_BATCH_SIZE
+from jamendo.models import Artist, Album, Track
+
+
+# named sizes accepted by parse_size
+DUMP_SIZES = {"10k": 10000, "100k": 100000, "1m": 1000000}
+
+LICENSES = (
+    "http://creativecommons.org/licenses/by/3.0/",
+    "http://creativecommons.org/licenses/by-sa/3.0/",
+    "http://creativecommons.org/licenses/by-nc/3.0/",
+    "http://creativecommons.org/licenses/by-nc-sa/3.0/",
+    "http://creativecommons.org/licenses/by-nc-nd/3.0/",
+    "http://creativecommons.org/licenses/by-nc-sa/2.0/",
+    "http://creativecommons.org/licenses/by-nc-nd/2.0/",
+    "http://creativecommons.org/licenses/by-sa/2.0/",
+)
+
+# (iso3 code, relative weight) of the artist countries
+COUNTRIES = (
+    ("FRA", 40), ("USA", 15), ("DEU", 10), ("ESP", 8), ("ITA", 6),
+    ("BEL", 5), ("GBR", 5), ("CAN", 3), ("BRA", 3), ("ARG", 2), ("RUS", 2),
+    ("POL", 1),
+)
+
+SYLLABLES = (u"la", u"mo", u"ri", u"ka", u"zé", u"tu", u"ven", u"ö", u"dra",
+    u"son", u"pi", u"lu", u"ne", u"çi", u"bo", u"ar")
+
+TAG_VOCABULARY = 2000
+MAX_TAGS_PER_TRACK = 8
+
+
+def parse_size(size):
+    """
+    Returns the number of tracks for size, either one of DUMP_SIZES or a
+    number.
+    """
+    size = size.lower()
+    if size in DUMP_SIZES:
+        return DUMP_SIZES[size]
+    return int(size)
+
+
+class DumpGenerator(object):
+    """
+    Writes synthetic dumps of tracks tracks.
+    """
+
+    def __init__(self, tracks, seed=0):
+        self.tracks = tracks
+        self.random = random.Random(seed)
+        self.countries = []
+        for code, weight in COUNTRIES:
+            self.countries.extend([code] * weight)
+
+    def words(self, count):
+        return u" ".join([u"".join([self.random.choice(SYLLABLES)
+            for i in range(self.random.randint(1, 4))]).capitalize()
+            for j in range(count)])
+
+    def album_count(self):
+        return min(60, int(self.random.paretovariate(1.3)))
+
+    def track_count(self):
+        return max(1, min(40, int(self.random.lognormvariate(2.1, 0.6))))
+
+    def tag(self):
+        # zipf-like: tag n is about n times less used than the first one
+        rank = min(TAG_VOCABULARY, int(self.random.paretovariate(1.0)))
+        return "tag%d" % rank
+
+    def write(self, fileobj):
+        """
+        Writes the dump to fileobj. Returns a (artists, albums, tracks)
+        tuple with the number of written records.
+        """
+        write = fileobj.write
+        write('<?xml version="1.0" encoding="UTF-8"?>\n<JamendoData>\n<Artists>\n')
+        artists = albums = tracks = 0
+        while tracks < self.tracks:
+            artists += 1
+            parts = [u"<artist><id>%d</id><name>%s</name>"
+                u"<url>http://www.jamendo.com/artist/%d</url><mbgid></mbgid>"
+                u"<image>http://img.jamendo.com/artists/%d.jpg</image>"
+                u"<location><country>%s</country><state>%d</state>"
+                u"<city>%s</city><latitude>%.4f</latitude>"
+                u"<longitude>%.4f</longitude></location><Albums>" % (artists,
+                escape(self.words(2)), artists, artists,
+                self.random.choice(self.countries), self.random.randint(1, 20),
+                escape(self.words(1)), self.random.uniform(-60, 70),
+                self.random.uniform(-180, 180))]
+            for i in range(self.album_count()):
+                if tracks >= self.tracks:
+                    break
+                albums += 1
+                genre = self.random.randrange(len(ID3_GENRES))
+                license = self.random.choice(LICENSES)
+                parts.append(u"<album><id>%d</id><name>%s</name>"
+                    u"<url>http://www.jamendo.com/album/%d</url>"
+                    u"<releasedate>%d-%02d-%02dT12:00:00+01:00</releasedate>"
+                    u"<filename>%s</filename><id3genre>%d</id3genre>"
+                    u"<license_artwork>%s</license_artwork><Tracks>" % (
+                    albums, escape(self.words(3)), albums,
+                    self.random.randint(2004, 2010), self.random.randint(1, 12),
+                    self.random.randint(1, 28), escape(self.words(3)), genre,
+                    license))
+                for numalbum in range(1, self.track_count() + 1):
+                    if tracks >= self.tracks:
+                        break
+                    tracks += 1
+                    tags = set([self.tag() for j in range(
+                        min(MAX_TAGS_PER_TRACK,
+                        int(self.random.expovariate(0.5))))])
+                    parts.append(u"<track><id>%d</id><name>%s</name>"
+                        u"<duration>%d</duration><numalbum>%d</numalbum>"
+                        u"<filename>%02d - %s</filename><id3genre>%d</id3genre>"
+                        u"<license>%s</license><Tags>%s</Tags></track>" % (
+                        tracks, escape(self.words(3)),
+                        self.random.randint(60, 600), numalbum, numalbum,
+                        escape(self.words(2)), genre, license,
+                        u"".join([u"<tag><idstr>%s</idstr><weight>%.2f</weight>"
+                            u"</tag>" % (tag, self.random.random())
+                            for tag in sorted(tags)])))
+                parts.append(u"</Tracks></album>")
+            parts.append(u"</Albums></artist>\n")
+            write(u"".join(parts).encode("utf-8"))
+        write("</Artists>\n</JamendoData>\n")
+        return artists, albums, tracks
+
+
+def write_dump(path, tracks, seed=0):
+    """
+    Writes a synthetic dump of tracks tracks to path, gzipped if it ends in
+    .gz. Returns a (artists, albums, tracks) tuple.
+    """
+    if path.endswith(".gz"):
+        fileobj = gzip.open(path, "wb")
+    else:
+        fileobj = open(path, "wb")
+    try:
+        return DumpGenerator(tracks, seed).write(fileobj)
+    finally:
+        fileobj.close()
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process and of its
+    (finished) children, in kilobytes.
+    """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def benchmark_import(fileobj, batch_size=DEFAULT_BATCH_SIZE, processes=0,
+    delta=False):
+    """
+    Imports the dump read from fileobj and returns a dict with the elapsed
+    time, the time spent in every importer stage, the inserted rows and
+    rows/second, per model and in total, and the peak RSS.
+    """
+    start = time.time()
+    importer = DumpImporter(batch_size=batch_size, delta=delta, verbosity=0)
+    if processes > 0:
+        counts = importer.run_parallel(fileobj, processes)
+    else:
+        counts = importer.run(fileobj)
+    elapsed = max(time.time() - start, 0.001)
+
+    rows = {}
+    for model in (Artist, Album, Track, TaggedItem):
+        name = model.__name__
+        rows[name] = counts[name] + importer.updated[name]
+    total = sum(counts.values()) + sum(importer.updated.values())
+    rss, children_rss = peak_rss()
+    return {
+        "batch_size": batch_size,
+        "processes": processes,
+        "delta": delta,
+        "elapsed": round(elapsed, 3),
+        "stages": dict([(name, round(seconds, 3))
+            for name, seconds in importer.timings.items()]),
+        "rows": rows,
+        "rows_per_second": dict([(name, round(count / elapsed, 1))
+            for name, count in rows.items()]),
+        "total_rows": total,
+        "total_rows_per_second": round(total / elapsed, 1),
+        "peak_rss_kb": rss,
+        "peak_children_rss_kb": children_rss,
+    }
+
+
+class BenchmarkItem(object):
+    def __init__(self, pk, date):
+        self.pk = pk
+        self.name = u"item %d" % pk
+        self.added_at = self.modified_at = date
+
+class BenchmarkFeed(Feed):
+    """
+    A feed of in-memory items with the item attributes of jamendo.feeds, so
+    only the feed building is timed.
+    """
+    VALIDATE = False
+
+    def __init__(self, items):
+        super(BenchmarkFeed, self).__init__(None, None)
+        self.objects = items
+
+    def items(self):
+        return self.objects
+
+    def feed_id(self):
+        return u"http://example.com/feeds/benchmark/"
+
+    def feed_title(self):
+        return u"Benchmark"
+
+    def item_id(self, item):
+        return u"http://example.com/items/%d/" % item.pk
+
+    def item_title(self, item):
+        return item.name
+
+    def item_updated(self, item):
+        return item.modified_at
+
+    def item_published(self, item):
+        return item.added_at
+
+    def item_authors(self, item):
+        return [{"name": item.name}]
+
+    def item_content(self, item):
+        return {"type": "html"}, item.name
+
+    def item_links(self, item):
+        return [{"href": u"http://example.com/items/%d/" % item.pk}]
+
+    def item_categories(self, item):
+        return []
+
+def benchmark_feed(items=10000, repeat=3):
+    """
+    Builds a feed of items entries with its item attributes resolved by
+    reflection, per item, and through the compiled dispatch plan, and
+    returns the best time of repeat runs of each and the speedup.
+    """
+    now = datetime.now()
+    objects = [BenchmarkItem(pk, now) for pk in range(items)]
+    results = {"items": items, "repeat": repeat}
+    for name, compile_plan in (("reflection", False), ("plan", True)):
+        timings = []
+        for i in range(repeat):
+            feed = BenchmarkFeed(objects)
+            feed.COMPILE_PLAN = compile_plan
+            start = time.time()
+            feed.get_feed(stream=False)
+            timings.append(time.time() - start)
+        results[name] = round(max(min(timings), 0.000001), 6)
+    results["speedup"] = round(results["reflection"] / results["plan"], 2)
+    return results
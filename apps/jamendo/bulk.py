@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers to write many rows at once, bypassing the ORM one-query-per-object
+save() and delete().
+"""
+
+from django.db import connection
+
+
+# sqlite refuses queries with more than 999 parameters
+IN_CHUNK_SIZE = 500
+
+
+def chunks(values, size=IN_CHUNK_SIZE):
+    values = list(values)
+    for start in xrange(0, len(values), size):
+        yield values[start:start + size]
+
+def insert_rows(model, fields, rows):
+    """
+    Inserts rows, tuples of values in the same order as the given field
+    names, into model's table using a single executemany.
+    """
+    if not rows:
+        return 0
+    qn = connection.ops.quote_name
+    model_fields = [model._meta.get_field(name) for name in fields]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join([qn(field.column) for field in model_fields]),
+        ", ".join(["%s"] * len(model_fields)))
+    params = [[field.get_db_prep_save(value)
+        for field, value in zip(model_fields, row)] for row in rows]
+    cursor = connection.cursor()
+    cursor.executemany(sql, params)
+    return len(rows)
+
+def update_rows(model, fields, rows):
+    """
+    Updates the given fields of many rows with a single executemany. Each
+    row is a tuple of values in fields order followed by the primary key.
+    """
+    if not rows:
+        return 0
+    qn = connection.ops.quote_name
+    model_fields = [model._meta.get_field(name) for name in fields]
+    sql = "UPDATE %s SET %s WHERE %s = %%s" % (
+        qn(model._meta.db_table),
+        ", ".join(["%s = %%s" % qn(field.column) for field in model_fields]),
+        qn(model._meta.pk.column))
+    params = [[field.get_db_prep_save(value)
+        for field, value in zip(model_fields, row)] + [row[-1]] for row in rows]
+    cursor = connection.cursor()
+    cursor.executemany(sql, params)
+    return len(rows)
+
+def delete_rows(model, pks):
+    """
+    Deletes the rows with the given primary keys, IN_CHUNK_SIZE at a time.
+    No signal is sent and nothing is deleted in cascade.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    deleted = 0
+    for pks_chunk in chunks(pks):
+        cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+            qn(model._meta.db_table), qn(model._meta.pk.column),
+            ", ".join(["%s"] * len(pks_chunk))), pks_chunk)
+        deleted += len(pks_chunk)
+    return deleted
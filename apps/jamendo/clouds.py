@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Precomputed tag clouds.
+
+Tag.objects.cloud_for_model aggregates the whole TaggedItem table and sizes
+every tag in python on each call. The clouds of artists, albums and tracks
+are kept instead in CloudTag, one row per (model, tag) with its count and
+font size, so a cloud page reads a few hundred rows.
+
+Albums are counted through AlbumTag: an album has a tag if any of its
+tracks does.
+
+refresh_clouds() rebuilds whole clouds set-wise, and is run after imports.
+refresh_clouds(tag_ids) recounts only the given tags, it is what tag writes
+run. It sizes those tags against the current smallest and largest counts
+but leaves the other rows alone, so their sizes may lag a bit behind until
+the next full rebuild.
+"""
+
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import Min, Max
+
+from tagging.models import Tag, TaggedItem
+from tagging.utils import LOGARITHMIC, _calculate_thresholds,\
+    _calculate_tag_weight
+
+from jamendo.bulk import chunks, update_rows
+from jamendo.responses import invalidate_responses
+
+
+CLOUD_STEPS = getattr(settings, "JAMENDO_CLOUD_STEPS", 4)
+
+
+def cloud_models():
+    from jamendo.models import Artist, Album, Track
+    return (Artist, Album, Track)
+
+def _count_sql(model, ctype_id, now):
+    """
+    Returns the SELECT of the (content type, tag, name, count, font size,
+    modified at) rows of the cloud of model, font sizes still unset, with
+    room for a tag_id condition at the end, and its parameters.
+    """
+    from jamendo.models import Album, AlbumTag
+    qn = connection.ops.quote_name
+    values = {
+        "tag": qn(Tag._meta.db_table),
+        "model": qn(model._meta.db_table),
+        "tagged_item": qn(TaggedItem._meta.db_table),
+        "album_tag": qn(AlbumTag._meta.db_table),
+    }
+    if model is Album:
+        return ("SELECT %%s, %(tag)s.id, %(tag)s.name, COUNT(*), 0, %%s "
+            "FROM %(album_tag)s INNER JOIN %(tag)s "
+            "ON %(tag)s.id = %(album_tag)s.tag_id WHERE 1 = 1" % values,
+            [ctype_id, now])
+    # orphaned TaggedItem rows, of deleted objects, are not counted
+    return ("SELECT %%s, %(tag)s.id, %(tag)s.name, COUNT(*), 0, %%s "
+        "FROM %(tagged_item)s "
+        "INNER JOIN %(tag)s ON %(tag)s.id = %(tagged_item)s.tag_id "
+        "INNER JOIN %(model)s ON %(model)s.id = %(tagged_item)s.object_id "
+        "WHERE %(tagged_item)s.content_type_id = %%s" % values,
+        [ctype_id, now, ctype_id])
+
+def font_size(count, min_count, max_count, steps=CLOUD_STEPS,
+    distribution=LOGARITHMIC):
+    """
+    Returns the font size, from 1 to steps, of a tag used count times in a
+    cloud whose tags are used from min_count to max_count times. Same sizes
+    as tagging.utils.calculate_cloud.
+    """
+    thresholds = _calculate_thresholds(float(min_count), float(max_count),
+        steps)
+    weight = _calculate_tag_weight(count, float(max_count), distribution)
+    for step in range(steps):
+        if weight <= thresholds[step]:
+            return step + 1
+    return steps
+
+def refresh_cloud(model, tag_ids=None):
+    """
+    Recomputes the CloudTag rows of model for the given tag pks, or all of
+    them if tag_ids is None.
+    """
+    from jamendo.models import CloudTag
+    qn = connection.ops.quote_name
+    table = qn(CloudTag._meta.db_table)
+    ctype = ContentType.objects.get_for_model(model)
+    select, params = _count_sql(model, ctype.pk, datetime.now())
+    insert = "INSERT INTO %s (content_type_id, tag_id, name, count, " \
+        "font_size, modified_at) %s" % (table, select)
+    tag_table = qn(Tag._meta.db_table)
+    group_by = " GROUP BY %s.id, %s.name" % (tag_table, tag_table)
+
+    cursor = connection.cursor()
+    if tag_ids is None:
+        cursor.execute("DELETE FROM %s WHERE content_type_id = %%s" % table,
+            [ctype.pk])
+        cursor.execute(insert + group_by, params)
+    else:
+        for ids_chunk in chunks(tag_ids):
+            placeholders = ", ".join(["%s"] * len(ids_chunk))
+            cursor.execute("DELETE FROM %s WHERE content_type_id = %%s "
+                "AND tag_id IN (%s)" % (table, placeholders),
+                [ctype.pk] + ids_chunk)
+            cursor.execute("%s AND %s.id IN (%s)%s" % (insert, tag_table,
+                placeholders, group_by), params + ids_chunk)
+
+    cloud = CloudTag.objects.filter(content_type=ctype)
+    bounds = cloud.aggregate(min_count=Min("count"), max_count=Max("count"))
+    if bounds["max_count"] is None:
+        return
+    if tag_ids is None:
+        querysets = [cloud]
+    else:
+        querysets = [cloud.filter(tag__in=ids_chunk)
+            for ids_chunk in chunks(tag_ids)]
+    rows = []
+    for queryset in querysets:
+        for pk, count, size in queryset.values_list("pk", "count",
+            "font_size"):
+            new_size = font_size(count, bounds["min_count"],
+                bounds["max_count"])
+            if new_size != size:
+                rows.append((new_size, pk))
+    update_rows(CloudTag, ("font_size", ), rows)
+
+def refresh_clouds(tag_ids=None):
+    """
+    Recomputes the clouds of every model in cloud_models, only for the
+    given tag pks if tag_ids is not None.
+    """
+    from jamendo.models import CloudTag
+    if tag_ids is not None:
+        tag_ids = list(tag_ids)
+        if not tag_ids:
+            return
+    for model in cloud_models():
+        refresh_cloud(model, tag_ids)
+    invalidate_responses(CloudTag)
+
+def get_cloud(model):
+    """
+    Returns the CloudTag rows of the cloud of model, by name.
+    """
+    from jamendo.models import CloudTag
+    return CloudTag.objects.filter(
+        content_type=ContentType.objects.get_for_model(model)).order_by("name")
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Denormalized artist countries.
+
+The country of an artist is the country of the state of its city, but
+reading it through city__state__country joins three tables. It is stored
+instead in Artist.country, next to a (country, name) index, and the number
+of artists of every country in Country.artist_count.
+
+Both are kept up to date by the signal handlers below when artists,
+cities or states are saved through the ORM. The importer writes them
+set-wise.
+"""
+
+from django.db import connection
+
+from jamendo.bulk import chunks
+
+
+def update_artist_countries():
+    """
+    Sets the country of every artist with a city to the country of its
+    state, with a single UPDATE.
+    """
+    from jamendo.models import Artist, City, State
+    qn = connection.ops.quote_name
+    values = {
+        "artist": qn(Artist._meta.db_table),
+        "city": qn(City._meta.db_table),
+        "state": qn(State._meta.db_table),
+    }
+    connection.cursor().execute("UPDATE %(artist)s SET country_id = ("
+        "SELECT %(state)s.country_id FROM %(city)s INNER JOIN %(state)s "
+        "ON %(state)s.id = %(city)s.state_id "
+        "WHERE %(city)s.id = %(artist)s.city_id) "
+        "WHERE city_id IS NOT NULL" % values)
+
+def refresh_country_counts(codes=None):
+    """
+    Recounts the artists of the countries with the given codes, or of all
+    of them if codes is None. Every count is a range of the (country, name)
+    index.
+    """
+    from jamendo.models import Artist, Country
+    from jamendo.responses import invalidate_responses
+    qn = connection.ops.quote_name
+    sql = "UPDATE %s SET artist_count = (SELECT COUNT(*) FROM %s " \
+        "WHERE %s.country_id = %s.code)" % (qn(Country._meta.db_table),
+        qn(Artist._meta.db_table), qn(Artist._meta.db_table),
+        qn(Country._meta.db_table))
+    cursor = connection.cursor()
+    if codes is None:
+        cursor.execute(sql)
+    else:
+        codes = [code for code in set(codes) if code]
+        for codes_chunk in chunks(codes):
+            cursor.execute("%s WHERE code IN (%s)" % (sql,
+                ", ".join(["%s"] * len(codes_chunk))), codes_chunk)
+    invalidate_responses(Country)
+
+
+def artist_pre_save(sender, instance, **kwargs):
+    from jamendo.models import Artist, City
+    previous = []
+    if instance.pk:
+        previous = list(Artist.objects.filter(pk=instance.pk).values_list(
+            "country", "city"))
+        instance._previous_country_id = [country for country, city in
+            previous]
+    if instance.city_id:
+        # none for a city without a state, as update_artist_countries does
+        countries = City.objects.filter(pk=instance.city_id).values_list(
+            "state__country", flat=True)
+        instance.country_id = countries and countries[0] or None
+    elif previous and previous[0][1] is not None:
+        # the city was cleared, and the country it gave with it
+        instance.country_id = None
+
+def artist_post_save(sender, instance, **kwargs):
+    codes = list(getattr(instance, "_previous_country_id", []))
+    refresh_country_counts(codes + [instance.country_id])
+
+def artist_post_delete(sender, instance, **kwargs):
+    refresh_country_counts([instance.country_id])
+
+def _move_artists(artists, country_id):
+    """
+    Sets the country of artists, a queryset, to country_id and recounts
+    the artists of the countries involved.
+    """
+    codes = list(artists.values_list("country", flat=True).distinct())
+    if codes != [country_id]:
+        artists.update(country=country_id)
+        refresh_country_counts(codes + [country_id])
+
+def city_post_save(sender, instance, created=False, **kwargs):
+    from jamendo.models import Artist, State
+    if created:
+        return
+    country_id = None
+    if instance.state_id:
+        country_id = State.objects.filter(pk=instance.state_id).values_list(
+            "country", flat=True)[0]
+    _move_artists(Artist.objects.filter(city=instance), country_id)
+
+def state_post_save(sender, instance, created=False, **kwargs):
+    from jamendo.models import Artist
+    if created:
+        return
+    _move_artists(Artist.objects.filter(city__state=instance),
+        instance.country_id)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Row counts for list pages that do not block on COUNT(*).
+
+Exact counts are cached per query and per model "generation": every write
+to a counted model (see models.py) and every bulk import starts a new
+generation, so cached counts are never stale. jamendo.responses uses the
+same generations for the validators of pages. Filtered lists are counted
+up to JAMENDO_COUNT_CAP rows; past that the database planner estimate is
+used where there is one (postgresql), or the cap as a lower bound.
+"""
+
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.utils.hashcompat import md5_constructor
+from django.utils.translation import ugettext as _
+
+
+COUNT_CAP = getattr(settings, "JAMENDO_COUNT_CAP", 10000)
+COUNT_CACHE_TIMEOUT = getattr(settings, "JAMENDO_COUNT_CACHE_TIMEOUT", 3600)
+# generations are kept longer than the counts and responses depending on them
+GENERATION_TIMEOUT = 30 * 24 * 3600
+
+# kinds of count
+EXACT, ESTIMATE, AT_LEAST = "exact", "estimate", "at_least"
+
+
+class ListCount(object):
+    """
+    The number of rows of a list, exact or not. In templates it renders as
+    1234, about 1.2M or more than 10000.
+    """
+
+    def __init__(self, value, kind=EXACT):
+        self.value = value
+        self.kind = kind
+
+    @property
+    def exact(self):
+        return self.kind == EXACT
+
+    def __int__(self):
+        return self.value
+
+    def __nonzero__(self):
+        return self.value > 0
+
+    def __unicode__(self):
+        if self.kind == AT_LEAST:
+            return _(u"more than %d") % self.value
+        if self.kind == ESTIMATE:
+            return _(u"about %s") % approximate(self.value)
+        return unicode(self.value)
+
+    def __repr__(self):
+        return "<ListCount: %d (%s)>" % (self.value, self.kind)
+
+
+def approximate(value):
+    """
+    Rounds value for display, ie: 1234567 -> 1.2M, 12345 -> 12k.
+    """
+    for divisor, suffix in ((1000000, u"M"), (1000, u"k")):
+        if value >= divisor:
+            if value < 10 * divisor:
+                return u"%.1f%s" % (float(value) / divisor, suffix)
+            return u"%d%s" % (value / divisor, suffix)
+    return unicode(value)
+
+
+def _generation_key(model):
+    return "jamendo.counts.%s.%s" % (model._meta.app_label,
+        model._meta.module_name)
+
+def get_generation(model):
+    """
+    Returns the timestamp of the last write to model.
+    """
+    key = _generation_key(model)
+    generation = cache.get(key)
+    if generation is None:
+        generation = time.time()
+        cache.set(key, generation, GENERATION_TIMEOUT)
+    return generation
+
+def invalidate_count(*models):
+    """
+    Starts a new generation for the given models. Use it after writing rows
+    without sending signals (ie: with jamendo.bulk).
+    """
+    now = time.time()
+    for model in models:
+        cache.set(_generation_key(model), now, GENERATION_TIMEOUT)
+
+def invalidate_count_on_write(sender, **kwargs):
+    invalidate_count(sender)
+
+
+def capped_count(queryset, cap):
+    """
+    Counts the rows of queryset, reading cap + 1 of them at most.
+    """
+    sql, params = queryset.values_list("pk").order_by()[:cap + 1].query.as_sql()
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(*) FROM (%s) capped" % sql, params)
+    return cursor.fetchone()[0]
+
+def estimate_count(queryset):
+    """
+    Returns the planner estimate of the rows of queryset, or None if the
+    database does not give one.
+    """
+    if not settings.DATABASE_ENGINE.startswith("postgresql"):
+        return None
+    sql, params = queryset.values_list("pk").order_by().query.as_sql()
+    cursor = connection.cursor()
+    cursor.execute("EXPLAIN %s" % sql, params)
+    match = re.search(r"rows=(\d+)", cursor.fetchone()[0])
+    return match and int(match.group(1)) or None
+
+def get_count(queryset, exact=True, cap=COUNT_CAP):
+    """
+    Returns a ListCount for queryset. Exact counts are cached until the
+    next write to its model. If exact is False, rows are only counted up to
+    cap and the count is an estimate (or a lower bound) past it.
+    """
+    if not exact:
+        value = capped_count(queryset, cap)
+        if value <= cap:
+            return ListCount(value)
+        estimate = estimate_count(queryset)
+        if estimate is not None and estimate > cap:
+            return ListCount(estimate, ESTIMATE)
+        return ListCount(cap, AT_LEAST)
+
+    model = queryset.model
+    sql, params = queryset.query.as_sql()
+    key = "jamendo.counts.%s" % md5_constructor("%f:%s:%r" % (
+        get_generation(model), sql, params)).hexdigest()
+    value = cache.get(key)
+    if value is None:
+        value = queryset.count()
+        cache.set(key, value, COUNT_CACHE_TIMEOUT)
+    return ListCount(value)
+
+
+class CountedQuerySet(QuerySet):
+    """
+    A QuerySet whose count() is a precomputed ListCount, so paginators do
+    not run COUNT(*) again. Make one with counted(); querysets derived from
+    it count their rows as usual.
+    """
+    list_count = None
+
+    def count(self):
+        if self.list_count is None:
+            return super(CountedQuerySet, self).count()
+        return int(self.list_count)
+
+def counted(queryset, list_count):
+    return queryset._clone(klass=CountedQuerySet, list_count=list_count)
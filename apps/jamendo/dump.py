@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Streaming reader for the Jamendo database dump, ie:
+http://img.jamendo.com/data/dbdump_artistalbumtrack.xml.gz
+
+The dump is a single xml document holding every artist and, nested inside
+it, its albums and tracks. It is read with iterparse and every <artist>
+element is thrown away as soon as it has been turned into plain python
+dicts, so memory use is bounded by the biggest artist, not by the dump.
+"""
+
+import gzip
+import sys
+from hashlib import sha1
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+
+# id3v1 genres, indexed by the number found in <id3genre>
+ID3_GENRES = (
+    u"Blues", u"Classic Rock", u"Country", u"Dance", u"Disco", u"Funk",
+    u"Grunge", u"Hip-Hop", u"Jazz", u"Metal", u"New Age", u"Oldies",
+    u"Other", u"Pop", u"R&B", u"Rap", u"Reggae", u"Rock", u"Techno",
+    u"Industrial", u"Alternative", u"Ska", u"Death Metal", u"Pranks",
+    u"Soundtrack", u"Euro-Techno", u"Ambient", u"Trip-Hop", u"Vocal",
+    u"Jazz+Funk", u"Fusion", u"Trance", u"Classical", u"Instrumental",
+    u"Acid", u"House", u"Game", u"Sound Clip", u"Gospel", u"Noise",
+    u"AlternRock", u"Bass", u"Soul", u"Punk", u"Space", u"Meditative",
+    u"Instrumental Pop", u"Instrumental Rock", u"Ethnic", u"Gothic",
+    u"Darkwave", u"Techno-Industrial", u"Electronic", u"Pop-Folk",
+    u"Eurodance", u"Dream", u"Southern Rock", u"Comedy", u"Cult",
+    u"Gangsta", u"Top 40", u"Christian Rap", u"Pop/Funk", u"Jungle",
+    u"Native American", u"Cabaret", u"New Wave", u"Psychadelic", u"Rave",
+    u"Showtunes", u"Trailer", u"Lo-Fi", u"Tribal", u"Acid Punk",
+    u"Acid Jazz", u"Polka", u"Retro", u"Musical", u"Rock & Roll",
+    u"Hard Rock",
+)
+
+
+def open_dump(path):
+    """
+    Opens a dump file, transparently un-gzipping it. "-" means stdin.
+    """
+    if path == "-":
+        return sys.stdin
+    fileobj = open(path, "rb")
+    magic = fileobj.read(2)
+    fileobj.seek(0)
+    if magic == "\x1f\x8b":
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    return fileobj
+
+def iter_artist_elements(fileobj):
+    """
+    Yields every <artist> element of the dump, clearing it (and its already
+    processed siblings) once the caller is done with it.
+    """
+    parent = None
+    for event, elem in ElementTree.iterparse(fileobj, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "Artists":
+                parent = elem
+        elif elem.tag == "artist":
+            yield elem
+            elem.clear()
+            if parent is not None:
+                parent.clear()
+
+def iter_artists(fileobj, skip=0):
+    """
+    Yields every artist of the dump as a dict (see parse_artist), but the
+    first skip ones.
+    """
+    for index, elem in enumerate(iter_artist_elements(fileobj)):
+        if index >= skip:
+            yield parse_artist(elem)
+
+def iter_artist_chunks(fileobj, size, skip=0, block_size=1024 * 1024):
+    """
+    Splits the dump, without parsing it, into raw xml chunks of about size
+    <artist> elements, so they can be parsed in other processes (see
+    parse_artist_chunk). The first skip artists are left out.
+    """
+    buf = ""
+    chunk = []
+    count = 0
+    started = False
+    while True:
+        block = fileobj.read(block_size)
+        buf += block
+        if not started:
+            start = buf.find("<artist>")
+            if start == -1:
+                if not block:
+                    return
+                continue
+            buf = buf[start:]
+            started = True
+        end = buf.rfind("</artist>")
+        while skip and end != -1:
+            # drop whole artists from the beginning of buf
+            end = buf.find("</artist>") + len("</artist>")
+            buf = buf[end:]
+            skip -= 1
+            end = buf.rfind("</artist>")
+        if end != -1:
+            end += len("</artist>")
+            chunk.append(buf[:end])
+            count += buf.count("</artist>", 0, end)
+            buf = buf[end:]
+        if count >= size or (not block and chunk):
+            yield "".join(chunk)
+            chunk = []
+            count = 0
+        if not block:
+            return
+
+def parse_artist_chunk(data):
+    """
+    Returns the list of artists (see parse_artist) found in a raw xml chunk
+    made by iter_artist_chunks.
+    """
+    root = ElementTree.fromstring("<Artists>%s</Artists>" % data)
+    return [parse_artist(elem) for elem in root.findall("artist")]
+
+def _text(elem, path, default=u""):
+    value = elem.findtext(path)
+    if value is None:
+        return default
+    value = value.strip()
+    if isinstance(value, str):
+        value = value.decode("utf-8")
+    return value
+
+def _int(elem, path, default=None):
+    value = elem.findtext(path)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def _float(elem, path, default=0.0):
+    value = elem.findtext(path)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def _decimal(elem, path):
+    value = elem.findtext(path)
+    if not value:
+        return None
+    try:
+        return Decimal(value.strip())
+    except InvalidOperation:
+        return None
+
+def _datetime(elem, path):
+    # ie: 2004-12-28T21:10:15+01:00, we keep local time and drop the offset
+    value = elem.findtext(path)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value.strip()[:19], "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
+
+def fingerprint(record):
+    """
+    Returns a digest of a record own values (its nested albums or tracks
+    are left out, the uids of its artist or album are in), used to tell
+    whether it changed since it was imported.
+    """
+    values = [(key, value) for key, value in sorted(record.items())
+        if key not in ("albums", "tracks", "fingerprint")]
+    return sha1(repr(values)).hexdigest()
+
+def parse_track(elem, artist_uid, album_uid):
+    uid = _int(elem, "id")
+    track = {
+        "uid": uid,
+        "artist": artist_uid,
+        "album": album_uid,
+        "mbgid": _text(elem, "mbgid"),
+        "name": _text(elem, "name"),
+        "url": _text(elem, "url") or u"http://www.jamendo.com/track/%s" % uid,
+        "duration": _int(elem, "duration", 0),
+        "numalbum": _int(elem, "numalbum", 1),
+        "filename": _text(elem, "filename"),
+        "genre": _text(elem, "id3genre") or None,
+        "license": _text(elem, "license") or None,
+        "tags": [(_text(tag, "idstr"), _float(tag, "weight"))
+            for tag in elem.findall("Tags/tag") if _text(tag, "idstr")],
+    }
+    track["fingerprint"] = fingerprint(track)
+    return track
+
+def parse_album(elem, artist_uid):
+    uid = _int(elem, "id")
+    tracks = [parse_track(track, artist_uid, uid)
+        for track in elem.findall("Tracks/track")]
+    album = {
+        "uid": uid,
+        "artist": artist_uid,
+        "mbgid": _text(elem, "mbgid"),
+        "name": _text(elem, "name"),
+        "url": _text(elem, "url") or u"http://www.jamendo.com/album/%s" % uid,
+        "image": _text(elem, "image") or None,
+        "release_date": _datetime(elem, "releasedate"),
+        "filename": _text(elem, "filename"),
+        "genre": _text(elem, "id3genre") or None,
+        "license": _text(elem, "license_artwork") or None,
+        "track_count": len(tracks),
+        "duration": sum([track["duration"] for track in tracks]),
+        "tracks": tracks,
+    }
+    album["fingerprint"] = fingerprint(album)
+    return album
+
+def parse_artist(elem):
+    """
+    Turns an <artist> element into a dict of plain python values. Its albums
+    are stored in "albums" and their tracks in each album "tracks".
+    Foreign keys are kept as natural keys (license url, id3 genre code,
+    country code, state and city names), resolving them is up to the writer.
+    Albums and tracks get the uids of their "artist" and "album", and every
+    record a "fingerprint" of its own values, so moving an album or a track
+    changes it.
+    """
+    uid = _int(elem, "id")
+    albums = [parse_album(album, uid)
+        for album in elem.findall("Albums/album")]
+    artist = {
+        "uid": uid,
+        "mbgid": _text(elem, "mbgid"),
+        "name": _text(elem, "name"),
+        "url": _text(elem, "url") or u"http://www.jamendo.com/artist/%s" % uid,
+        "image": _text(elem, "image") or None,
+        "country": _text(elem, "location/country") or None,
+        "state": _text(elem, "location/state") or None,
+        "city": _text(elem, "location/city") or None,
+        "latitude": _decimal(elem, "location/latitude"),
+        "longitude": _decimal(elem, "location/longitude"),
+        "album_count": len(albums),
+        "albums": albums,
+    }
+    artist["fingerprint"] = fingerprint(artist)
+    return artist
+
+def genre_name(code):
+    """
+    Returns the id3 genre name for the given dump code.
+    """
+    try:
+        return ID3_GENRES[int(code)]
+    except (ValueError, IndexError):
+        return code
+
+def license_names(url):
+    """
+    Returns a (license_class, name) tuple guessed from a license url, ie:
+    http://creativecommons.org/licenses/by-nc-sa/3.0/ -> (by-nc-sa, CC by-nc-sa 3.0)
+    """
+    bits = [bit for bit in url.split("/") if bit]
+    if "licenses" in bits:
+        index = bits.index("licenses")
+        license_class = bits[index + 1] if len(bits) > index + 1 else u""
+        version = bits[index + 2] if len(bits) > index + 2 else u""
+        return license_class, (u"CC %s %s" % (license_class, version)).strip()
+    return u"", url
@@ -2,22 +2,44 @@
 
 from datetime import datetime
 
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
-from django.utils.translation import ugettext_lazy as _
+from django.db import connection
+from django.utils.hashcompat import md5_constructor
+from django.utils.translation import ugettext as _, get_language
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.template.loader import render_to_string
+from django.views.decorators.http import condition
 
-from atom import Feed
-from tagging.models import Tag
-from jamendo.models import Artist, Album
+from atom import Feed, AtomFeed, StreamingAtomFeed
+from tagging.models import Tag, TaggedItem
+from jamendo.models import Artist, Album, City, State, Country, License, Genre
+from jamendo.pagination import iter_by_cursor
+from jamendo.tags import with_tags
+from jamendo.responses import get_validators, get_generation
 
 
 ITEMS_PER_FEED = getattr(settings, 'ITEMS_PER_FEED', 20)
+FEED_CACHE_TIMEOUT = getattr(settings, "JAMENDO_FEED_CACHE_TIMEOUT", 600)
+# bigger documents are streamed but not cached
+FEED_CACHE_MAX_SIZE = getattr(settings, "JAMENDO_FEED_CACHE_MAX_SIZE",
+    1024 * 1024)
+FEED_ITEM_CACHE_TIMEOUT = getattr(settings,
+    "JAMENDO_FEED_ITEM_CACHE_TIMEOUT", 24 * 3600)
 
 
 class BaseFeed(Feed):
+    STREAM = True
+    # models whose writes change the feed, see jamendo.responses
+    depends_on = ()
+    # models, besides the item one, whose writes change the item content
+    item_depends_on = ()
+    # if True, the tags of the items are read along with them
+    prefetch_tags = False
+
     def __init__(self, *args, **kwargs):
         super(BaseFeed, self).__init__(args, kwargs)
         self.site = Site.objects.get(pk=settings.SITE_ID)
@@ -38,16 +60,40 @@ class BaseFeed(Feed):
         return [{"name" : item.name}]
 
     def feed_updated(self):
-        try:
-            updated_at = self._get_qs().latest("modified_at").modified_at
-        except AttributeError:
-            # We return an arbitrary date if there are no results, because there
-            # must be a feed_updated field as per the Atom specifications, however
-            # there is no real data to go by, and an arbitrary date can be static.
-            return datetime(year=2009, month=1, day=1)
+        # modified_at is read alone, from its index
+        updated = self._get_qs().order_by("-modified_at").values_list(
+            "modified_at", flat=True)[:1]
+        if updated:
+            return updated[0]
+        # We return an arbitrary date if there are no results, because there
+        # must be a feed_updated field as per the Atom specifications, however
+        # there is no real data to go by, and an arbitrary date can be static.
+        return datetime(year=2009, month=1, day=1)
+
+    def _get_items_qs(self):
+        if self.prefetch_tags:
+            return with_tags(self._get_qs().all())
+        return self._get_qs().all()
 
     def items(self):
-        return self._get_qs().all().order_by("-added_at")[:ITEMS_PER_FEED]
+        return self._get_items_qs().order_by("-added_at")[:ITEMS_PER_FEED]
+
+    def render_item(self, template_name, item):
+        """
+        Renders template_name for item. Renderings are cached by item,
+        modified_at and language, and for the generations of the models in
+        item_depends_on, so an entry is rendered once per change, not once
+        per feed request.
+        """
+        generations = [get_generation(model) for model in self.item_depends_on]
+        key = "jamendo.feeds.item.%s" % md5_constructor("%s:%s:%s:%s:%s:%r" % (
+            template_name, item._meta.db_table, item.pk, item.modified_at,
+            get_language(), generations)).hexdigest()
+        content = cache.get(key)
+        if content is None:
+            content = render_to_string(template_name, {"instance": item})
+            cache.set(key, content, FEED_ITEM_CACHE_TIMEOUT)
+        return content
 
     #def feed_icon(self, obj):
         # return URI
@@ -56,6 +102,10 @@ class BaseFeed(Feed):
         # return URI
 
 class ArtistsFeed(BaseFeed):
+    depends_on = (Artist, Album, City, State, Country, Tag, TaggedItem)
+    item_depends_on = (City, State, Country, Tag, TaggedItem)
+    prefetch_tags = True
+
     def __init__(self, *args, **kwargs):
         super(ArtistsFeed, self).__init__(args, kwargs)
 
@@ -70,7 +120,7 @@ class ArtistsFeed(BaseFeed):
     
     def item_content(self, item):
         return {"type": "html", "xml:base": "http://%s" % self.site.domain},\
-            render_to_string('jamendo/artists/feed.html', {"instance": item})
+            self.render_item('jamendo/artists/feed.html', item)
     
     def item_links(self, item):
         return [{"href" : "http://%s%s" % (self.site.domain, reverse("jamendo_artist", args=(item.pk,)))}]
@@ -96,6 +146,9 @@ class ArtistsFeed(BaseFeed):
         return [{"term": tag.name} for tag in item.tags]
 
 class AlbumsFeed(BaseFeed):
+    depends_on = (Album, Artist, License, Genre, Tag, TaggedItem)
+    item_depends_on = (License, Genre, Tag, TaggedItem)
+
     def __init__(self, *args, **kwargs):
         super(AlbumsFeed, self).__init__(args, kwargs)
     
@@ -110,7 +163,7 @@ class AlbumsFeed(BaseFeed):
     
     def item_content(self, item):
         return {"type": "html", "xml:base": "http://%s" % self.site.domain},\
-            render_to_string('jamendo/albums/feed.html', {"instance": item})
+            self.render_item('jamendo/albums/feed.html', item)
     
     def item_links(self, item):
         return [{"href" : "http://%s%s" % (self.site.domain, reverse("jamendo_album", args=(item.pk,)))},
@@ -137,9 +190,18 @@ class AlbumsForFeed(BaseFeed):
     """
     Feed of albums for a given artist
     """
+    depends_on = (Album, Artist, License, Genre, Tag, TaggedItem)
+    item_depends_on = (License, Genre, Tag, TaggedItem)
+    prefetch_tags = True
+
     def __init__(self, *args, **kwargs):
         super(AlbumsForFeed, self).__init__(args, kwargs)
 
+    def get_feed_object(self, extra_params=None):
+        if not extra_params:
+            raise LookupError("Feed does not exist")
+        return super(AlbumsForFeed, self).get_feed_object(extra_params)
+
     def get_object(self, bits):
         if bits:
             artist = Artist.objects.get(pk=bits[0])
@@ -148,10 +210,16 @@ class AlbumsForFeed(BaseFeed):
         return None
     
     def _get_qs(self):
-        return Artist.objects
+        return self.artist.album_set
+
+    def feed_updated(self):
+        # the feed shows the artist name too
+        return max(self.artist.modified_at,
+            super(AlbumsForFeed, self).feed_updated())
 
     def items(self):
-        return self.artist.album_set.all().order_by("name")
+        # every chunk of albums comes with its tags
+        return iter_by_cursor(self._get_items_qs(), ("name", "pk"))
 
     def item_id(self, item):
         return "http://%s%s" % (self.site.domain, reverse("jamendo_album", args=(item.pk,)))
@@ -161,7 +229,7 @@ class AlbumsForFeed(BaseFeed):
     
     def item_content(self, item):
         return {"type": "html", "xml:base": "http://%s" % self.site.domain},\
-            render_to_string('jamendo/albums/feed.html', {"instance": item})
+            self.render_item('jamendo/albums/feed.html', item)
     
     def item_links(self, item):
         return [{"href" : "http://%s%s" % (self.site.domain, reverse("jamendo_album", args=(item.pk,)))}]
@@ -186,6 +254,84 @@ class AlbumsForFeed(BaseFeed):
     def item_categories(self, item):
         return [{"term": tag.name} for tag in item.tags]
 
+
+def _cache_pieces(pieces, key):
+    """
+    Yields the pieces of a feed document, caching the whole document at key
+    once they are all sent, unless it is bigger than FEED_CACHE_MAX_SIZE.
+    """
+    document, size = [], 0
+    for piece in pieces:
+        if document is not None:
+            size += len(piece)
+            if size > FEED_CACHE_MAX_SIZE:
+                document = None
+            else:
+                document.append(piece)
+        yield piece
+    if document is not None:
+        cache.set(key, "".join(document), FEED_CACHE_TIMEOUT)
+
+def _closing(pieces):
+    """
+    Yields pieces, then closes the database connection. The handler closes
+    it once the response is returned, before a streamed feed is written, so
+    the queries of the entries open a new one.
+    """
+    try:
+        for piece in pieces:
+            yield piece
+    finally:
+        connection.close()
+
+def feed(request, url, feed_dict=None):
+    """
+    Same as django.contrib.syndication.views.feed, for atom feeds. Streaming
+    feeds are sent as they are written, one entry at a time.
+
+    Feeds have an ETag and Last-Modified made of their slug, object, updated
+    date and the generations of the models they depend on (see
+    jamendo.responses): unchanged feeds are answered with a 304, and the
+    documents of changed ones are cached by ETag.
+    """
+    if not feed_dict:
+        raise Http404("No feeds are registered.")
+    try:
+        slug, param = url.split("/", 1)
+    except ValueError:
+        slug, param = url, ""
+    try:
+        feed_class = feed_dict[slug]
+    except KeyError:
+        raise Http404("Slug %r isn't registered." % slug)
+
+    feed_instance = feed_class(slug, request)
+    try:
+        obj = feed_instance.get_feed_object(param)
+        updated = feed_instance.feed_updated()
+    except (LookupError, ValueError, ObjectDoesNotExist):
+        raise Http404("Invalid feed parameters.")
+    validators = get_validators(request, "feed:%s" % slug,
+        feed_instance.depends_on, updated)
+
+    def cached_feed(request):
+        key = "jamendo.feeds.%s" % validators.etag
+        document = cache.get(key)
+        if document is not None:
+            return HttpResponse(document, mimetype=AtomFeed.mime_type)
+        feedgen = feed_instance.make_feed(obj)
+        if isinstance(feedgen, StreamingAtomFeed):
+            return HttpResponse(_closing(_cache_pieces(
+                feedgen.iter_write("utf-8"), key)), mimetype=feedgen.mime_type)
+        response = HttpResponse(mimetype=feedgen.mime_type)
+        feedgen.write(response, "utf-8")
+        if len(response.content) <= FEED_CACHE_MAX_SIZE:
+            cache.set(key, response.content, FEED_CACHE_TIMEOUT)
+        return response
+    # polling readers get a 304 until the feed changes
+    return condition(lambda request: validators.etag,
+        lambda request: validators.last_modified)(cached_feed)(request)
+
 # TODO: feeds for:
 # artists for a given country
 # albums for a given license
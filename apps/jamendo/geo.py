@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Artists near a point or inside a box, without a GIS extension.
+
+Every artist with a location has its geohash in Artist.geocell, an indexed
+column. A geohash names a cell of a grid and its prefixes name the cells
+containing it, so the artists of a cell are a range of that index (geocell
+>= "u0q" AND geocell < "u0r", the following prefix, which sorts after its
+cells whatever the collation).
+
+A box is covered with at most MAX_CELLS cells, of the finest precision that
+allows it, and only the artists of those cells are read: a radius query is
+the box around the circle, trimmed by distance. A k-nearest query doubles a
+radius until the box around it holds k artists, counting them instead of
+reading them, and then reads only the artists close enough to be among the
+k nearest.
+"""
+
+import math
+import operator
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Q
+
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+# characters of the stored geohashes, ~5 meters
+GEOHASH_PRECISION = 9
+MAX_CELLS = getattr(settings, "JAMENDO_GEO_MAX_CELLS", 16)
+EARTH_RADIUS = 6371.0
+# half the circumference, no two points are further apart
+MAX_DISTANCE = math.pi * EARTH_RADIUS
+# first radius tried by nearest, in km
+NEAREST_RADIUS = 10.0
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """
+    Returns the geohash of a point, ie: (57.64911, 10.40744) -> "u4pruydqq".
+    """
+    latitude, longitude = float(latitude), float(longitude)
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = char = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            value, interval = longitude, lon_range
+        else:
+            value, interval = latitude, lat_range
+        middle = (interval[0] + interval[1]) / 2
+        char <<= 1
+        if value >= middle:
+            char |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[char])
+            bits = char = 0
+    return "".join(chars)
+
+def geocell(latitude, longitude):
+    """
+    Returns the Artist.geocell of a location, empty if it is unknown.
+    """
+    if latitude is None or longitude is None:
+        return ""
+    return encode(latitude, longitude)
+
+def cell_size(precision):
+    """
+    Returns the (height, width), in degrees, of the cells of precision.
+    """
+    bits = 5 * precision
+    return 180.0 / (1 << (bits // 2)), 360.0 / (1 << ((bits + 1) // 2))
+
+def _cell_range(start, end, origin, size):
+    count = int(round((2 * -origin) / size))
+    first = min(count - 1, max(0, int(math.floor((start - origin) / size))))
+    last = min(count - 1, max(0, int(math.floor((end - origin) / size))))
+    return first, last
+
+def covering_cells(south, west, north, east, max_cells=MAX_CELLS):
+    """
+    Returns the geohashes of the cells covering the box, as few as needed of
+    the finest precision for which they are at most max_cells. A box whose
+    west is greater than its east crosses the antimeridian.
+    """
+    if west > east:
+        return covering_cells(south, west, north, 180.0, max_cells) + \
+            covering_cells(south, -180.0, north, east, max_cells)
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        rows = _cell_range(south, north, -90.0, height)
+        columns = _cell_range(west, east, -180.0, width)
+        if precision == 1 or (rows[1] - rows[0] + 1) * \
+            (columns[1] - columns[0] + 1) <= max_cells:
+            break
+    cells = set()
+    for row in range(rows[0], rows[1] + 1):
+        for column in range(columns[0], columns[1] + 1):
+            cells.add(encode(-90.0 + (row + 0.5) * height,
+                -180.0 + (column + 0.5) * width, precision))
+    return sorted(cells)
+
+def cell_ranges(cells):
+    """
+    Returns the (first, last) geohash prefixes of the runs of consecutive
+    cells, ie: ["u0", "u1", "u3"] -> [("u0", "u1"), ("u3", "u3")].
+    """
+    ranges = []
+    for cell in sorted(cells):
+        if ranges:
+            first, last = ranges[-1]
+            if len(last) == len(cell) and last[:-1] == cell[:-1] and \
+                BASE32.index(cell[-1]) == BASE32.index(last[-1]) + 1:
+                ranges[-1] = (first, cell)
+                continue
+        ranges.append((cell, cell))
+    return ranges
+
+def cell_successor(cell):
+    """
+    Returns the first geohash prefix after every cell starting with cell,
+    ie: "u4pr" -> "u4ps", "u4pz" -> "u4q", or None if there is none ("zz").
+    """
+    while cell and cell[-1] == BASE32[-1]:
+        cell = cell[:-1]
+    if not cell:
+        return None
+    return cell[:-1] + BASE32[BASE32.index(cell[-1]) + 1]
+
+def cells_q(cells):
+    """
+    Returns a Q for the artists inside the given cells, one geocell index
+    range per run of consecutive cells.
+    """
+    ranges = []
+    for first, last in cell_ranges(cells):
+        successor = cell_successor(last)
+        if successor is None:
+            ranges.append(Q(geocell__gte=first))
+        else:
+            ranges.append(Q(geocell__gte=first, geocell__lt=successor))
+    return reduce(operator.or_, ranges, Q(pk__in=[]))
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Returns the great-circle distance, in km, between two points.
+    """
+    lat1, lon1, lat2, lon2 = [math.radians(float(value))
+        for value in (lat1, lon1, lat2, lon2)]
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * \
+        math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+def bounding_box(latitude, longitude, radius):
+    """
+    Returns the (south, west, north, east) box around the circle of radius
+    km centered in the given point.
+    """
+    delta = math.degrees(radius / EARTH_RADIUS)
+    south, north = latitude - delta, latitude + delta
+    if south <= -90.0 or north >= 90.0 or radius >= MAX_DISTANCE:
+        # the circle covers a pole, so all longitudes
+        return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+    lon_delta = math.degrees(math.asin(min(1.0, math.sin(radius /
+        EARTH_RADIUS) / math.cos(math.radians(latitude)))))
+    if lon_delta >= 180.0:
+        return south, -180.0, north, 180.0
+    west = (longitude - lon_delta + 540.0) % 360.0 - 180.0
+    east = (longitude + lon_delta + 540.0) % 360.0 - 180.0
+    return south, west, north, east
+
+
+def _decimal(value):
+    return Decimal(str(value))
+
+def in_box(queryset, south, west, north, east):
+    """
+    Returns the artists of queryset inside the box.
+    """
+    queryset = queryset.filter(cells_q(covering_cells(south, west, north,
+        east))).filter(latitude__gte=_decimal(south),
+        latitude__lte=_decimal(north))
+    if west > east:
+        return queryset.filter(Q(longitude__gte=_decimal(west)) |
+            Q(longitude__lte=_decimal(east)))
+    return queryset.filter(longitude__gte=_decimal(west),
+        longitude__lte=_decimal(east))
+
+def _by_distance(artists, latitude, longitude):
+    """
+    Sets the distance attribute of every artist and returns them sorted by
+    it, the nearest first.
+    """
+    artists = list(artists)
+    for artist in artists:
+        artist.distance = distance(latitude, longitude, artist.latitude,
+            artist.longitude)
+    artists.sort(key=lambda artist: (artist.distance, artist.pk))
+    return artists
+
+def nearby(queryset, latitude, longitude, radius, limit=None):
+    """
+    Returns the artists of queryset at most radius km away from the point,
+    the nearest first, up to limit of them. Every artist gets its distance
+    in a distance attribute.
+    """
+    artists = [artist for artist in _by_distance(in_box(queryset,
+        *bounding_box(latitude, longitude, radius)), latitude, longitude)
+        if artist.distance <= radius]
+    return artists[:limit]
+
+def nearest(queryset, latitude, longitude, limit):
+    """
+    Returns the limit artists of queryset nearest to the point, see nearby.
+    """
+    radius = NEAREST_RADIUS
+    while radius < MAX_DISTANCE and in_box(queryset, *bounding_box(latitude,
+        longitude, radius)).count() < limit:
+        radius *= 2
+    candidates = _by_distance(in_box(queryset, *bounding_box(latitude,
+        longitude, radius)), latitude, longitude)
+    if len(candidates) < limit:
+        # the radius covers the whole world
+        return candidates
+    # the limit nearest are no further than the limit-th candidate, and if
+    # that is inside the circle they are all in the box
+    reach = candidates[limit - 1].distance
+    if reach <= radius:
+        return candidates[:limit]
+    return nearby(queryset, latitude, longitude, reach, limit)
+
+
+def artist_pre_save(sender, instance, **kwargs):
+    instance.geocell = geocell(instance.latitude, instance.longitude)
@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Loads a Jamendo database dump (see jamendo.dump) into jamendo models.
+
+Artists read from the dump are buffered and written every batch_size
+artists or tracks: missing licenses, genres, countries, states and cities
+first, then artists, albums and tracks, each of them with a single
+executemany INSERT. Natural keys (jamendo uids, license urls, etc) are
+resolved to primary keys by jamendo.resolvers, which are loaded once and
+updated after every batch, so no per-row query is issued.
+
+The time spent in every stage (parse, resolve, build, insert, commit,
+tagging, delete) is added up in DumpImporter.timings, see
+jamendo.benchmark.
+"""
+
+from __future__ import with_statement
+
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Max, Min
+
+from tagging.models import Tag, TaggedItem
+
+from jamendo.dump import iter_artists, iter_artist_chunks, parse_artist_chunk,\
+    genre_name, license_names
+from jamendo.models import Artist, Album, Track, License, Genre, Country,\
+    State, City, ImportCheckpoint, AlbumTag
+from jamendo.bulk import insert_rows, update_rows, delete_rows, chunks
+from jamendo.clouds import refresh_clouds
+from jamendo.geo import geocell
+from jamendo.countries import refresh_country_counts
+from jamendo.responses import invalidate_responses
+from jamendo.resolvers import KeyResolver, UidResolver
+from jamendo.tags import update_tags_bulk, refresh_album_tags
+
+
+DEFAULT_BATCH_SIZE = 1000
+# models the importer writes rows of
+IMPORTED_MODELS = (License, Genre, Country, State, City, Artist, Album, Track,
+    Tag, TaggedItem)
+
+
+class DumpImporter(object):
+    """
+    Imports the artists, albums and tracks of a dump, creating the licenses,
+    genres, countries, states and cities they refer to, and tags tracks.
+
+    Rows that already exist (same jamendo uid) are left untouched unless
+    delta is True: then artists, albums and tracks whose fingerprint changed
+    are updated and the ones missing from the dump are deleted, so a full
+    dump can be re-imported doing work proportional to what changed.
+
+    If a checkpoint name is given, progress is stored in the ImportCheckpoint
+    of that name with every committed batch, and resume=True skips the
+    artists it says were already written.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, delta=False,
+        checkpoint=None, resume=False, verbosity=1):
+        self.batch_size = batch_size
+        self.delta = delta
+        self.verbosity = verbosity
+        self.pending = []
+        self.pending_tracks = 0
+        # number of artists read from the dump, skipped ones included
+        self.ordinal = 0
+        self.checkpoint = None
+        self.skip = 0
+        if checkpoint:
+            self.checkpoint, created = ImportCheckpoint.objects.get_or_create(
+                name=checkpoint)
+            if resume:
+                self.skip = self.checkpoint.artists
+            else:
+                self.checkpoint.artists = self.checkpoint.albums = 0
+                self.checkpoint.tracks = self.checkpoint.batch = 0
+                self.checkpoint.finished = False
+                self.checkpoint.save()
+        names = [model.__name__ for model in (License, Genre, Country,
+            State, City, Artist, Album, Track, TaggedItem)]
+        self.counts = dict([(name, 0) for name in names])
+        self.updated = dict([(name, 0) for name in names])
+        self.deleted = dict([(name, 0) for name in names])
+        self.seen = {Artist: set(), Album: set(), Track: set()}
+        # seconds spent in every stage, not counting the nested ones
+        self.timings = {}
+        self.stages = []
+        with self.stage("resolve"):
+            self.load_keys()
+
+    def load_keys(self):
+        self.licenses = KeyResolver(License, ("url", )).load()
+        self.genres = KeyResolver(Genre, ("code", )).load()
+        self.countries = KeyResolver(Country, ("code", )).load()
+        self.states = KeyResolver(State, ("code", "country")).load()
+        self.cities = KeyResolver(City, ("name", "state")).load()
+        self.artists = UidResolver(Artist, fingerprints=self.delta).load()
+        self.albums = UidResolver(Album, fingerprints=self.delta).load()
+        self.tracks = UidResolver(Track, fingerprints=self.delta).load()
+
+        self.next_license_uid = (License.objects.aggregate(
+            uid=Max("uid"))["uid"] or 0) + 1
+        # dump only gives us the iso3 code of a country, unknown countries
+        # get a negative numcode so they never clash with a real iso one
+        self.next_country_numcode = min(0, Country.objects.aggregate(
+            numcode=Min("numcode"))["numcode"] or 0) - 1
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        self.stages.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            nested = self.stages.pop()
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed - nested
+            if self.stages:
+                self.stages[-1] += elapsed
+
+    def timed(self, name, iterable):
+        """
+        Yields the items of iterable, adding the time spent waiting for them
+        to the name stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    return
+            yield item
+
+    def run(self, fileobj):
+        """
+        Imports every artist read from fileobj and returns the number of
+        inserted rows per model name (see updated and deleted for the rest).
+        """
+        for artist in self.timed("parse", iter_artists(fileobj,
+            self.parse_skip())):
+            self.add(artist)
+        return self.finish()
+
+    def parse_skip(self):
+        # in delta mode every artist of the dump is needed to know which
+        # uids are missing, so the resumed ones are parsed anyway
+        if self.delta:
+            return 0
+        self.ordinal = self.skip
+        return self.skip
+
+    def finish(self):
+        self.flush()
+        if self.delta:
+            with self.stage("delete"):
+                self.delete_missing()
+        if self.checkpoint:
+            ImportCheckpoint.objects.filter(pk=self.checkpoint.pk).update(
+                finished=True, modified_at=datetime.now())
+        with self.stage("tagging"):
+            refresh_clouds()
+        refresh_country_counts()
+        transaction.commit_unless_managed()
+        # rows were written without signals
+        invalidate_responses(*IMPORTED_MODELS)
+        return self.counts
+
+    def run_parallel(self, fileobj, processes=None):
+        """
+        Same as run, but the dump is split in raw chunks of batch_size
+        artists that a pool of processes parse while this one, the only
+        writer, keeps inserting the already parsed ones in dump order.
+        """
+        processes = processes or cpu_count()
+        pool = Pool(processes)
+        # Pool.imap reads its input as fast as it can, so chunks waiting to
+        # be parsed are bounded here to keep memory use flat
+        slots = threading.BoundedSemaphore(processes * 2)
+
+        def bounded(chunks):
+            for chunk in chunks:
+                slots.acquire()
+                yield chunk
+
+        try:
+            chunks = bounded(iter_artist_chunks(fileobj, self.batch_size,
+                self.parse_skip()))
+            # parse is the time this process waits for the pool
+            for artists in self.timed("parse", pool.imap(parse_artist_chunk,
+                chunks)):
+                slots.release()
+                for artist in artists:
+                    self.add(artist)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return self.finish()
+
+    def add(self, artist):
+        self.ordinal += 1
+        if self.ordinal <= self.skip:
+            # already written by the import being resumed
+            for model, uid in self.iter_uids(artist):
+                self.seen[model].add(uid)
+            return
+        self.pending.append(artist)
+        for album in artist["albums"]:
+            self.pending_tracks += len(album["tracks"])
+        if len(self.pending) >= self.batch_size or \
+            self.pending_tracks >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        # whatever the nested stages do not account for is building rows
+        with self.stage("build"):
+            self.write(self.pending, datetime.now())
+        # once committed, rows were written without signals
+        invalidate_responses(*IMPORTED_MODELS)
+        self.pending = []
+        self.pending_tracks = 0
+        if self.verbosity > 1:
+            print ", ".join(["%s: %d" % item for item in sorted(self.counts.items())])
+
+    def iter_uids(self, artist):
+        yield Artist, artist["uid"]
+        for album in artist["albums"]:
+            yield Album, album["uid"]
+            for track in album["tracks"]:
+                yield Track, track["uid"]
+
+    @transaction.commit_manually
+    def write(self, artists, now):
+        albums = [album for artist in artists for album in artist["albums"]]
+        tracks = [track for album in albums for track in album["tracks"]]
+
+        try:
+            self.write_licenses(albums + tracks, now)
+            self.write_genres(albums + tracks, now)
+            self.write_locations(artists, now)
+            self.write_artists(artists, now)
+            self.write_albums(artists, now)
+            self.write_tracks(artists, now)
+
+            if self.checkpoint:
+                # committed along with the rows, so it never gets ahead of
+                # them
+                self.checkpoint.artists = self.ordinal
+                self.checkpoint.albums += len(albums)
+                self.checkpoint.tracks += len(tracks)
+                self.checkpoint.batch += 1
+                ImportCheckpoint.objects.filter(pk=self.checkpoint.pk).update(
+                    artists=self.checkpoint.artists,
+                    albums=self.checkpoint.albums,
+                    tracks=self.checkpoint.tracks,
+                    batch=self.checkpoint.batch, modified_at=now)
+        except:
+            transaction.rollback()
+            raise
+        with self.stage("commit"):
+            transaction.commit()
+
+    def refresh(self, resolver, keys):
+        with self.stage("resolve"):
+            resolver.refresh(keys)
+
+    def insert(self, model, fields, rows):
+        with self.stage("insert"):
+            self.counts[model.__name__] += insert_rows(model, fields, rows)
+
+    def write_licenses(self, records, now):
+        rows = []
+        for url in set([record["license"] for record in records]):
+            if url and url not in self.licenses:
+                license_class, name = license_names(url)
+                rows.append((self.next_license_uid, license_class, name, url, now, now))
+                self.next_license_uid += 1
+        if rows:
+            self.insert(License, ("uid", "license_class",
+                "name", "url", "added_at", "modified_at"), rows)
+            self.refresh(self.licenses, [row[3] for row in rows])
+
+    def write_genres(self, records, now):
+        rows = []
+        for code in set([record["genre"] for record in records]):
+            if code and code not in self.genres:
+                rows.append((code, genre_name(code), u"", now, now))
+        if rows:
+            self.insert(Genre, ("code", "name",
+                "plural_name", "added_at", "modified_at"), rows)
+            self.refresh(self.genres, [row[0] for row in rows])
+
+    def write_locations(self, artists, now):
+        rows = []
+        for code in set([artist["country"] for artist in artists]):
+            if code and code not in self.countries:
+                rows.append((code, self.next_country_numcode, code, code, 0,
+                    now, now))
+                self.next_country_numcode -= 1
+        if rows:
+            self.insert(Country, ("code", "numcode", "name",
+                "printable_name", "artist_count", "added_at", "modified_at"),
+                rows)
+            self.refresh(self.countries, [row[0] for row in rows])
+
+        rows = []
+        for key in set([(artist["state"], artist["country"]) for artist in artists]):
+            if key[0] and key not in self.states:
+                rows.append((key[0], key[0], key[1], now, now))
+        if rows:
+            self.insert(State, ("code", "name", "country",
+                "added_at", "modified_at"), rows)
+            self.refresh(self.states, [(row[0], row[2]) for row in rows])
+
+        rows = []
+        for artist in artists:
+            key = (artist["city"], self.states.get((artist["state"], artist["country"])))
+            if key[0] and key not in self.cities:
+                rows.append((key[0], key[1], now, now))
+                self.cities.add(key, None)
+        if rows:
+            self.insert(City, ("name", "state", "added_at",
+                "modified_at"), rows)
+            self.refresh(self.cities, [row[:2] for row in rows])
+
+    def write_artists(self, artists, now):
+        rows = []
+        for artist in artists:
+            state = self.states.get((artist["state"], artist["country"]))
+            city = self.cities.get((artist["city"], state))
+            rows.append(((artist["uid"], artist["mbgid"], artist["name"],
+                artist["image"], artist["url"], artist["album_count"], city,
+                artist["country"] or None, artist["latitude"],
+                artist["longitude"], geocell(artist["latitude"],
+                artist["longitude"])), artist["fingerprint"]))
+        self.write_rows(Artist, self.artists, ("uid", "mbgid", "name",
+            "image", "url", "album_count", "city", "country", "latitude",
+            "longitude", "geocell"), rows, now)
+
+    def write_albums(self, artists, now):
+        rows = []
+        for artist in artists:
+            for album in artist["albums"]:
+                rows.append(((album["uid"], album["mbgid"], album["name"],
+                    album["url"], album["image"], album["release_date"],
+                    album["filename"], self.genres.get(album["genre"]),
+                    self.licenses.get(album["license"]),
+                    self.artists[artist["uid"]], album["track_count"],
+                    album["duration"]), album["fingerprint"]))
+        self.write_rows(Album, self.albums, ("uid", "mbgid", "name", "url",
+            "image", "release_date", "filename", "genre", "license",
+            "artist", "track_count", "duration"), rows, now)
+
+    def write_tracks(self, artists, now):
+        rows = []
+        for artist in artists:
+            artist_pk = self.artists[artist["uid"]]
+            for album in artist["albums"]:
+                album_pk = self.albums[album["uid"]]
+                for track in album["tracks"]:
+                    rows.append(((track["uid"], track["mbgid"], track["name"],
+                        track["url"], track["duration"], album_pk, artist_pk,
+                        track["numalbum"], track["filename"],
+                        self.genres.get(track["genre"]),
+                        self.licenses.get(track["license"])),
+                        track["fingerprint"]))
+        written = set(self.write_rows(Track, self.tracks, ("uid", "mbgid",
+            "name", "url", "duration", "album", "artist", "numalbum",
+            "filename", "genre", "license"), rows, now))
+
+        # tags are part of the track fingerprint, so only the tracks just
+        # inserted or updated may need their tags written
+        pairs = []
+        for artist in artists:
+            for album in artist["albums"]:
+                for track in album["tracks"]:
+                    if track["uid"] in written:
+                        pairs.append((self.tracks[track["uid"]],
+                            [name for name, weight in track["tags"]]))
+        with self.stage("tagging"):
+            # clouds are rebuilt once, by finish
+            added, removed = update_tags_bulk(Track, pairs, clouds=False)
+        self.counts["TaggedItem"] += added
+        self.deleted["TaggedItem"] += removed
+
+    def write_rows(self, model, resolver, fields, rows, now):
+        """
+        Inserts the rows whose uid (their first value) is not in resolver.
+        In delta mode rows whose fingerprint changed are updated too, and
+        those are the only existing rows whose modified_at and updated_at
+        are touched.
+        """
+        new_rows, changed_rows = [], []
+        for values, digest in rows:
+            uid = values[0]
+            if self.delta:
+                self.seen[model].add(uid)
+            if uid not in resolver:
+                new_rows.append(values + (digest, now, now, now))
+                # a placeholder, so a repeated uid is not inserted twice
+                resolver.add(uid, None)
+                if self.delta:
+                    resolver.set_fingerprint(uid, digest)
+            elif self.delta and resolver.get_fingerprint(uid) != digest:
+                changed_rows.append(values + (digest, now, now, resolver[uid]))
+                resolver.set_fingerprint(uid, digest)
+        if new_rows:
+            self.insert(model, fields + ("fingerprint",
+                "added_at", "modified_at", "updated_at"), new_rows)
+            self.refresh(resolver, [row[0] for row in new_rows])
+        if changed_rows:
+            with self.stage("insert"):
+                self.updated[model.__name__] += update_rows(model, fields + (
+                    "fingerprint", "modified_at", "updated_at"), changed_rows)
+        return [row[0] for row in new_rows + changed_rows]
+
+    @transaction.commit_on_success
+    def delete_missing(self):
+        """
+        Deletes the tracks, albums and artists that were not in the dump,
+        with their TaggedItem and AlbumTag rows, set-wise and without
+        signals. The AlbumTag rows of the albums that lost tracks are
+        recomputed here, clouds and country counts by finish.
+        """
+        missing = {}
+        for model, resolver in ((Track, self.tracks), (Album, self.albums),
+            (Artist, self.artists)):
+            uids = set(resolver) - self.seen[model]
+            missing[model] = [resolver[uid] for uid in uids]
+            for uid in uids:
+                resolver.remove(uid)
+
+        album_ids = set()
+        for pks_chunk in chunks(missing[Track]):
+            album_ids.update(Track.objects.filter(pk__in=pks_chunk
+                ).values_list("album", flat=True))
+        album_ids.difference_update(missing[Album])
+
+        for model in (Track, Album, Artist):
+            ctype = ContentType.objects.get_for_model(model)
+            for pks_chunk in chunks(missing[model]):
+                self.deleted["TaggedItem"] += delete_rows(TaggedItem,
+                    TaggedItem.objects.filter(content_type=ctype,
+                    object_id__in=pks_chunk).values_list("pk", flat=True))
+        for pks_chunk in chunks(missing[Album]):
+            delete_rows(AlbumTag, AlbumTag.objects.filter(
+                album__in=pks_chunk).values_list("pk", flat=True))
+        for model in (Track, Album, Artist):
+            self.deleted[model.__name__] += delete_rows(model, missing[model])
+        refresh_album_tags(list(album_ids))
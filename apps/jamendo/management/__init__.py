@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from django.db.models.signals import post_syncdb
+
+from jamendo import models as jamendo_models
+
+
+def install_search(sender, **kwargs):
+    from jamendo.search import install
+    install()
+
+post_syncdb.connect(install_search, sender=jamendo_models)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import simplejson
+
+from jamendo.benchmark import benchmark_feed
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--items", dest="items", type="int", default=10000,
+            help="Number of entries of the feed."),
+        make_option("--repeat", dest="repeat", type="int", default=3,
+            help="Number of runs, the best one is kept."),
+    )
+    help = ("Builds a large in-memory feed with per item attribute lookups "
+        "and with the compiled dispatch plan, and prints both times and "
+        "the speedup as json.")
+
+    def handle(self, *args, **options):
+        print simplejson.dumps(benchmark_feed(options["items"],
+            options["repeat"]), sort_keys=True, indent=2)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+
+from jamendo.benchmark import benchmark_import
+from jamendo.dump import open_dump
+from jamendo.importer import DEFAULT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", dest="batch_size", type="int",
+            default=DEFAULT_BATCH_SIZE,
+            help="Number of artists or tracks written per INSERT batch."),
+        make_option("--processes", dest="processes", type="int", default=0,
+            help="Parse the dump using this many processes."),
+        make_option("--delta", action="store_true", dest="delta",
+            default=False, help="Import in delta mode."),
+        make_option("--noinput", action="store_false", dest="interactive",
+            default=True,
+            help="Do not ask before deleting an old test database."),
+    )
+    help = ("Imports a dump into a new test database and prints the time "
+        "spent per stage, rows/second and peak RSS as json.")
+    args = "<dump file>"
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: benchmark_jamendo_import %s" % self.args)
+        try:
+            fileobj = open_dump(args[0])
+        except IOError, e:
+            raise CommandError("Unable to open %s: %s" % (args[0], e))
+
+        # never benchmark against the real database
+        old_name = settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0,
+            autoclobber=not options["interactive"])
+        try:
+            results = benchmark_import(fileobj, options["batch_size"],
+                options["processes"], options["delta"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        results["dump"] = args[0]
+        print simplejson.dumps(results, sort_keys=True, indent=2)
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from jamendo.models import AlbumTag
+from jamendo.tags import refresh_album_tags
+
+
+class Command(NoArgsCommand):
+    help = "Recomputes the album tags from the tags of their tracks."
+
+    def handle_noargs(self, **options):
+        refresh_album_tags()
+        transaction.commit_unless_managed()
+        if int(options.get("verbosity", 1)) > 0:
+            print "%d album tags built" % AlbumTag.objects.count()
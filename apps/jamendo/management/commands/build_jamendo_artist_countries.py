@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from jamendo.countries import update_artist_countries, refresh_country_counts
+
+
+class Command(NoArgsCommand):
+    help = "Sets the country of every artist from its city and recounts " \
+        "the artists of every country."
+
+    def handle_noargs(self, **options):
+        update_artist_countries()
+        refresh_country_counts()
+        transaction.commit_unless_managed()
+        if int(options.get("verbosity", 1)) > 0:
+            print "Artist countries updated"
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from jamendo.bulk import update_rows
+from jamendo.geo import geocell
+from jamendo.models import Artist
+
+
+class Command(NoArgsCommand):
+    help = "Sets the geocell of every artist from its latitude and longitude."
+
+    def handle_noargs(self, **options):
+        rows = []
+        for pk, latitude, longitude, cell in Artist.objects.values_list("pk",
+            "latitude", "longitude", "geocell").iterator():
+            new_cell = geocell(latitude, longitude)
+            if new_cell != cell:
+                rows.append((new_cell, pk))
+        update_rows(Artist, ("geocell", ), rows)
+        transaction.commit_unless_managed()
+        if int(options.get("verbosity", 1)) > 0:
+            print "%d artist geocells updated" % len(rows)
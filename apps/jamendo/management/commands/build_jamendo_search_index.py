@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import NoArgsCommand
+
+from jamendo.search import install, get_backend
+
+
+class Command(NoArgsCommand):
+    help = "Creates and rebuilds the name search indexes of jamendo lists."
+
+    def handle_noargs(self, **options):
+        install(rebuild=True)
+        if int(options.get("verbosity", 1)) > 0:
+            print "Search indexes built with %s" % get_backend().__class__.__name__
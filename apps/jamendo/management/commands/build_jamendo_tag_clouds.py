@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from jamendo.models import CloudTag
+from jamendo.clouds import refresh_clouds
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the tag clouds of artists, albums and tracks."
+
+    def handle_noargs(self, **options):
+        refresh_clouds()
+        transaction.commit_unless_managed()
+        if int(options.get("verbosity", 1)) > 0:
+            print "%d cloud tags built" % CloudTag.objects.count()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from jamendo.benchmark import write_dump, parse_size
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--tracks", dest="tracks", default="10k",
+            help="Number of tracks: 10k, 100k, 1m or any number."),
+        make_option("--seed", dest="seed", type="int", default=0,
+            help="Random seed, the same seed gives the same dump."),
+    )
+    help = "Writes a synthetic Jamendo dump, gzipped if the name ends in .gz."
+    args = "<dump file>"
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: generate_jamendo_dump %s" % self.args)
+        try:
+            tracks = parse_size(options["tracks"])
+        except ValueError:
+            raise CommandError("Invalid number of tracks: %s" % options["tracks"])
+        artists, albums, tracks = write_dump(args[0], tracks, options["seed"])
+        if int(options.get("verbosity", 1)) > 0:
+            print "%s: %d artists, %d albums, %d tracks" % (args[0], artists,
+                albums, tracks)
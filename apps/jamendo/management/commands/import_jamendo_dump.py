@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from jamendo.dump import open_dump
+from jamendo.importer import DumpImporter, DEFAULT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", dest="batch_size", type="int",
+            default=DEFAULT_BATCH_SIZE,
+            help="Number of artists or tracks written per INSERT batch."),
+        make_option("--delta", action="store_true", dest="delta",
+            default=False,
+            help="Also update changed artists, albums and tracks and delete "
+                "the ones missing from the dump. Use it with full dumps only."),
+        make_option("--processes", dest="processes", type="int", default=0,
+            help="Parse the dump using this many processes while the main "
+                "one writes to the database. 0 parses it in the main one."),
+        make_option("--checkpoint", dest="checkpoint", default=None,
+            help="Name of the checkpoint where progress is stored. Defaults "
+                "to the dump file name."),
+        make_option("--resume", action="store_true", dest="resume",
+            default=False,
+            help="Continue from the last committed batch of the checkpoint."),
+    )
+    help = "Imports a Jamendo database dump (dbdump_artistalbumtrack.xml.gz)."
+    args = "<dump file>"
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: import_jamendo_dump %s" % self.args)
+        verbosity = int(options.get("verbosity", 1))
+
+        try:
+            fileobj = open_dump(args[0])
+        except IOError, e:
+            raise CommandError("Unable to open %s: %s" % (args[0], e))
+
+        checkpoint = options["checkpoint"] or os.path.basename(args[0])
+        importer = DumpImporter(batch_size=options["batch_size"],
+            delta=options["delta"], checkpoint=checkpoint,
+            resume=options["resume"], verbosity=verbosity)
+        if verbosity > 0 and importer.skip:
+            print "Resuming %s after %d artists" % (checkpoint, importer.skip)
+        if options["processes"] > 0:
+            counts = importer.run_parallel(fileobj, options["processes"])
+        else:
+            counts = importer.run(fileobj)
+
+        if verbosity > 0:
+            for name, inserted in sorted(counts.items()):
+                print "%s: %d new, %d updated, %d deleted rows" % (name,
+                    inserted, importer.updated[name], importer.deleted[name])
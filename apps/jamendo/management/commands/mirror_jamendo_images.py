@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from jamendo.mirror import mirror_images, MIRROR_ROOT, MIRROR_WORKERS
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--root", dest="root", default=MIRROR_ROOT,
+            help="Directory where images are saved (MEDIA_ROOT by default)."),
+        make_option("--workers", dest="workers", type="int",
+            default=MIRROR_WORKERS, help="Number of concurrent downloads."),
+        make_option("--force", action="store_true", dest="force",
+            default=False, help="Download unchanged images again."),
+    )
+    help = "Mirrors album covers and artist images, with their thumbnails."
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get("verbosity", 1))
+        counts = mirror_images(options["root"], options["workers"],
+            options["force"], verbosity)
+        if verbosity > 0:
+            for directory, directory_counts in sorted(counts.items()):
+                print "%s: %d downloaded, %d unchanged, %d failed" % (
+                    directory, directory_counts["downloaded"],
+                    directory_counts["unchanged"], directory_counts["failed"])
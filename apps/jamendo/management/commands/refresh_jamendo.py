@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from jamendo.api import JamendoClient, API_URL, API_RATE_LIMIT
+from jamendo.refresher import Refresher, DEFAULT_CONCURRENCY
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--limit", dest="limit", type="int", default=1000,
+            help="Max number of artists, albums and tracks refreshed per pass."),
+        make_option("--concurrency", dest="concurrency", type="int",
+            default=DEFAULT_CONCURRENCY,
+            help="Number of get2 requests in flight."),
+        make_option("--max-age", dest="max_age", type="int", default=None,
+            help="Only refresh rows not updated in this many hours."),
+        make_option("--api-url", dest="api_url", default=API_URL,
+            help="Base url of the get2 webservice."),
+        make_option("--rate-limit", dest="rate_limit", type="float",
+            default=API_RATE_LIMIT,
+            help="Max number of requests per second."),
+        make_option("--forever", action="store_true", dest="forever",
+            default=False, help="Keep refreshing the stalest rows."),
+        make_option("--sleep", dest="sleep", type="int", default=60,
+            help="Seconds to wait when there is nothing to refresh."),
+    )
+    help = "Refreshes the stalest artists, albums and tracks from Jamendo webservice."
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get("verbosity", 1))
+        max_age = options["max_age"] and timedelta(hours=options["max_age"])
+        client = JamendoClient(options["api_url"],
+            rate_limit=options["rate_limit"])
+        refresher = Refresher(concurrency=options["concurrency"],
+            client=client, max_age=max_age, verbosity=verbosity)
+        try:
+            if options["forever"]:
+                refresher.run_forever(options["limit"], options["sleep"])
+            else:
+                refresher.run(options["limit"])
+        finally:
+            client.close()
+        if verbosity > 0:
+            print "%d rows refreshed, %d failed requests" % (
+                refresher.refreshed, refresher.errors)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local mirror of album covers and artist images.
+
+Images are saved as MEDIA_ROOT/albums/<uid>.jpg (and artists/<uid>.jpg),
+the paths the templates use, with a thumbnail for every size in
+JAMENDO_THUMBNAIL_SIZES as albums/<width>x<height>/<uid>.jpg. Downloads run
+in a bounded pool of worker threads; the ETag and size of every mirrored
+image are kept in an index file so unchanged images are not downloaded
+again.
+
+Thumbnails need PIL, images are mirrored without them if it is missing.
+"""
+
+import Queue
+import httplib
+import os
+import socket
+import threading
+import urllib2
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+from django.conf import settings
+
+from jamendo.models import Album, Artist
+
+
+MIRROR_ROOT = getattr(settings, "JAMENDO_MIRROR_ROOT", settings.MEDIA_ROOT)
+THUMBNAIL_SIZES = getattr(settings, "JAMENDO_THUMBNAIL_SIZES", ((50, 50), ))
+MIRROR_WORKERS = getattr(settings, "JAMENDO_MIRROR_WORKERS", 8)
+MIRROR_TIMEOUT = getattr(settings, "JAMENDO_MIRROR_TIMEOUT", 30)
+
+# directory -> model of the mirrored images
+MIRRORED_MODELS = (
+    ("albums", Album),
+    ("artists", Artist),
+)
+
+INDEX_NAME = ".mirror"
+
+# download results
+DOWNLOADED, UNCHANGED, FAILED = "downloaded", "unchanged", "failed"
+
+
+class ImageMirror(object):
+    """
+    Mirrors the images of one directory (ie: albums) of root.
+    """
+
+    def __init__(self, directory, root=MIRROR_ROOT, sizes=THUMBNAIL_SIZES,
+        workers=MIRROR_WORKERS, timeout=MIRROR_TIMEOUT, force=False,
+        verbosity=1):
+        self.directory = directory
+        self.path = os.path.join(root, directory)
+        self.sizes = sizes
+        self.workers = workers
+        self.timeout = timeout
+        self.force = force
+        self.verbosity = verbosity
+        self.index = {}
+        self.counts = {DOWNLOADED: 0, UNCHANGED: 0, FAILED: 0}
+
+    def get_path(self, uid, size=None):
+        if size:
+            return os.path.join(self.path, "%dx%d" % size, "%d.jpg" % uid)
+        return os.path.join(self.path, "%d.jpg" % uid)
+
+    def load_index(self):
+        """
+        Reads the (etag, size) of the mirrored images, by uid.
+        """
+        self.index = {}
+        try:
+            index = open(os.path.join(self.path, INDEX_NAME))
+        except IOError:
+            return
+        try:
+            for line in index:
+                uid, etag, size = line.rstrip("\n").split("\t")
+                self.index[int(uid)] = (etag, int(size))
+        finally:
+            index.close()
+
+    def save_index(self):
+        filename = os.path.join(self.path, INDEX_NAME)
+        index = open(filename + ".tmp", "w")
+        try:
+            for uid, (etag, size) in sorted(self.index.iteritems()):
+                index.write("%d\t%s\t%d\n" % (uid, etag, size))
+        finally:
+            index.close()
+        os.rename(filename + ".tmp", filename)
+
+    def is_unchanged(self, uid, etag, size):
+        """
+        Tells whether the image of uid has the given etag or, if the server
+        did not send one, size. Missing thumbnails count as a change.
+        """
+        if self.force or uid not in self.index:
+            return False
+        if not os.path.exists(self.get_path(uid)):
+            return False
+        for thumbnail_size in self.thumbnail_sizes():
+            if not os.path.exists(self.get_path(uid, thumbnail_size)):
+                return False
+        old_etag, old_size = self.index[uid]
+        if etag or old_etag:
+            return etag == old_etag
+        return size == old_size
+
+    def thumbnail_sizes(self):
+        if Image is None:
+            return ()
+        return self.sizes
+
+    def download(self, uid, url):
+        """
+        Saves the image of uid from url and its thumbnails. Returns a
+        (result, etag, size) tuple.
+        """
+        request = urllib2.Request(url)
+        etag, size = self.index.get(uid, ("", 0))
+        if etag and self.is_unchanged(uid, etag, size):
+            request.add_header("If-None-Match", etag)
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                return UNCHANGED, etag, size
+            return FAILED, None, None
+        except (urllib2.URLError, httplib.HTTPException, socket.error):
+            return FAILED, None, None
+
+        try:
+            etag = response.info().get("ETag", "")
+            try:
+                size = int(response.info().get("Content-Length"))
+            except (TypeError, ValueError):
+                size = None
+            if size is not None and self.is_unchanged(uid, etag, size):
+                return UNCHANGED, etag, size
+            filename = self.get_path(uid)
+            try:
+                data = response.read()
+                tmp = open(filename + ".tmp", "wb")
+                try:
+                    tmp.write(data)
+                finally:
+                    tmp.close()
+                os.rename(filename + ".tmp", filename)
+            except (IOError, OSError, httplib.HTTPException, socket.error):
+                return FAILED, None, None
+        finally:
+            response.close()
+
+        if not self.write_thumbnails(uid, filename):
+            return FAILED, None, None
+        return DOWNLOADED, etag, len(data)
+
+    def write_thumbnails(self, uid, filename):
+        for size in self.thumbnail_sizes():
+            try:
+                image = Image.open(filename)
+                if image.mode not in ("L", "RGB"):
+                    image = image.convert("RGB")
+                image.thumbnail(size, Image.ANTIALIAS)
+                image.save(self.get_path(uid, size), "JPEG", quality=85)
+            except (IOError, OSError):
+                return False
+        return True
+
+    def work(self, tasks, results):
+        while True:
+            task = tasks.get()
+            if task is None:
+                results.put(None)
+                return
+            uid, url = task
+            results.put((uid, ) + self.download(uid, url))
+
+    def feed(self, tasks, images):
+        for uid, url in images:
+            tasks.put((uid, url))
+        for i in range(self.workers):
+            tasks.put(None)
+
+    def run(self, images):
+        """
+        Mirrors images, an iterable of (uid, url). The index is only
+        written by the calling thread.
+        """
+        for size in (None, ) + tuple(self.thumbnail_sizes()):
+            path = size and os.path.dirname(self.get_path(0, size)) or self.path
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.load_index()
+
+        # bounded, so images is consumed as downloads go
+        tasks = Queue.Queue(self.workers * 2)
+        results = Queue.Queue()
+        threads = [threading.Thread(target=self.feed, args=(tasks, images))]
+        threads += [threading.Thread(target=self.work, args=(tasks, results))
+            for i in range(self.workers)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+
+        running = self.workers
+        try:
+            while running:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                uid, status, etag, size = result
+                self.counts[status] += 1
+                if status == FAILED:
+                    self.index.pop(uid, None)
+                    if self.verbosity > 1:
+                        print "Error mirroring %s %d" % (self.directory, uid)
+                else:
+                    self.index[uid] = (etag or "", size or 0)
+        finally:
+            self.save_index()
+        for thread in threads:
+            thread.join()
+        return self.counts
+
+
+def mirror_images(root=MIRROR_ROOT, workers=MIRROR_WORKERS, force=False,
+    verbosity=1):
+    """
+    Mirrors the images of every album and artist with one. Returns a dict of
+    directory -> result counts.
+    """
+    if Image is None and verbosity > 0:
+        print "PIL is not installed, thumbnails will not be written."
+    counts = {}
+    for directory, model in MIRRORED_MODELS:
+        images = model.objects.filter(uid__isnull=False,
+            image__isnull=False).exclude(image="").values_list("uid", "image")
+        mirror = ImageMirror(directory, root=root, workers=workers,
+            force=force, verbosity=verbosity)
+        # read here, the feeding thread must not use the db connection
+        counts[directory] = mirror.run(list(images))
+    return counts
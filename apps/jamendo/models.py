@@ -1,18 +1,29 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from __future__ import with_statement
+
 import urllib
+from datetime import datetime
 
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.db.models.signals import pre_save, post_save, post_delete
+
+from tagging.models import Tag, TaggedItem
 
-from tagging.models import Tag
+from jamendo.counts import invalidate_count_on_write
+from jamendo.geo import artist_pre_save as artist_geocell_pre_save
+from jamendo.countries import artist_pre_save, artist_post_save,\
+    artist_post_delete, city_post_save, state_post_save
+from jamendo.tags import track_tag_added, track_tag_removed, track_deleted,\
+    tagged_item_changed, batched_refreshes
 
 class HistoryMixin(models.Model):
     # creation date time
     added_at = models.DateTimeField(auto_now_add=True)
-    # last modified date time
-    modified_at = models.DateTimeField(auto_now=True)
+    # last modified date time, indexed for the feeds updated date
+    modified_at = models.DateTimeField(auto_now=True, db_index=True)
     # date time at which it was updated with jamendo data
     updated_at = models.DateTimeField(null=True, blank=True)
     
@@ -25,14 +36,41 @@ class TaggedMixin(models.Model):
         abstract = True
 
     def _get_tags(self):
+        # tags may have been read already, see jamendo.tags.prefetch_tags
+        tags = getattr(self, "_prefetched_tags", None)
+        if tags is not None:
+            return tags
         return Tag.objects.get_for_object(self)
 
     def _set_tags(self, tag_list):
-        Tag.objects.update_tags(self, tag_list)
+        self.__dict__.pop("_prefetched_tags", None)
+        with batched_refreshes():
+            Tag.objects.update_tags(self, tag_list)
 
     tags = property(_get_tags, _set_tags)
 
-class Album(HistoryMixin, TaggedMixin):
+    def delete(self):
+        # the tracks deleted along refresh their albums and clouds only once
+        with batched_refreshes():
+            super(TaggedMixin, self).delete()
+
+    @classmethod
+    def set_tags_bulk(cls, pairs):
+        """
+        Sets the tags of many objects at once, pairs being (object or pk,
+        tag_list) tuples. See jamendo.tags.update_tags_bulk.
+        """
+        from jamendo.tags import update_tags_bulk
+        return update_tags_bulk(cls, pairs)
+
+class FingerprintMixin(models.Model):
+    # digest of the jamendo dump record this row was last imported from
+    fingerprint = models.CharField(max_length=40, blank=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+class Album(HistoryMixin, TaggedMixin, FingerprintMixin):
     uid = models.IntegerField(unique=True, db_index=True)
     mbgid = models.TextField(max_length=48, blank=True)
     
@@ -59,13 +97,8 @@ class Album(HistoryMixin, TaggedMixin):
         return u"%s - %s" % (self.name, self.artist)
 
     def get_tags(self):
-        track_ids = self.track_set.values_list("pk", flat=True)
-        content_type = ContentType.objects.get_for_model(Track)
-        tags = Tag.objects.filter(
-                items__content_type=content_type,
-                items__object_id__in=track_ids
-            ).distinct()
-        return tags
+        # the tags of its tracks, see AlbumTag
+        return Tag.objects.filter(album_tags__album=self)
 
     def get_mp3_url(self):
         # redirects to stream url for the first track of this album,
@@ -112,6 +145,8 @@ class Country(HistoryMixin):
     numcode = models.IntegerField(unique=True, db_index=True)
     name = models.TextField(max_length=100, db_index=True)
     printable_name = models.TextField(max_length=100)
+    # number of artists with this country, see jamendo.countries
+    artist_count = models.IntegerField(default=0)
     
     def __unicode__(self):
         return u"%s" % (self.name, )
@@ -134,7 +169,7 @@ class City(HistoryMixin):
     def __unicode__(self):
         return u"%s, %s" % (self.name, self.state)
     
-class Artist(HistoryMixin, TaggedMixin):
+class Artist(HistoryMixin, TaggedMixin, FingerprintMixin):
     uid = models.IntegerField(unique=True, db_index=True)
     mbgid = models.TextField(max_length=48, blank=True)
     
@@ -144,8 +179,15 @@ class Artist(HistoryMixin, TaggedMixin):
     album_count = models.IntegerField(default=1)
     
     city = models.ForeignKey("City", blank=True, null=True, db_index=True)
+    # city.state.country, denormalized, see jamendo.countries
+    # indexed along with name by sql/artist.sql, see below
+    country = models.ForeignKey("Country", to_field="code", blank=True,
+        null=True, editable=False, db_index=False)
     latitude = models.DecimalField(max_digits=12, decimal_places=10, blank=True, null=True)
-    longitude = models.DecimalField(max_digits=13, decimal_places=10, blank=True, default=True)
+    longitude = models.DecimalField(max_digits=13, decimal_places=10, blank=True, null=True)
+    # geohash of latitude and longitude, see jamendo.geo
+    geocell = models.CharField(max_length=12, blank=True, db_index=True,
+        editable=False)
     
     def __unicode__(self):
         return u"%s" % (self.name, )
@@ -153,19 +195,30 @@ class Artist(HistoryMixin, TaggedMixin):
     def get_quoted_name(self):
         return urllib.quote(self.name)
 
+    def get_album_uids(self):
+        # albums may have been read already, ie: by ArtistShow
+        albums = getattr(self, "_prefetched_albums", None)
+        if albums is not None:
+            return [album.uid for album in albums]
+        return list(self.album_set.values_list("uid", flat=True))
+
     def get_mp3_m3u(self):
         url_tpl = "http://api.jamendo.com/get2/stream/album/m3u/?id=%s&streamencoding=mp31"
-        album_ids = map(str, list(self.album_set.values_list("uid", flat=True)))
+        album_ids = map(str, self.get_album_uids())
         album_ids_str = "+".join(album_ids)
         return url_tpl % album_ids_str
 
     def get_ogg_m3u(self):
         url_tpl = "http://api.jamendo.com/get2/stream/album/m3u/?id=%s&streamencoding=ogg2"
-        album_ids = map(str, list(self.album_set.values_list("uid", flat=True)))
+        album_ids = map(str, self.get_album_uids())
         album_ids_str = "+".join(album_ids)
         return url_tpl % album_ids_str
 
-class Track(HistoryMixin, TaggedMixin):
+# ForeignKey ignores db_index=False (Django 1.1), and the (country, name, id)
+# index of sql/artist.sql makes a country one redundant
+Artist._meta.get_field("country").db_index = False
+
+class Track(HistoryMixin, TaggedMixin, FingerprintMixin):
     uid = models.IntegerField(unique=True, null=True, blank=True)
     mbgid = models.TextField(max_length=48, blank=True)
 
@@ -192,6 +245,62 @@ class Track(HistoryMixin, TaggedMixin):
     def get_ogg_url(self):
         return "http://api.jamendo.com/get2/stream/track/m3u/?id=%d&streamencoding=ogg2" % self.uid
     
+class AlbumTag(models.Model):
+    """
+    The tags of the tracks of an album, with the number of tracks tagged
+    with each. It is derived from the track TaggedItem rows and kept up to
+    date by jamendo.tags, so it must not be edited by hand.
+    """
+    album = models.ForeignKey("Album")
+    tag = models.ForeignKey(Tag, related_name="album_tags")
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (("album", "tag"), )
+
+    def __unicode__(self):
+        return u"%s: %s (%d)" % (self.album_id, self.tag_id, self.count)
+
+class CloudTag(models.Model):
+    """
+    A tag of the tag cloud of a model, with the number of objects of the
+    model it tags and its font size. Kept up to date by jamendo.clouds.
+    """
+    content_type = models.ForeignKey(ContentType)
+    tag = models.ForeignKey(Tag, related_name="cloud_tags")
+    # the tag name, so clouds are read without a join
+    name = models.CharField(max_length=50)
+    count = models.IntegerField(default=0)
+    font_size = models.IntegerField(default=1)
+    # when the count was last computed, for jamendo.autocomplete
+    modified_at = models.DateTimeField(default=datetime.now, db_index=True)
+
+    class Meta:
+        unique_together = (("content_type", "tag"), )
+        ordering = ["name"]
+
+    def __unicode__(self):
+        return u"%s (%d)" % (self.name, self.count)
+
+class ImportCheckpoint(HistoryMixin):
+    """
+    Progress of a dump import. It is updated in the same transaction as
+    every batch of rows the importer writes, so an interrupted import can
+    be resumed from its last committed batch.
+    """
+    name = models.TextField(unique=True, db_index=True)
+    # number of <artist> elements of the dump already written. gzipped dumps
+    # cannot be seeked, so this is used instead of a byte offset
+    artists = models.IntegerField(default=0)
+    albums = models.IntegerField(default=0)
+    tracks = models.IntegerField(default=0)
+    # number of the last committed batch
+    batch = models.IntegerField(default=0)
+    finished = models.BooleanField(default=False)
+
+    def __unicode__(self):
+        return u"%s (%d artists)" % (self.name, self.artists)
+
 class Playlist(HistoryMixin):
     uid = models.IntegerField(unique=True, null=True, blank=True)
     name = models.TextField(blank=True, db_index=True)
@@ -235,3 +344,27 @@ class Radio(HistoryMixin):
     weight = models.IntegerField(default=1)
     image = models.URLField(blank=True, null=True)
 
+
+# cached list counts, cached pages and their ETags change on every write of
+# these models
+for model in (Artist, Album, Track, License, Genre, Country, State, City,
+    Tag, TaggedItem):
+    post_save.connect(invalidate_count_on_write, sender=model)
+    post_delete.connect(invalidate_count_on_write, sender=model)
+
+# album tags follow the tags of their tracks
+post_save.connect(track_tag_added, sender=TaggedItem)
+post_delete.connect(track_tag_removed, sender=TaggedItem)
+post_delete.connect(track_deleted, sender=Track)
+# and so do tag clouds, once album tags are up to date
+post_save.connect(tagged_item_changed, sender=TaggedItem)
+post_delete.connect(tagged_item_changed, sender=TaggedItem)
+
+# artist countries and country artist counts
+pre_save.connect(artist_pre_save, sender=Artist)
+post_save.connect(artist_post_save, sender=Artist)
+post_delete.connect(artist_post_delete, sender=Artist)
+post_save.connect(city_post_save, sender=City)
+post_save.connect(state_post_save, sender=State)
+# and geohashes
+pre_save.connect(artist_geocell_pre_save, sender=Artist)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Keyset (aka seek) pagination.
+
+Instead of OFFSET n, a page is asked for with the ordering values of the
+last row of the previous page (the cursor), ie: name > 'foo' OR (name =
+'foo' AND id > 42), so the database walks the (name, id) index from there
+and any page costs the same as the first one. No COUNT(*) is run either:
+one extra row is read to know whether there is a next page.
+
+Cursors are handed to clients as opaque url-safe tokens.
+"""
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils import simplejson
+
+
+# rows read at a time by iter_by_cursor
+CHUNK_SIZE = 100
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    return urlsafe_b64encode(simplejson.dumps(values)).rstrip("=")
+
+def decode_cursor(token, length):
+    """
+    Returns the list of values encoded in token, which must be length long.
+    Raises InvalidCursor if token was not made by encode_cursor.
+    """
+    try:
+        token = str(token)
+        values = simplejson.loads(urlsafe_b64decode(token +
+            "=" * (-len(token) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(token)
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor(token)
+    return values
+
+def _to_python(model, fields, values, token):
+    """
+    Returns values converted to the types of the model fields they are
+    compared to, so a token of wrong values raises InvalidCursor instead of
+    an error of the query.
+    """
+    converted = []
+    for field, value in zip(fields, values):
+        name = field.lstrip("-")
+        if name == "pk":
+            model_field = model._meta.pk
+        else:
+            model_field = model._meta.get_field(name)
+        try:
+            converted.append(model_field.to_python(value))
+        except (ValidationError, TypeError, ValueError):
+            raise InvalidCursor(token)
+    return converted
+
+
+def _seek(fields, values, backwards=False):
+    """
+    Returns a Q for the rows after (before if backwards) values in the
+    ordering given by fields. The first field is constrained on its own
+    too, so the database can use it for an index range scan.
+    """
+    def lookup(field, strict):
+        descending = field.startswith("-")
+        if descending != backwards:
+            return "%s__%s" % (field.lstrip("-"), strict and "lt" or "lte")
+        return "%s__%s" % (field.lstrip("-"), strict and "gt" or "gte")
+
+    seek_q = Q(**{lookup(fields[0], True): values[0]})
+    for index in range(1, len(fields)):
+        conditions = dict([(field.lstrip("-"), value) for field, value in
+            zip(fields[:index], values[:index])])
+        conditions[lookup(fields[index], True)] = values[index]
+        seek_q |= Q(**conditions)
+    return Q(**{lookup(fields[0], False): values[0]}) & seek_q
+
+
+class CursorPage(object):
+    """
+    A page of rows. next_cursor and previous_cursor are the tokens of the
+    following and preceding pages, or None if there are none.
+    """
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+
+def _values(obj, fields):
+    values = []
+    for field in fields:
+        value = getattr(obj, field.lstrip("-"))
+        if hasattr(value, "pk"):
+            value = value.pk
+        values.append(value)
+    return values
+
+def _cursor(obj, fields):
+    return encode_cursor(_values(obj, fields))
+
+def paginate_by_cursor(queryset, fields, per_page, after=None, before=None):
+    """
+    Returns the CursorPage of queryset, ordered by fields, with the
+    per_page rows following the after cursor, or preceding the before one,
+    or the first ones if both are None or empty, as ?before= would pass.
+    fields must identify a row, so its last one should be the pk.
+    """
+    fields = tuple(fields)
+    after, before = after or None, before or None
+    backwards = before is not None
+    token = backwards and before or after
+    if backwards:
+        ordering = [field.startswith("-") and field[1:] or "-" + field
+            for field in fields]
+    else:
+        ordering = list(fields)
+    queryset = queryset.order_by(*ordering)
+    if token is not None:
+        values = _to_python(queryset.model, fields,
+            decode_cursor(token, len(fields)), token)
+        queryset = queryset.filter(_seek(fields, values, backwards))
+
+    object_list = list(queryset[:per_page + 1])
+    more = len(object_list) > per_page
+    object_list = object_list[:per_page]
+    if backwards:
+        object_list.reverse()
+    if not object_list:
+        return CursorPage(object_list, None, None)
+
+    first, last = _cursor(object_list[0], fields), _cursor(object_list[-1], fields)
+    if backwards:
+        # before cursors come from a following page, so there is one
+        return CursorPage(object_list, last, more and first or None)
+    return CursorPage(object_list, more and last or None,
+        token is not None and first or None)
+
+
+def iter_by_cursor(queryset, fields, chunk_size=CHUNK_SIZE):
+    """
+    Yields every row of queryset, ordered by fields, reading chunk_size of
+    them at a time with the same seek conditions as paginate_by_cursor, so
+    only a chunk is ever in memory and no chunk costs more than the first.
+    fields must identify a row, so its last one should be the pk.
+    """
+    fields = tuple(fields)
+    queryset = queryset.order_by(*fields)
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        for obj in chunk:
+            yield obj
+        if len(chunk) < chunk_size:
+            return
+        chunk = list(queryset.filter(_seek(fields, _values(chunk[-1],
+            fields)))[:chunk_size])
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Background refresh of artists, albums and tracks from Jamendo webservice.
+
+Rows are refreshed stalest first: the ones never synced (updated_at is
+null), then by oldest updated_at, and, for the same staleness, the most
+popular first. concurrency worker threads keep that many get2 batches in
+flight while the calling thread, the only one touching the database,
+writes their results back with one UPDATE batch per request.
+"""
+
+import Queue
+import heapq
+import threading
+import time
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import Q
+
+from jamendo.api import JamendoClient, fetch_fields, write_refreshed
+from jamendo.models import Artist, Album, Track
+from jamendo.responses import invalidate_responses
+
+
+# (model, refreshed fields, popularity field or None)
+REFRESH_JOBS = (
+    (Artist, ("name", "image", "url"), "album_count"),
+    (Album, ("name", "image", "url", "release_date"), "track_count"),
+    (Track, ("name", "duration", "numalbum"), None),
+)
+
+DEFAULT_CONCURRENCY = 4
+
+
+class Refresher(object):
+    """
+    Refreshes up to limit rows of every job per pass, only the ones not
+    updated in the last max_age (a timedelta) if given.
+    """
+
+    def __init__(self, jobs=REFRESH_JOBS, concurrency=DEFAULT_CONCURRENCY,
+        client=None, max_age=None, verbosity=1):
+        self.jobs = jobs
+        self.concurrency = concurrency
+        self.client = client or JamendoClient()
+        self.max_age = max_age
+        self.verbosity = verbosity
+        self.queue = []
+        self.refreshed = 0
+        self.errors = 0
+
+    def load(self, limit, updated_before=None):
+        """
+        Pushes the limit stalest rows of every job into the priority queue,
+        only the ones not updated since updated_before if given.
+        """
+        never = datetime.min
+        for index, (model, fields, popularity) in enumerate(self.jobs):
+            queryset = model.objects.filter(uid__isnull=False)
+            if self.max_age:
+                queryset = queryset.filter(Q(updated_at__isnull=True) |
+                    Q(updated_at__lt=datetime.now() - self.max_age))
+            if updated_before:
+                queryset = queryset.filter(Q(updated_at__isnull=True) |
+                    Q(updated_at__lt=updated_before))
+            ordering = popularity and ("-%s" % popularity, ) or ()
+            # databases disagree on where NULLs go when sorting, so rows
+            # never synced are asked for on their own
+            querysets = (
+                queryset.filter(updated_at__isnull=True).order_by(*ordering),
+                queryset.filter(updated_at__isnull=False).order_by(
+                    "updated_at", *ordering),
+            )
+            remaining = limit
+            for queryset in querysets:
+                if remaining <= 0:
+                    break
+                rows = queryset.values_list("uid", "updated_at",
+                    popularity or "uid")[:remaining]
+                for uid, updated_at, value in rows:
+                    score = popularity and -(value or 0) or 0
+                    heapq.heappush(self.queue,
+                        (updated_at or never, score, index, uid))
+                    remaining -= 1
+
+    def batches(self):
+        """
+        Pops the queue in priority order, grouping uids of the same job in
+        batches of the client batch_size. Yields (job index, uids) tuples.
+        """
+        pending = {}
+        while self.queue:
+            updated_at, score, index, uid = heapq.heappop(self.queue)
+            uids = pending.setdefault(index, [])
+            uids.append(uid)
+            if len(uids) >= self.client.batch_size:
+                yield index, pending.pop(index)
+        for index, uids in pending.items():
+            yield index, uids
+
+    def work(self, tasks, results):
+        while True:
+            task = tasks.get()
+            if task is None:
+                results.put(None)
+                return
+            index, uids = task
+            model, fields, popularity = self.jobs[index]
+            try:
+                records = fetch_fields(self.client, model, fields, uids)
+            except Exception, e:
+                records = e
+            results.put((index, uids, records))
+
+    def feed(self, tasks):
+        for task in self.batches():
+            tasks.put(task)
+        for i in range(self.concurrency):
+            tasks.put(None)
+
+    def run(self, limit=1000, updated_before=None):
+        """
+        Refreshes the limit stalest rows of every job, only the ones not
+        updated since updated_before if given. Returns the number of
+        refreshed rows.
+        """
+        self.load(limit, updated_before)
+        # bounded, so at most concurrency batches wait for a worker
+        tasks = Queue.Queue(self.concurrency)
+        results = Queue.Queue()
+        threads = [threading.Thread(target=self.feed, args=(tasks, ))]
+        threads += [threading.Thread(target=self.work, args=(tasks, results))
+            for i in range(self.concurrency)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+
+        refreshed = 0
+        running = self.concurrency
+        while running:
+            result = results.get()
+            if result is None:
+                running -= 1
+                continue
+            refreshed += self.write(*result)
+        for thread in threads:
+            thread.join()
+        self.refreshed += refreshed
+        return refreshed
+
+    def write(self, index, uids, records):
+        model, fields, popularity = self.jobs[index]
+        if isinstance(records, Exception):
+            self.errors += 1
+            if self.verbosity > 0:
+                print "Error refreshing %s %s: %s" % (model.__name__,
+                    "+".join(map(str, uids)), records)
+            return 0
+        refreshed = write_refreshed(model, fields, records)
+        # rows jamendo knows nothing about are marked as synced anyway, so
+        # they do not stay on top of the queue forever
+        missing = set(uids) - set(records)
+        if missing:
+            model.objects.filter(uid__in=list(missing)).update(
+                updated_at=datetime.now())
+        transaction.commit_unless_managed()
+        invalidate_responses(model)
+        if self.verbosity > 1:
+            print "%d %s refreshed" % (refreshed, model._meta.verbose_name_plural)
+        return refreshed
+
+    def run_forever(self, limit=1000, poll_interval=60):
+        """
+        Keeps refreshing the stalest rows, sleeping poll_interval seconds
+        whenever a pass finds nothing to refresh. A pass skips the rows
+        refreshed since the previous one started: without max_age every
+        row is always stale, and a small table would otherwise be
+        refreshed over and over without a pause.
+        """
+        updated_before = None
+        while True:
+            started = datetime.now()
+            if not self.run(limit, updated_before):
+                time.sleep(poll_interval)
+            updated_before = started
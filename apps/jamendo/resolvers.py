@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-memory natural key -> primary key maps used while importing.
+
+Dump records point at each other by natural keys (jamendo uids, license
+urls, country codes, etc). These resolvers are loaded with one query per
+model and updated as rows are inserted, so foreign keys are resolved
+without any per-row query.
+"""
+
+from array import array
+from binascii import hexlify, unhexlify
+from bisect import bisect_left
+from heapq import merge
+from itertools import izip
+
+from jamendo.bulk import chunks
+
+
+DIGEST_SIZE = 20
+EMPTY_DIGEST = "\0" * DIGEST_SIZE
+
+# rows added to a UidResolver are merged into its arrays once there are more
+# than this many of them (or a quarter of the arrays size)
+COMPACT_THRESHOLD = 65536
+
+
+class KeyResolver(object):
+    """
+    Maps the values of some fields of a model (a single value or a tuple of
+    them, ie: State (code, country)) to primary keys. Meant for the small
+    tables (licenses, genres, countries, states and cities), so they are
+    kept in a dict.
+    """
+
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = tuple(fields)
+        self.keys = {}
+
+    def _key(self, values):
+        if len(self.fields) == 1:
+            return values[0]
+        return tuple(values)
+
+    def _update(self, queryset):
+        for row in queryset.values_list(*(self.fields + ("pk", ))):
+            self.keys[self._key(row[:-1])] = row[-1]
+
+    def load(self):
+        self.keys = {}
+        self._update(self.model.objects.all())
+        return self
+
+    def refresh(self, keys):
+        """
+        Reads the primary keys of the given, just inserted, keys.
+        """
+        lookup = "%s__in" % self.fields[0]
+        if len(self.fields) == 1:
+            values = set(keys)
+        else:
+            values = set([key[0] for key in keys])
+        values.discard(None)
+        for values_chunk in chunks(values):
+            self._update(self.model.objects.filter(**{lookup: values_chunk}))
+
+    def get(self, key, default=None):
+        return self.keys.get(key, default)
+
+    def add(self, key, pk):
+        self.keys[key] = pk
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class UidResolver(object):
+    """
+    Maps jamendo uids to primary keys (and, optionally, to the fingerprint
+    of the record they were imported from) for artists, albums and tracks.
+
+    Rows are kept sorted in arrays and looked up with bisect: 16 bytes per
+    row, 36 with fingerprints, instead of the hundred or so a dict entry
+    costs. Rows added later go to a dict that is merged into the arrays
+    every now and then.
+    """
+
+    def __init__(self, model, fingerprints=False):
+        self.model = model
+        self.with_fingerprints = fingerprints
+        self.uids = array("l")
+        self.pks = array("l")
+        self.digests = ""
+        self.added = {}
+        self.added_digests = {}
+
+    def load(self):
+        self.uids = array("l")
+        self.pks = array("l")
+        digests = []
+        self.added = {}
+        self.added_digests = {}
+        fields = ("uid", "pk")
+        if self.with_fingerprints:
+            fields += ("fingerprint", )
+        queryset = self.model.objects.filter(uid__isnull=False).order_by(
+            "uid").values_list(*fields)
+        for row in queryset.iterator():
+            self.uids.append(row[0])
+            self.pks.append(row[1])
+            if self.with_fingerprints:
+                digests.append(row[2] and unhexlify(row[2]) or EMPTY_DIGEST)
+        self.digests = "".join(digests)
+        return self
+
+    def _index(self, uid):
+        index = bisect_left(self.uids, uid)
+        if index < len(self.uids) and self.uids[index] == uid and \
+            self.pks[index]:
+            return index
+        return None
+
+    def get(self, uid, default=None):
+        if uid in self.added:
+            return self.added[uid]
+        index = self._index(uid)
+        if index is None:
+            return default
+        return self.pks[index]
+
+    def __getitem__(self, uid):
+        if uid not in self:
+            raise KeyError(uid)
+        return self.get(uid)
+
+    def __contains__(self, uid):
+        return uid in self.added or self._index(uid) is not None
+
+    def __iter__(self):
+        for uid, pk in izip(self.uids, self.pks):
+            if pk and uid not in self.added:
+                yield uid
+        for uid in self.added:
+            yield uid
+
+    def __len__(self):
+        return len([uid for uid in self])
+
+    def add(self, uid, pk):
+        """
+        Stores the pk of an inserted row. None may be used while the pk is
+        not known yet, so the uid is not inserted twice.
+        """
+        self.added[uid] = pk
+
+    def remove(self, uid):
+        self.added.pop(uid, None)
+        self.added_digests.pop(uid, None)
+        index = self._index(uid)
+        if index is not None:
+            self.pks[index] = 0
+
+    def refresh(self, uids):
+        """
+        Reads the primary keys of the given, just inserted, uids.
+        """
+        for uids_chunk in chunks(uids):
+            self.added.update(self.model.objects.filter(
+                uid__in=uids_chunk).values_list("uid", "pk"))
+        if len(self.added) > max(COMPACT_THRESHOLD, len(self.uids) / 4):
+            self.compact()
+
+    def compact(self):
+        """
+        Merges the added rows whose pk is known into the sorted arrays.
+        """
+        added = sorted([(uid, pk) for uid, pk in self.added.iteritems()
+            if pk is not None])
+        if not added:
+            return
+
+        def stored():
+            for index, (uid, pk) in enumerate(izip(self.uids, self.pks)):
+                if pk and uid not in self.added:
+                    yield uid, pk, self.digests[
+                        index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+
+        def pending():
+            for uid, pk in added:
+                digest = self.added_digests.get(uid)
+                yield uid, pk, digest and unhexlify(digest) or EMPTY_DIGEST
+
+        uids, pks, digests = array("l"), array("l"), []
+        for uid, pk, digest in merge(stored(), pending()):
+            uids.append(uid)
+            pks.append(pk)
+            if self.with_fingerprints:
+                digests.append(digest)
+        self.uids, self.pks, self.digests = uids, pks, "".join(digests)
+        for uid, pk in added:
+            del self.added[uid]
+            self.added_digests.pop(uid, None)
+
+    def get_fingerprint(self, uid):
+        if uid in self.added_digests:
+            return self.added_digests[uid]
+        index = self._index(uid)
+        if index is None:
+            return None
+        digest = self.digests[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+        if digest == EMPTY_DIGEST:
+            return u""
+        return hexlify(digest)
+
+    def set_fingerprint(self, uid, fingerprint):
+        self.added_digests[uid] = fingerprint
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Conditional GET and response caching for the class-based views.
+
+Every model a page is made of has a "generation" (see jamendo.counts): a
+timestamp of its last write, bumped by the save and delete signals (see
+models.py) and by the code writing rows without them (imports, refreshes,
+bulk tagging). A page ETag is a digest of its url, language, user, the
+modified_at of the shown instance if any and the generations of the models
+it depends on; its Last-Modified the latest of those dates. Unchanged
+pages are answered with a 304 without being rendered.
+
+Generations are only as shared as the cache backend: with a per-process
+one (locmem) a process does not see the writes of the others. So list
+pages also fold the latest modified_at of their models in, one MAX() of
+an indexed column each, and show pages the latest modified_at of the
+instance and of the rows shown along with it (see ShowView.related).
+
+If JAMENDO_RESPONSE_CACHE is on, responses to anonymous users are also
+cached by ETag, so any write to a model a page depends on makes its cached
+responses unreachable. Some of those models have no modified_at (tags),
+so it is only turned on with a cache backend shared by all the processes:
+never with locmem.
+"""
+
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils.hashcompat import md5_constructor
+from django.utils.translation import get_language
+
+from jamendo.counts import get_generation, invalidate_count
+
+
+RESPONSE_CACHE = getattr(settings, "JAMENDO_RESPONSE_CACHE", False) and \
+    not settings.CACHE_BACKEND.startswith("locmem:")
+RESPONSE_CACHE_TIMEOUT = getattr(settings,
+    "JAMENDO_RESPONSE_CACHE_TIMEOUT", 600)
+
+# same generations as the counts
+invalidate_responses = invalidate_count
+
+def latest_modified_at(models):
+    """
+    Returns the latest modified_at of the rows of the given models that
+    have one, or None.
+    """
+    latest = None
+    for model in models:
+        if "modified_at" not in [field.name for field in model._meta.fields]:
+            continue
+        value = model.objects.aggregate(latest=Max("modified_at"))["latest"]
+        if value is not None and (latest is None or value > latest):
+            latest = value
+    return latest
+
+
+class Validators(object):
+    """
+    The ETag and Last-Modified of a page, see get_validators.
+    """
+
+    def __init__(self, etag, last_modified):
+        self.etag = etag
+        self.last_modified = last_modified
+
+def get_validators(request, name, models, modified_at=None):
+    """
+    Returns the Validators of the page name (ie: the view class name) shown
+    at request, made of the given models and, if it shows a single row, of
+    its modified_at.
+    """
+    generations = [get_generation(model) for model in models]
+    user = getattr(request, "user", None)
+    user_pk = user is not None and user.is_authenticated() and user.pk or ""
+    etag = md5_constructor("%s:%s:%s:%s:%s:%r" % (name,
+        request.get_full_path(), get_language(), user_pk, modified_at,
+        generations)).hexdigest()
+
+    last_modified = modified_at
+    if generations:
+        latest = datetime.fromtimestamp(max(generations))
+        if last_modified is None or latest > last_modified:
+            last_modified = latest
+    return Validators(etag, last_modified)
+
+
+def cacheable(request):
+    user = getattr(request, "user", None)
+    return RESPONSE_CACHE and request.method == "GET" and \
+        (user is None or not user.is_authenticated())
+
+def get_cached_response(etag):
+    return cache.get("jamendo.responses.%s" % etag)
+
+def set_cached_response(etag, response):
+    if response.status_code == 200:
+        cache.set("jamendo.responses.%s" % etag, response,
+            RESPONSE_CACHE_TIMEOUT)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Indexed name search for the list views.
+
+name__icontains is a full table scan. Depending on the database engine
+names are indexed instead with:
+
+- sqlite3: an FTS5 table per model (jamendo_<model>_search) kept up to
+  date by triggers, so bulk inserts are indexed too. Words of the query
+  match words of the names by prefix and results are ranked with bm25.
+- postgresql: a pg_trgm GIN index on the name column, which makes
+  ILIKE '%...%' an index scan, and results ranked by similarity.
+
+Any other engine (or a sqlite built without FTS5) falls back to
+icontains. Indexes are created on syncdb, see build_jamendo_search_index to
+(re)build them on an existing database.
+"""
+
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+
+
+def _engine():
+    engine = settings.DATABASE_ENGINE
+    if engine == "sqlite3":
+        return "sqlite3"
+    if engine.startswith("postgresql"):
+        return "postgresql"
+    return None
+
+def _sqlite_has_fts5():
+    cursor = connection.cursor()
+    try:
+        cursor.execute("PRAGMA compile_options")
+        return "ENABLE_FTS5" in [row[0] for row in cursor.fetchall()]
+    except Exception:
+        return False
+
+
+class SearchBackend(object):
+    """
+    icontains search, the fallback used when names are not indexed.
+    """
+
+    def search(self, queryset, query):
+        """
+        Returns queryset filtered by the rows whose name matches query,
+        ordered by relevance.
+        """
+        return queryset.filter(name__icontains=query)
+
+    def install(self, model):
+        pass
+
+    def rebuild(self, model):
+        pass
+
+
+class SqliteSearchBackend(SearchBackend):
+    def table(self, model):
+        return "%s_search" % model._meta.db_table
+
+    def match(self, query):
+        # every word is matched by prefix, quoted so FTS5 operators in
+        # user input are taken literally
+        words = re.findall(r"\w+", query, re.UNICODE)
+        return u" ".join([u'"%s"*' % word for word in words])
+
+    def search(self, queryset, query):
+        match = self.match(query)
+        if not match:
+            return super(SqliteSearchBackend, self).search(queryset, query)
+        model = queryset.model
+        table = self.table(model)
+        return queryset.extra(tables=[table],
+            select={"search_rank": "bm25(%s)" % table},
+            where=["%s.rowid = %s.%s" % (table, model._meta.db_table,
+                model._meta.pk.column), "%s MATCH %%s" % table],
+            params=[match]).order_by("search_rank", "pk")
+
+    def install(self, model):
+        values = {"table": self.table(model), "base": model._meta.db_table,
+            "pk": model._meta.pk.column}
+        cursor = connection.cursor()
+        for sql in (
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %(table)s USING fts5(name, "
+                "content='%(base)s', content_rowid='%(pk)s', "
+                "tokenize='unicode61 remove_diacritics 2')",
+            "CREATE TRIGGER IF NOT EXISTS %(table)s_insert AFTER INSERT ON "
+                "%(base)s BEGIN INSERT INTO %(table)s(rowid, name) VALUES "
+                "(new.%(pk)s, new.name); END",
+            "CREATE TRIGGER IF NOT EXISTS %(table)s_delete AFTER DELETE ON "
+                "%(base)s BEGIN INSERT INTO %(table)s(%(table)s, rowid, name) "
+                "VALUES ('delete', old.%(pk)s, old.name); END",
+            "CREATE TRIGGER IF NOT EXISTS %(table)s_update AFTER UPDATE OF "
+                "name ON %(base)s BEGIN INSERT INTO %(table)s(%(table)s, "
+                "rowid, name) VALUES ('delete', old.%(pk)s, old.name); "
+                "INSERT INTO %(table)s(rowid, name) VALUES (new.%(pk)s, "
+                "new.name); END",
+            ):
+            cursor.execute(sql % values)
+
+    def rebuild(self, model):
+        table = self.table(model)
+        connection.cursor().execute(
+            "INSERT INTO %s(%s) VALUES ('rebuild')" % (table, table))
+
+
+class PostgresqlSearchBackend(SearchBackend):
+    def search(self, queryset, query):
+        query = query.strip()
+        if not query:
+            return queryset
+        column = "%s.%s" % (connection.ops.quote_name(
+            queryset.model._meta.db_table), connection.ops.quote_name("name"))
+        # not name__icontains, it compares UPPER(name) and the index is on
+        # name
+        pattern = u"%%%s%%" % query.replace("\\", "\\\\").replace("%",
+            "\\%").replace("_", "\\_")
+        return queryset.extra(
+            select={"search_rank": "-similarity(%s, %%s)" % column},
+            select_params=[query], where=["%s ILIKE %%s" % column],
+            params=[pattern]).order_by("search_rank", "pk")
+
+    def install(self, model):
+        cursor = connection.cursor()
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+            ["%s_name_trgm" % model._meta.db_table])
+        if not cursor.fetchone():
+            cursor.execute("CREATE INDEX %s_name_trgm ON %s USING gin "
+                "(name gin_trgm_ops)" % (model._meta.db_table,
+                connection.ops.quote_name(model._meta.db_table)))
+
+    def rebuild(self, model):
+        connection.cursor().execute("REINDEX INDEX %s_name_trgm" %
+            model._meta.db_table)
+
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        engine = _engine()
+        if engine == "sqlite3" and _sqlite_has_fts5():
+            _backend = SqliteSearchBackend()
+        elif engine == "postgresql":
+            _backend = PostgresqlSearchBackend()
+        else:
+            _backend = SearchBackend()
+    return _backend
+
+def searched_models():
+    from jamendo.models import Artist, Album, City, Country, License
+    return (Artist, Album, City, Country, License)
+
+def search(queryset, query):
+    """
+    Returns the rows of queryset whose name matches query, best first.
+    """
+    return get_backend().search(queryset, query)
+
+def install(rebuild=False):
+    """
+    Creates the name indexes of the searched models, rebuilding their
+    content if rebuild is True.
+    """
+    backend = get_backend()
+    for model in searched_models():
+        backend.install(model)
+        if rebuild:
+            backend.rebuild(model)
+    transaction.commit_unless_managed()
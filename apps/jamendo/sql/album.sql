@@ -0,0 +1 @@
+CREATE INDEX jamendo_album_name_id ON jamendo_album (name, id);
@@ -0,0 +1,2 @@
+CREATE INDEX jamendo_artist_name_id ON jamendo_artist (name, id);
+CREATE INDEX jamendo_artist_country_name ON jamendo_artist (country_id, name, id);
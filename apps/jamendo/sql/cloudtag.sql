@@ -0,0 +1 @@
+CREATE INDEX jamendo_cloudtag_content_type_name ON jamendo_cloudtag (content_type_id, name);
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tagging many objects at once.
+
+Tag.objects.update_tags(obj, tags) runs a handful of queries per object.
+update_tags_bulk does the same for a whole list of objects of a model with
+a few set-wise statements: missing tags are inserted once, the current
+TaggedItem rows are read in chunks, diffed against the wanted ones and the
+difference is written with one DELETE and one executemany INSERT.
+
+The tags of the tracks of every album are also kept, with their counts, in
+AlbumTag, so album pages read them with one indexed lookup instead of a
+DISTINCT over the TaggedItem rows of all its tracks. update_tags_bulk
+recomputes the rows of the albums it touches; single TaggedItem writes
+(Tag.objects.update_tags, the admin) update them through signals. The same
+goes for the tag clouds of jamendo.clouds. Within batched_refreshes, ie:
+while deleting an album and its tracks, those handlers only collect what
+they touch, and it is refreshed once at the end.
+
+Lists of objects showing their tags read them with prefetch_tags, or from
+a with_tags queryset, in one query instead of one per object.
+"""
+
+import threading
+from contextlib import contextmanager
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import F
+from django.db.models.query import QuerySet, ITER_CHUNK_SIZE
+
+from tagging import settings as tagging_settings
+from tagging.models import Tag, TaggedItem
+from tagging.utils import parse_tag_input
+
+from jamendo.bulk import chunks, insert_rows, delete_rows
+from jamendo.clouds import refresh_clouds
+from jamendo.counts import CountedQuerySet
+from jamendo.responses import invalidate_responses
+
+
+def normalize_tags(tags):
+    """
+    Returns the set of tag names for tags, either a tag input string (as
+    accepted by Tag.objects.update_tags) or a list of tag names.
+    """
+    if isinstance(tags, basestring):
+        names = parse_tag_input(tags)
+    else:
+        names = [name.strip() for name in tags]
+    if tagging_settings.FORCE_LOWERCASE_TAGS:
+        names = [name.lower() for name in names]
+    return set([name[:tagging_settings.MAX_TAG_LENGTH]
+        for name in names if name])
+
+def get_tag_ids(names):
+    """
+    Returns a dict mapping every given tag name to its Tag pk, inserting the
+    missing tags with a single executemany.
+    """
+    tag_ids = {}
+    for names_chunk in chunks(names):
+        tag_ids.update(Tag.objects.filter(
+            name__in=names_chunk).values_list("name", "pk"))
+    missing = [name for name in names if name not in tag_ids]
+    if missing:
+        insert_rows(Tag, ("name", ), [(name, ) for name in missing])
+        for names_chunk in chunks(missing):
+            tag_ids.update(Tag.objects.filter(
+                name__in=names_chunk).values_list("name", "pk"))
+    return tag_ids
+
+def update_tags_bulk(model, pairs, clouds=True):
+    """
+    Sets the tags of many objects of model. pairs is an iterable of (object
+    or pk, tags) and tags is whatever normalize_tags accepts. Objects not in
+    pairs are left alone. The tag clouds of the changed tags are refreshed
+    too, unless clouds is False.
+
+    Returns a (added, removed) tuple with the number of TaggedItem rows
+    inserted and deleted.
+    """
+    ctype = ContentType.objects.get_for_model(model)
+    wanted = {}
+    for obj, tags in pairs:
+        wanted[getattr(obj, "pk", obj)] = normalize_tags(tags)
+    if not wanted:
+        return 0, 0
+
+    names = set()
+    for tag_names in wanted.itervalues():
+        names.update(tag_names)
+    tag_ids = get_tag_ids(names)
+
+    wanted_items = set()
+    for object_id, tag_names in wanted.iteritems():
+        for name in tag_names:
+            wanted_items.add((object_id, tag_ids[name]))
+
+    current_items = set()
+    obsolete = []
+    changed_tags = set()
+    for ids_chunk in chunks(wanted.keys()):
+        for pk, object_id, tag_id in TaggedItem.objects.filter(
+            content_type=ctype, object_id__in=ids_chunk).values_list(
+            "pk", "object_id", "tag"):
+            if (object_id, tag_id) in wanted_items:
+                current_items.add((object_id, tag_id))
+            else:
+                obsolete.append(pk)
+                changed_tags.add(tag_id)
+
+    new_items = wanted_items - current_items
+    changed_tags.update([tag_id for object_id, tag_id in new_items])
+    removed = delete_rows(TaggedItem, obsolete)
+    added = insert_rows(TaggedItem, ("tag", "content_type", "object_id"),
+        [(tag_id, ctype.pk, object_id) for object_id, tag_id in new_items])
+
+    from jamendo.models import Track
+    if model is Track and (added or removed):
+        album_ids = set()
+        for ids_chunk in chunks(wanted.keys()):
+            album_ids.update(Track.objects.filter(
+                pk__in=ids_chunk).values_list("album", flat=True))
+        refresh_album_tags(album_ids)
+    if clouds:
+        refresh_clouds(changed_tags)
+    invalidate_responses(model, Tag, TaggedItem)
+    return added, removed
+
+
+def refresh_album_tags(album_ids=None):
+    """
+    Recomputes the AlbumTag rows of the given album pks, or of every album
+    if album_ids is None, from the TaggedItem rows of their tracks.
+    """
+    from jamendo.models import Track, AlbumTag
+    qn = connection.ops.quote_name
+    values = {
+        "album_tag": qn(AlbumTag._meta.db_table),
+        "tagged_item": qn(TaggedItem._meta.db_table),
+        "track": qn(Track._meta.db_table),
+    }
+    insert = ("INSERT INTO %(album_tag)s (album_id, tag_id, count) "
+        "SELECT %(track)s.album_id, %(tagged_item)s.tag_id, COUNT(*) "
+        "FROM %(tagged_item)s INNER JOIN %(track)s "
+        "ON %(track)s.id = %(tagged_item)s.object_id "
+        "WHERE %(tagged_item)s.content_type_id = %%s" % values)
+    group_by = " GROUP BY %(track)s.album_id, %(tagged_item)s.tag_id" % values
+    ctype_id = ContentType.objects.get_for_model(Track).pk
+
+    cursor = connection.cursor()
+    if album_ids is None:
+        cursor.execute("DELETE FROM %(album_tag)s" % values)
+        cursor.execute(insert + group_by, [ctype_id])
+        return
+    for ids_chunk in chunks(album_ids):
+        placeholders = ", ".join(["%s"] * len(ids_chunk))
+        cursor.execute("DELETE FROM %s WHERE album_id IN (%s)" % (
+            values["album_tag"], placeholders), ids_chunk)
+        cursor.execute("%s AND %s.album_id IN (%s)%s" % (insert,
+            values["track"], placeholders, group_by), [ctype_id] + ids_chunk)
+
+
+def prefetch_tags(objects):
+    """
+    Reads the tags of objects, a list of instances of a same model, with a
+    single query (one per chunk of them) and attaches them to each one as
+    _prefetched_tags, where TaggedMixin.tags looks first. Returns objects.
+    """
+    if not objects:
+        return objects
+    ctype = ContentType.objects.get_for_model(objects[0])
+    tags = dict([(obj.pk, []) for obj in objects])
+    for ids_chunk in chunks(tags.keys()):
+        for item in TaggedItem.objects.filter(content_type=ctype,
+            object_id__in=ids_chunk).select_related("tag").order_by(
+            "tag__name"):
+            tags[item.object_id].append(item.tag)
+    for obj in objects:
+        obj._prefetched_tags = tags[obj.pk]
+    return objects
+
+class TaggedQuerySet(CountedQuerySet):
+    """
+    A QuerySet whose rows come with their tags, read with prefetch_tags for
+    every chunk of rows fetched. Make one with with_tags(); it keeps the
+    list_count of a counted queryset.
+    """
+
+    def iterator(self):
+        rows = []
+        for obj in super(TaggedQuerySet, self).iterator():
+            rows.append(obj)
+            if len(rows) == ITER_CHUNK_SIZE:
+                for row in prefetch_tags(rows):
+                    yield row
+                rows = []
+        for row in prefetch_tags(rows):
+            yield row
+
+def with_tags(queryset):
+    """
+    Returns a copy of queryset whose rows come with their tags. Lists, ie: a
+    page of rows, get them right away.
+    """
+    if isinstance(queryset, QuerySet):
+        return queryset._clone(klass=TaggedQuerySet,
+            list_count=getattr(queryset, "list_count", None))
+    return prefetch_tags(list(queryset))
+
+
+_pending = threading.local()
+
+def _batch():
+    return getattr(_pending, "batch", None)
+
+@contextmanager
+def batched_refreshes():
+    """
+    Within it, the AlbumTag rows and clouds the signal handlers below would
+    refresh on every Track delete or TaggedItem write are only collected,
+    and refreshed once when it ends. Nested uses are part of the outer one.
+    """
+    if _batch() is not None:
+        yield
+        return
+    batch = _pending.batch = {"albums": set(), "tags": set(), "tracks": []}
+    try:
+        yield
+    finally:
+        _pending.batch = None
+    from jamendo.models import Track
+    ctype = ContentType.objects.get_for_model(Track)
+    for pks_chunk in chunks(batch["tracks"]):
+        batch["tags"].update(TaggedItem.objects.filter(content_type=ctype,
+            object_id__in=pks_chunk).values_list("tag", flat=True))
+    refresh_album_tags(list(batch["albums"]))
+    refresh_clouds(batch["tags"])
+
+
+def _track_album_id(item):
+    """
+    Returns the album pk of the track tagged by item, or None if item does
+    not tag a (still existing) track.
+    """
+    from jamendo.models import Track
+    if item.content_type_id != ContentType.objects.get_for_model(Track).pk:
+        return None
+    album_ids = Track.objects.filter(pk=item.object_id).values_list("album",
+        flat=True)
+    return album_ids and album_ids[0] or None
+
+def track_tag_added(sender, instance, created=False, **kwargs):
+    from jamendo.models import AlbumTag
+    album_id = created and _track_album_id(instance)
+    if not album_id:
+        return
+    if _batch() is not None:
+        _batch()["albums"].add(album_id)
+        return
+    if not AlbumTag.objects.filter(album=album_id,
+        tag=instance.tag_id).update(count=F("count") + 1):
+        AlbumTag.objects.create(album_id=album_id, tag_id=instance.tag_id,
+            count=1)
+
+def track_tag_removed(sender, instance, **kwargs):
+    from jamendo.models import AlbumTag
+    album_id = _track_album_id(instance)
+    if not album_id:
+        return
+    if _batch() is not None:
+        _batch()["albums"].add(album_id)
+        return
+    album_tags = AlbumTag.objects.filter(album=album_id, tag=instance.tag_id)
+    album_tags.update(count=F("count") - 1)
+    album_tags.filter(count__lte=0).delete()
+
+def track_deleted(sender, instance, **kwargs):
+    if _batch() is not None:
+        _batch()["albums"].add(instance.album_id)
+        _batch()["tracks"].append(instance.pk)
+        return
+    # the TaggedItem rows of a track are not deleted with it
+    refresh_album_tags([instance.album_id])
+    refresh_clouds(TaggedItem.objects.filter(
+        content_type=ContentType.objects.get_for_model(instance),
+        object_id=instance.pk).values_list("tag", flat=True))
+
+def tagged_item_changed(sender, instance, **kwargs):
+    if _batch() is not None:
+        _batch()["tags"].add(instance.tag_id)
+        return
+    refresh_clouds([instance.tag_id])
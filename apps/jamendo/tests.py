@@ -5,7 +5,52 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import BaseHTTPServer
+import SocketServer
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urlparse
+from StringIO import StringIO
+from datetime import datetime
+from decimal import Decimal
+from xml.dom import minidom
+
+from django.conf import settings
+from django.db import connection
+from django.http import Http404
 from django.test import TestCase
+from django.utils import simplejson
+
+from tagging.models import Tag, TaggedItem
+
+from jamendo.atom import StreamingAtomFeed, ValidationError
+from jamendo.api import JamendoClient, refresh, write_refreshed
+from jamendo.autocomplete import ModelPrefixIndex, TagPrefixIndex, normalize
+from jamendo.benchmark import DumpGenerator, BenchmarkFeed, BenchmarkItem,\
+    benchmark_import, benchmark_feed
+from jamendo.clouds import get_cloud, refresh_clouds, font_size
+from jamendo.counts import get_count, counted
+from jamendo.refresher import Refresher
+from jamendo.geo import encode, cell_ranges, cell_successor, cells_q,\
+    covering_cells, nearby, nearest, in_box
+from jamendo.dump import iter_artists, iter_artist_chunks, parse_artist_chunk
+from jamendo.feeds import AlbumsForFeed, feed
+from jamendo.importer import DumpImporter
+from jamendo.mirror import ImageMirror, Image
+from jamendo.pagination import paginate_by_cursor, iter_by_cursor,\
+    encode_cursor, InvalidCursor
+from jamendo.resolvers import KeyResolver, UidResolver
+from jamendo import responses
+from jamendo.responses import invalidate_responses
+from jamendo.search import search, get_backend, SqliteSearchBackend
+from jamendo.tags import refresh_album_tags, prefetch_tags, with_tags
+from jamendo.models import Artist, Album, Track, Genre, Country,\
+    State, City, ImportCheckpoint, AlbumTag, CloudTag
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +66,1313 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+def logged_queries(func, *args, **kwargs):
+    """
+    Returns the result of func(*args, **kwargs) and the list of the queries
+    it ran (since the last request it made started, if any).
+    """
+    old_debug, settings.DEBUG = settings.DEBUG, True
+    connection.queries = []
+    try:
+        return func(*args, **kwargs), connection.queries
+    finally:
+        settings.DEBUG = old_debug
+
+
+SAMPLE_DUMP = """<?xml version="1.0" encoding="UTF-8"?>
+<JamendoData>
+<Artists>
+<artist>
+    <id>338</id><name>Both</name><url>http://www.jamendo.com/artist/both</url>
+    <mbgid></mbgid><image>http://img.jamendo.com/artists/b/both.jpg</image>
+    <location>
+        <country>FRA</country><state>16</state><city>Angoul\xc3\xaame</city>
+        <latitude>45.65</latitude><longitude>0.156</longitude>
+    </location>
+    <Albums>
+    <album>
+        <id>33</id><name>Simple Exercice</name>
+        <url>http://www.jamendo.com/album/33</url>
+        <releasedate>2004-12-28T21:10:15+01:00</releasedate>
+        <filename>Both - Simple Exercice</filename><id3genre>17</id3genre>
+        <license_artwork>http://creativecommons.org/licenses/by-nc-nd/2.0/</license_artwork>
+        <Tracks>
+        <track>
+            <id>241</id><name>Simple Exercice</name><duration>197</duration>
+            <numalbum>1</numalbum><filename>01 - Simple Exercice</filename>
+            <id3genre>17</id3genre>
+            <license>http://creativecommons.org/licenses/by-nc-nd/2.0/</license>
+            <Tags><tag><idstr>rock</idstr><weight>0.5</weight></tag></Tags>
+        </track>
+        <track>
+            <id>242</id><name>Tout va bien</name><duration>203</duration>
+            <numalbum>2</numalbum><filename>02 - Tout va bien</filename>
+            <id3genre>17</id3genre>
+            <license>http://creativecommons.org/licenses/by-sa/2.0/</license>
+        </track>
+        </Tracks>
+    </album>
+    </Albums>
+</artist>
+<artist>
+    <id>339</id><name>Nobody</name><url>http://www.jamendo.com/artist/nobody</url>
+    <location><country>FRA</country><state>16</state><city>Cognac</city></location>
+    <Albums></Albums>
+</artist>
+</Artists>
+</JamendoData>
+"""
+
+def sample_dump():
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode="wb")
+    gz.write(SAMPLE_DUMP)
+    gz.close()
+    return gzip.GzipFile(fileobj=StringIO(buf.getvalue()), mode="rb")
+
+class DumpImportTest(TestCase):
+    def test_parse(self):
+        artists = list(iter_artists(sample_dump()))
+        self.assertEqual([artist["uid"] for artist in artists], [338, 339])
+        album = artists[0]["albums"][0]
+        self.assertEqual(album["track_count"], 2)
+        self.assertEqual(album["duration"], 400)
+        self.assertEqual(album["tracks"][0]["tags"], [(u"rock", 0.5)])
+        self.assertEqual(artists[0]["city"], u"Angoul\xeame")
+
+    def test_import(self):
+        counts = DumpImporter(batch_size=1, verbosity=0).run(sample_dump())
+        self.assertEqual(counts["Artist"], 2)
+        self.assertEqual(counts["Track"], 2)
+        self.assertEqual(counts["License"], 2)
+        self.assertEqual(counts["City"], 2)
+        self.assertEqual(counts["State"], 1)
+
+        track = Track.objects.get(uid=242)
+        self.assertEqual(track.artist.uid, 338)
+        self.assertEqual(track.album.uid, 33)
+        self.assertEqual(track.license.license_class, u"by-sa")
+        self.assertEqual(track.genre.name, u"Rock")
+        artist = Artist.objects.get(uid=338)
+        self.assertEqual(artist.city.state.country.code, u"FRA")
+        self.assertEqual(artist.city.name, u"Angoul\xeame")
+
+        # importing it again must not duplicate anything
+        counts = DumpImporter(verbosity=0).run(sample_dump())
+        self.assertEqual(sum(counts.values()), 0)
+        self.assertEqual(Track.objects.count(), 2)
+
+    def test_parallel_import(self):
+        chunks = list(iter_artist_chunks(sample_dump(), 1, block_size=64))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual([artist["uid"] for artist in
+            parse_artist_chunk(chunks[1])], [339])
+        chunks = list(iter_artist_chunks(sample_dump(), 10, skip=1))
+        self.assertEqual([artist["uid"] for artist in
+            parse_artist_chunk(chunks[0])], [339])
+
+        importer = DumpImporter(batch_size=1, verbosity=0)
+        counts = importer.run_parallel(sample_dump(), processes=2)
+        self.assertEqual(counts["Artist"], 2)
+        self.assertEqual(counts["Track"], 2)
+        self.assertEqual(Track.objects.get(uid=242).album.uid, 33)
+
+    def test_resume(self):
+        importer = DumpImporter(batch_size=1, checkpoint="dump", verbosity=0)
+        write_artists = importer.write_artists
+        def failing_write_artists(artists, now):
+            if artists[0]["uid"] == 339:
+                raise IOError("disk full")
+            write_artists(artists, now)
+        importer.write_artists = failing_write_artists
+        self.assertRaises(IOError, importer.run, sample_dump())
+        checkpoint = ImportCheckpoint.objects.get(name="dump")
+        self.assertEqual((checkpoint.artists, checkpoint.tracks,
+            checkpoint.finished), (1, 2, False))
+        self.assertEqual(Artist.objects.count(), 1)
+
+        # the second time everything has been written already
+        for processes, new_artists in ((0, 1), (2, 0)):
+            importer = DumpImporter(batch_size=1, checkpoint="dump",
+                resume=True, verbosity=0)
+            if processes:
+                counts = importer.run_parallel(sample_dump(), processes)
+            else:
+                counts = importer.run(sample_dump())
+            self.assertEqual(counts["Artist"], new_artists)
+            self.assertEqual(counts["Track"], 0)
+            self.assertEqual(counts["TaggedItem"], 0)
+            self.failUnless(ImportCheckpoint.objects.get(name="dump").finished)
+        self.assertEqual(Artist.objects.count(), 2)
+
+    def test_delta_import(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        untouched = Track.objects.get(uid=241).modified_at
+
+        changed = SAMPLE_DUMP.replace("Tout va bien", "Tout va mal")
+        changed = changed.replace("<id>339</id>", "<id>340</id>")
+        importer = DumpImporter(delta=True, verbosity=0)
+        importer.run(StringIO(changed))
+        self.assertEqual(importer.counts["Artist"], 1)
+        self.assertEqual(importer.updated["Track"], 1)
+        self.assertEqual(importer.updated["Album"], 0)
+        self.assertEqual(importer.deleted["Artist"], 1)
+        self.assertEqual(Track.objects.get(uid=242).name, u"Tout va mal")
+        self.assertEqual(Track.objects.get(uid=241).modified_at, untouched)
+        self.assertEqual(list(Artist.objects.order_by("uid").values_list(
+            "uid", flat=True)), [338, 340])
+
+    def test_delta_move(self):
+        DumpImporter(verbosity=0).run(StringIO(self.album_dump(1)))
+        dump = self.album_dump(1)
+        # track 242 moves to album 34, the albums of artist 338 to 339 and
+        # artist 338 goes away
+        start = dump.index("<track>\n            <id>242")
+        end = dump.index("</track>", start) + len("</track>")
+        track = dump[start:end]
+        dump = dump[:start] + dump[end:]
+        dump = dump.replace("</Tracks></album>", track + "</Tracks></album>")
+        start = dump.index("<artist>")
+        end = dump.index("</artist>", start) + len("</artist>")
+        artist = dump[start:end]
+        dump = dump[:start] + dump[end:]
+        albums = artist[artist.index("<Albums>"):
+            artist.index("</Albums>") + len("</Albums>")]
+        dump = dump.replace("<Albums></Albums>", albums)
+
+        importer = DumpImporter(delta=True, verbosity=0)
+        importer.run(StringIO(dump))
+        self.assertEqual(importer.updated["Album"], 2)
+        self.assertEqual(importer.updated["Track"], 3)
+        self.assertEqual(importer.deleted["Artist"], 1)
+        self.assertEqual(list(Album.objects.order_by("uid").values_list(
+            "uid", "artist__uid")), [(33, 339), (34, 339)])
+        self.assertEqual(list(Track.objects.order_by("uid").values_list(
+            "uid", "album__uid", "artist__uid")),
+            [(241, 33, 339), (242, 34, 339), (1000, 34, 339)])
+        self.assertEqual(list(Artist.objects.values_list("uid", flat=True)),
+            [339])
+
+    def album_dump(self, tracks):
+        """
+        Returns the sample dump with a second album of tracks tagged tracks.
+        """
+        track_tpl = ("<track><id>%d</id><name>track %d</name>"
+            "<duration>60</duration><numalbum>%d</numalbum>"
+            "<filename>track</filename><id3genre>17</id3genre><license>"
+            "http://creativecommons.org/licenses/by-sa/2.0/</license>"
+            "<Tags><tag><idstr>pop</idstr><weight>0.5</weight></tag>"
+            "</Tags></track>")
+        album = ("<album><id>34</id><name>Other</name>"
+            "<url>http://www.jamendo.com/album/34</url>"
+            "<filename>Both - Other</filename><id3genre>17</id3genre>"
+            "<Tracks>%s</Tracks></album>" % "".join([track_tpl % (uid, uid,
+            uid) for uid in range(1000, 1000 + tracks)]))
+        return SAMPLE_DUMP.replace("</album>", "</album>" + album, 1)
+
+    def test_delta_delete(self):
+        queries = []
+        # the first run fills the content type cache
+        for tracks in (1, 5, 30):
+            Track.objects.all().delete()
+            Album.objects.all().delete()
+            TaggedItem.objects.all().delete()
+            DumpImporter(verbosity=0).run(StringIO(self.album_dump(tracks)))
+            self.assertEqual(TaggedItem.objects.count(), tracks + 1)
+            self.assertEqual(AlbumTag.objects.count(), 2)
+
+            importer = DumpImporter(delta=True, verbosity=0)
+            queries.append(len(logged_queries(importer.run,
+                sample_dump())[1]))
+            self.assertEqual(importer.deleted["Album"], 1)
+            self.assertEqual(importer.deleted["Track"], tracks)
+            self.assertEqual(importer.deleted["TaggedItem"], tracks)
+            # no orphaned tags are left
+            self.assertEqual(list(TaggedItem.objects.values_list("tag__name",
+                flat=True)), [u"rock"])
+            self.assertEqual(list(AlbumTag.objects.values_list("album__uid",
+                "tag__name")), [(33, u"rock")])
+            self.assertEqual(get_cloud(Track).get().name, u"rock")
+        # deletes are set-wise
+        self.assertEqual(queries[1], queries[2])
+
+class ArtistCountriesTest(TestCase):
+    urls = "jamendo.urls"
+
+    def setUp(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        self.artist = Artist.objects.get(uid=338)
+        self.spain = Country.objects.create(code=u"ESP", numcode=724,
+            name=u"Spain", printable_name=u"Spain")
+
+    def artist_counts(self):
+        return dict(Country.objects.values_list("code", "artist_count"))
+
+    def test_import(self):
+        self.assertEqual(self.artist.country_id, u"FRA")
+        self.assertEqual(self.artist_counts(), {u"FRA": 2, u"ESP": 0})
+
+    def test_state_moved(self):
+        state = self.artist.city.state
+        state.country = self.spain
+        state.save()
+        self.assertEqual(Artist.objects.get(uid=338).country_id, u"ESP")
+        self.assertEqual(self.artist_counts(), {u"FRA": 0, u"ESP": 2})
+
+    def test_artist_moved(self):
+        state = State.objects.create(code=u"01", name=u"Alava",
+            country=self.spain)
+        self.artist.city = City.objects.create(name=u"Vitoria", state=state)
+        self.artist.save()
+        self.assertEqual(self.artist.country_id, u"ESP")
+        self.assertEqual(self.artist_counts(), {u"FRA": 1, u"ESP": 1})
+        self.artist.delete()
+        self.assertEqual(self.artist_counts(), {u"FRA": 1, u"ESP": 0})
+
+    def test_city_cleared(self):
+        self.artist.city = None
+        self.artist.save()
+        self.assertEqual(Artist.objects.get(uid=338).country_id, None)
+        self.assertEqual(self.artist_counts(), {u"FRA": 1, u"ESP": 0})
+
+    def test_city_without_state(self):
+        self.artist.city = City.objects.create(name=u"Nowhere")
+        self.artist.save()
+        self.assertEqual(Artist.objects.get(uid=338).country_id, None)
+        self.assertEqual(self.artist_counts(), {u"FRA": 1, u"ESP": 0})
+
+    def test_state_cleared(self):
+        city = self.artist.city
+        city.state = None
+        city.save()
+        self.assertEqual(Artist.objects.get(uid=338).country_id, None)
+        self.assertEqual(self.artist_counts(), {u"FRA": 1, u"ESP": 0})
+
+    def test_views(self):
+        response = self.client.get("/countries/FRA/")
+        self.assertContains(response, self.artist.name)
+        response = self.client.get("/countries/")
+        self.assertContains(response, "(2 artists)")
+
+
+class GeoTest(TestCase):
+    urls = "jamendo.urls"
+
+    def setUp(self):
+        for uid, name, latitude, longitude in (
+            (1, u"Paris", "48.8566", "2.3522"),
+            (2, u"London", "51.5074", "-0.1278"),
+            (3, u"Tokyo", "35.6762", "139.6503"),
+            (4, u"Taveuni", "-16.85", "179.95"),
+            (5, u"Samoa", "-16.85", "-179.95")):
+            Artist.objects.create(uid=uid, name=name,
+                url=u"http://www.jamendo.com/artist/%d" % uid,
+                latitude=Decimal(latitude), longitude=Decimal(longitude))
+
+    def names(self, artists):
+        return [artist.name for artist in artists]
+
+    def test_geohash(self):
+        self.assertEqual(encode(57.64911, 10.40744), "u4pruydqq")
+        self.assertEqual(Artist.objects.get(uid=1).geocell[:5], "u09tv")
+        self.assertEqual(cell_ranges(["u3", "u0", "u1"]),
+            [("u0", "u1"), ("u3", "u3")])
+        self.assertTrue(len(covering_cells(40, -5, 52, 10)) <= 16)
+
+    def test_cell_successor(self):
+        self.assertEqual(cell_successor("u4pr"), "u4ps")
+        self.assertEqual(cell_successor("u4pz"), "u4q")
+        self.assertEqual(cell_successor("zz"), None)
+        # cells at the end of their ranges
+        Artist.objects.filter(uid=1).update(geocell="u4pzzzzzz")
+        Artist.objects.filter(uid=2).update(geocell="zzzzzzzzz")
+        Artist.objects.filter(uid=3).update(geocell="u4q000000")
+        self.assertEqual(self.names(Artist.objects.filter(
+            cells_q(["u4py", "u4pz"])).order_by("uid")), [u"Paris"])
+        self.assertEqual(self.names(Artist.objects.filter(
+            cells_q(["zz"]))), [u"London"])
+
+    def test_nearby(self):
+        artists = nearby(Artist.objects.all(), 48.85, 2.35, 400)
+        self.assertEqual(self.names(artists), [u"Paris", u"London"])
+        self.assertTrue(340 < artists[1].distance < 345)
+        self.assertEqual(self.names(nearby(Artist.objects.all(), 48.85,
+            2.35, 100)), [u"Paris"])
+
+    def test_nearest(self):
+        self.assertEqual(self.names(nearest(Artist.objects.all(), 35.0,
+            135.0, 2)), [u"Tokyo", u"Taveuni"])
+        # across the antimeridian
+        self.assertEqual(self.names(nearest(Artist.objects.all(), -16.85,
+            -179.99, 2)), [u"Samoa", u"Taveuni"])
+        self.assertEqual(self.names(nearest(Artist.objects.all(), 48.85,
+            2.35, 3)), [u"Paris", u"London", u"Tokyo"])
+        # fewer artists than asked for
+        self.assertEqual(len(nearest(Artist.objects.all(), 48.85, 2.35, 10)),
+            5)
+        self.assertEqual(list(Artist.objects.filter(cells_q([]))), [])
+
+    def test_in_box(self):
+        self.assertEqual(self.names(in_box(Artist.objects.order_by("uid"),
+            45, -5, 55, 5)), [u"Paris", u"London"])
+        self.assertEqual(self.names(in_box(Artist.objects.order_by("uid"),
+            -20, 179, -10, -179)), [u"Taveuni", u"Samoa"])
+
+    def test_view(self):
+        response = self.client.get("/artists/nearby/", {"lat": "48.85",
+            "lon": "2.35", "radius": "400", "format": "json"})
+        self.assertEqual([artist["name"] for artist in
+            simplejson.loads(response.content)], [u"Paris", u"London"])
+        response = self.client.get("/artists/nearby/", {"lat": "48.85",
+            "lon": "2.35", "limit": "1"})
+        self.assertContains(response, u"Paris")
+        self.assertNotContains(response, u"London")
+        for params in ({"lat": "north"},
+            {"lat": "48.85", "lon": "2.35", "radius": "-1"},
+            {"lat": "48.85", "lon": "2.35", "radius": "0"},
+            {"lat": "48.85", "lon": "2.35", "limit": "0"},
+            {"bbox": "40,0,50,2", "limit": "-3"}):
+            response = self.client.get("/artists/nearby/", params)
+            self.assertEqual(response.status_code, 400)
+
+
+class ResolversTest(TestCase):
+    def test_uid_resolver(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        pk = Artist.objects.get(uid=339).pk
+        artists = UidResolver(Artist, fingerprints=True).load()
+        self.failUnless(338 in artists)
+        self.assertEqual(artists.get(339), pk)
+        self.assertEqual(len(artists.get_fingerprint(339)), 40)
+        self.assertEqual(artists.get(1), None)
+
+        artists.add(1, 10)
+        artists.set_fingerprint(1, "ab" * 20)
+        artists.remove(338)
+        artists.compact()
+        self.assertEqual(list(artists), [1, 339])
+        self.assertEqual(artists[1], 10)
+        self.assertEqual(artists.get_fingerprint(1), "ab" * 20)
+        self.assertEqual(artists.get(339), pk)
+
+    def test_key_resolver(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        states = KeyResolver(State, ("code", "country")).load()
+        self.assertEqual(states.get((u"16", u"FRA")),
+            State.objects.get(code=u"16").pk)
+        self.failIf((u"16", u"ARG") in states)
+
+    def test_no_per_row_queries(self):
+        queries = logged_queries(DumpImporter(batch_size=1000,
+            verbosity=0).run, sample_dump())[1]
+        more_queries = logged_queries(DumpImporter(batch_size=1000,
+            verbosity=0).run, StringIO(SAMPLE_DUMP.replace("<Artists>",
+                "<Artists>" + "".join(["<artist><id>%d</id></artist>" % uid
+                    for uid in range(1000, 1100)]))))[1]
+        self.failUnless(len(more_queries) <= len(queries))
+
+class BulkTagsTest(TestCase):
+    def test_update_tags_bulk(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        first, second = Track.objects.order_by("uid")
+        self.assertEqual([tag.name for tag in first.tags], [u"rock"])
+
+        added, removed = Track.set_tags_bulk([(first, u"rock pop"),
+            (second.pk, [u"jazz"])])
+        self.assertEqual((added, removed), (2, 0))
+        self.assertEqual([tag.name for tag in first.tags], [u"pop", u"rock"])
+
+        added, removed = Track.set_tags_bulk([(first, [u"jazz"])])
+        self.assertEqual((added, removed), (1, 2))
+        self.assertEqual([tag.name for tag in first.tags], [u"jazz"])
+        self.assertEqual([tag.name for tag in second.tags], [u"jazz"])
+        self.assertEqual(Tag.objects.filter(name=u"jazz").count(), 1)
+
+
+class PrefetchTagsTest(TestCase):
+
+    def setUp(self):
+        for uid in range(1, 5):
+            artist = Artist.objects.create(uid=uid, name=u"artist %d" % uid,
+                url=u"http://www.jamendo.com/artist/%d" % uid)
+            artist.tags = u" ".join([u"tag%d" % i for i in range(uid)])
+
+    def test_prefetch(self):
+        artists = list(Artist.objects.order_by("uid"))
+        def read_tags():
+            prefetch_tags(artists)
+            return [[tag.name for tag in artist.tags] for artist in artists]
+        tags, queries = logged_queries(read_tags)
+        self.assertEqual(tags,
+            [[u"tag0"], [u"tag0", u"tag1"], [u"tag0", u"tag1", u"tag2"],
+            [u"tag0", u"tag1", u"tag2", u"tag3"]])
+        self.assertEqual(len(queries), 1)
+
+        artists = with_tags(Artist.objects.all()).order_by("uid")[1:3]
+        lengths, queries = logged_queries(lambda: [len(artist.tags)
+            for artist in artists])
+        self.assertEqual(lengths, [2, 3])
+        self.assertEqual(len(queries), 2)
+
+        artist = artists[0]
+        artist.tags = u"other"
+        self.assertEqual([tag.name for tag in artist.tags], [u"other"])
+
+
+class AlbumTagsTest(TestCase):
+    def setUp(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        self.album = Album.objects.get(uid=33)
+        self.first, self.second = Track.objects.order_by("uid")
+
+    def album_tags(self):
+        return [(album_tag.tag.name, album_tag.count) for album_tag in
+            AlbumTag.objects.filter(album=self.album).order_by("tag__name")]
+
+    def test_import(self):
+        self.assertEqual(self.album_tags(), [(u"rock", 1)])
+        self.assertEqual([tag.name for tag in self.album.get_tags()],
+            [u"rock"])
+
+    def test_bulk(self):
+        Track.set_tags_bulk([(self.first, u"rock pop"),
+            (self.second, u"jazz")])
+        self.assertEqual(self.album_tags(),
+            [(u"jazz", 1), (u"pop", 1), (u"rock", 1)])
+
+    def test_signals(self):
+        self.first.tags = u"rock pop"
+        self.second.tags = u"pop"
+        self.assertEqual(self.album_tags(), [(u"pop", 2), (u"rock", 1)])
+        self.first.delete()
+        self.assertEqual(self.album_tags(), [(u"pop", 1)])
+
+    def test_refresh(self):
+        AlbumTag.objects.all().delete()
+        refresh_album_tags()
+        self.assertEqual(self.album_tags(), [(u"rock", 1)])
+
+    def delete_album(self, tracks):
+        album = Album.objects.create(uid=34, name=u"Other",
+            artist=self.album.artist)
+        for uid in range(tracks):
+            track = Track.objects.create(uid=1000 + uid, album=album,
+                artist=album.artist, name=u"track %d" % uid)
+            track.tags = u"pop jazz"
+        queries = logged_queries(album.delete)[1]
+        return len([query for query in queries
+            if "albumtag" in query["sql"] or "cloudtag" in query["sql"]])
+
+    def test_delete(self):
+        # AlbumTag rows and clouds are refreshed once, whatever the tracks
+        self.assertEqual(self.delete_album(2), self.delete_album(6))
+        self.assertEqual(AlbumTag.objects.exclude(album=self.album).count(), 0)
+        self.assertEqual([tag.name for tag in get_cloud(Track)], [u"rock"])
+
+
+class TagCloudTest(TestCase):
+    urls = "jamendo.urls"
+
+    def setUp(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        self.first, self.second = Track.objects.order_by("uid")
+
+    def cloud(self, model):
+        return [(tag.name, tag.count, tag.font_size)
+            for tag in get_cloud(model)]
+
+    def test_import(self):
+        self.assertEqual(self.cloud(Track), [(u"rock", 1, 1)])
+        self.assertEqual(self.cloud(Album), [(u"rock", 1, 1)])
+        self.assertEqual(self.cloud(Artist), [])
+
+    def test_tag_writes(self):
+        self.second.tags = u"rock pop"
+        Artist.objects.get(uid=338).tags = u"french"
+        self.assertEqual(self.cloud(Track), [(u"pop", 1, 1), (u"rock", 2, 4)])
+        self.assertEqual(self.cloud(Album), [(u"pop", 1, 1), (u"rock", 1, 1)])
+        self.assertEqual(self.cloud(Artist), [(u"french", 1, 1)])
+
+        Track.set_tags_bulk([(self.first, u"pop"), (self.second, u"pop")])
+        self.assertEqual(self.cloud(Track), [(u"pop", 2, 1)])
+        self.second.delete()
+        self.assertEqual(self.cloud(Track), [(u"pop", 1, 1)])
+
+    def test_rebuild(self):
+        CloudTag.objects.all().delete()
+        refresh_clouds()
+        self.assertEqual(self.cloud(Track), [(u"rock", 1, 1)])
+
+    def test_font_size(self):
+        self.assertEqual([font_size(count, 1, 100) for count in (1, 5, 30,
+            100)], [1, 2, 3, 4])
+
+    def test_view(self):
+        self.second.tags = u"pop"
+        response = self.client.get("/tags_cloud/tracks/")
+        self.assertContains(response, 'class="size1">pop<')
+        self.assertContains(response, 'class="size1">rock<')
+
+class StubJamendoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers get2 requests like /get2/id+name+image/album/xml/?id=33+34 with
+    made up "<unit> <uid>" names and image urls.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type="text/xml", headers=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        path, query = urlparse.urlsplit(self.path)[2:4]
+        fields, unit = path.split("/")[2:4]
+        uids = urlparse.parse_qs(query)["id"][0].split(" ")
+        body = ["<data>"]
+        for uid in uids:
+            body.append("<%s>" % unit)
+            for field in fields.split("+"):
+                if field == "id":
+                    value = uid
+                elif field == "image":
+                    value = "http://img.jamendo.com/%s/%s.jpg" % (unit, uid)
+                else:
+                    value = "%s %s" % (unit, uid)
+                body.append("<%s>%s</%s>" % (field, value, field))
+            body.append("</%s>" % unit)
+        body.append("</data>")
+        self.send_body("".join(body))
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+    BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class StubServer(object):
+    """
+    Runs handler in a local HTTP server, in a background thread.
+    """
+    def __init__(self, handler=StubJamendoHandler):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.connections = 0
+        self.server.paths = []
+        self.url = "http://127.0.0.1:%d" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JamendoClientTest(TestCase):
+    def setUp(self):
+        self.stub = StubServer()
+        self.client = JamendoClient(self.stub.url + "/get2/", rate_limit=None,
+            batch_size=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.stub.stop()
+
+    def test_batched_requests(self):
+        records = list(self.client.iter_units("album", ["id", "name"],
+            [1, 2, 3, 4, 5]))
+        self.assertEqual([record["name"].text for record in records],
+            ["album %d" % uid for uid in range(1, 6)])
+        self.assertEqual(self.stub.server.paths[0],
+            "/get2/id+name/album/xml/?id=1+2&n=all")
+        self.assertEqual(len(self.stub.server.paths), 3)
+        # every request went through the same kept-alive connection
+        self.assertEqual(self.stub.server.connections, 1)
+
+    def test_rate_limit(self):
+        client = JamendoClient(self.stub.url + "/get2/", rate_limit=20,
+            batch_size=1)
+        start = time.time()
+        list(client.iter_units("album", ["id"], range(5)))
+        self.failUnless(time.time() - start >= 0.2)
+        client.close()
+
+    def test_refresh(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        untouched = Album.objects.get(uid=33).modified_at
+        self.assertEqual(refresh(Album, ["image"], [33], client=self.client), 1)
+        album = Album.objects.get(uid=33)
+        self.assertEqual(album.image, "http://img.jamendo.com/album/33.jpg")
+        self.failIf(album.modified_at == untouched)
+
+        # nothing changed this time, so only updated_at moves
+        modified_at, updated_at = album.modified_at, album.updated_at
+        refresh(Album, ["image"], [33], client=self.client)
+        album = Album.objects.get(uid=33)
+        self.assertEqual(album.modified_at, modified_at)
+        self.failUnless(album.updated_at > updated_at)
+
+    def test_write_empty_values(self):
+        artist = Artist.objects.create(uid=1, name=u"", image=u"",
+            url=u"http://www.jamendo.com/artist/1")
+        self.assertEqual(write_refreshed(Artist, ("name", "image", "url"),
+            {1: [None] * 3}), 1)
+        artist = Artist.objects.get(pk=artist.pk)
+        self.assertEqual((artist.name, artist.image, artist.url),
+            (u"", u"", u"http://www.jamendo.com/artist/1"))
+
+
+class RefresherTest(TestCase):
+    def setUp(self):
+        self.stub = StubServer()
+        self.client = JamendoClient(self.stub.url + "/get2/", rate_limit=None,
+            batch_size=1)
+
+    def tearDown(self):
+        self.client.close()
+        self.stub.stop()
+
+    def test_stalest_first(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        Artist.objects.filter(uid=338).update(updated_at=None)
+        Artist.objects.filter(uid=339).update(updated_at=datetime(2009, 1, 1))
+        refresher = Refresher(jobs=((Artist, ("name", ), "album_count"), ),
+            concurrency=1, client=self.client, verbosity=0)
+        self.assertEqual(refresher.run(limit=10), 2)
+        self.assertEqual(self.stub.server.paths, [
+            "/get2/id+name/artist/xml/?id=338&n=all",
+            "/get2/id+name/artist/xml/?id=339&n=all"])
+        self.assertEqual(Artist.objects.get(uid=339).name, u"artist 339")
+
+    def test_concurrency_and_limit(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        refresher = Refresher(concurrency=3, client=self.client, verbosity=0)
+        # one artist, one album and one track
+        self.assertEqual(refresher.run(limit=1), 3)
+        self.assertEqual(refresher.errors, 0)
+        self.assertEqual(Track.objects.filter(name__startswith="track").count(), 1)
+
+    def test_run_forever(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        refresher = Refresher(concurrency=1, client=self.client, verbosity=0)
+        refreshed = Artist.objects.count() + Album.objects.count() +\
+            Track.objects.count()
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append((seconds, refresher.refreshed))
+            if len(sleeps) == 2:
+                raise KeyboardInterrupt
+        original, time.sleep = time.sleep, sleep
+        try:
+            self.assertRaises(KeyboardInterrupt, refresher.run_forever,
+                limit=10, poll_interval=5)
+        finally:
+            time.sleep = original
+        # the second pass only finds rows refreshed by the first one, the
+        # third starts over after a pause
+        self.assertEqual(sleeps, [(5, refreshed), (5, refreshed * 2)])
+
+
+class StubImageHandler(StubJamendoHandler):
+    """
+    Serves made up images at /<uid>.jpg, with an ETag, and answers 304 to
+    If-None-Match requests. /404.jpg is missing.
+    """
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        uid = self.path.strip("/").split(".")[0]
+        if uid == "404":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag = '"%s"' % uid
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        image = StringIO()
+        if Image is not None:
+            Image.new("RGB", (200, 200)).save(image, "JPEG")
+        else:
+            image.write("image %s" % uid)
+        self.send_body(image.getvalue(), "image/jpeg", {"ETag": etag})
+
+
+class ImageMirrorTest(TestCase):
+    def setUp(self):
+        self.stub = StubServer(StubImageHandler)
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.stub.stop()
+        shutil.rmtree(self.root)
+
+    def test_mirror(self):
+        images = [(uid, "%s/%d.jpg" % (self.stub.url, uid))
+            for uid in (33, 34, 404)]
+        mirror = ImageMirror("albums", root=self.root, workers=2, verbosity=0)
+        self.assertEqual(mirror.run(images),
+            {"downloaded": 2, "unchanged": 0, "failed": 1})
+        self.assert_(os.path.exists(os.path.join(self.root, "albums", "33.jpg")))
+        if Image is not None:
+            thumbnail = Image.open(os.path.join(self.root, "albums", "50x50",
+                "34.jpg"))
+            self.assertEqual(thumbnail.size, (50, 50))
+
+        # the etags are remembered, nothing is downloaded again
+        mirror = ImageMirror("albums", root=self.root, workers=2, verbosity=0)
+        self.assertEqual(mirror.run(images),
+            {"downloaded": 0, "unchanged": 2, "failed": 1})
+
+        os.remove(os.path.join(self.root, "albums", "34.jpg"))
+        mirror = ImageMirror("albums", root=self.root, workers=2, verbosity=0)
+        self.assertEqual(mirror.run(images),
+            {"downloaded": 1, "unchanged": 1, "failed": 1})
+
+
+class BenchmarkTest(TestCase):
+    def test_generated_dump(self):
+        dump = StringIO()
+        artists, albums, tracks = DumpGenerator(300, seed=1).write(dump)
+        self.assertEqual(tracks, 300)
+        parsed = list(iter_artists(StringIO(dump.getvalue())))
+        self.assertEqual(len(parsed), artists)
+        self.assertEqual(sum([len(album["tracks"]) for artist in parsed
+            for album in artist["albums"]]), 300)
+
+        # same seed, same dump
+        other = StringIO()
+        DumpGenerator(300, seed=1).write(other)
+        self.assertEqual(other.getvalue(), dump.getvalue())
+
+        results = benchmark_import(StringIO(dump.getvalue()), batch_size=50)
+        self.assertEqual(results["rows"]["Track"], 300)
+        self.assertEqual(results["rows"]["Album"], albums)
+        self.assertEqual(Track.objects.count(), 300)
+        for stage in ("parse", "resolve", "build", "insert", "commit",
+            "tagging"):
+            self.assert_(stage in results["stages"])
+        self.assert_(results["peak_rss_kb"] > 0)
+
+    def test_feed(self):
+        items = [BenchmarkItem(pk, datetime.now()) for pk in range(3)]
+        plan_feed, reflection_feed = BenchmarkFeed(items), BenchmarkFeed(items)
+        reflection_feed.COMPILE_PLAN = False
+        for item in items:
+            self.assertEqual(plan_feed.get_item_params(item),
+                reflection_feed.get_item_params(item))
+        # attributes set on the instance win over the class plan
+        plan_feed = BenchmarkFeed(items)
+        plan_feed.item_title = lambda: u"title"
+        self.assertEqual(plan_feed.get_item_params(items[0])["title"],
+            u"title")
+
+        results = benchmark_feed(items=200, repeat=1)
+        for key in ("reflection", "plan", "speedup"):
+            self.assert_(results[key] > 0)
+
+
+class CursorPaginationTest(TestCase):
+    urls = "jamendo.urls"
+
+    def setUp(self):
+        # repeated names, so pks break the ties
+        for uid in range(1, 8):
+            Artist.objects.create(uid=uid, name=u"artist %d" % (uid / 2),
+                url=u"http://www.jamendo.com/artist/%d" % uid)
+        self.names = list(Artist.objects.order_by("name", "pk").values_list(
+            "name", "pk"))
+
+    def walk(self, queryset, per_page):
+        pages = []
+        page = paginate_by_cursor(queryset, ("name", "pk"), per_page)
+        pages.append(page)
+        while page.has_next():
+            page = paginate_by_cursor(queryset, ("name", "pk"), per_page,
+                after=page.next_cursor)
+            pages.append(page)
+        return pages
+
+    def test_paginate(self):
+        pages = self.walk(Artist.objects.all(), 3)
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual([(artist.name, artist.pk) for page in pages
+            for artist in page], self.names)
+        self.failIf(pages[0].has_previous())
+
+        # and back
+        page = paginate_by_cursor(Artist.objects.all(), ("name", "pk"), 3,
+            before=pages[2].previous_cursor)
+        self.assertEqual([artist.pk for artist in page],
+            [artist.pk for artist in pages[1]])
+        page = paginate_by_cursor(Artist.objects.all(), ("name", "pk"), 3,
+            before=page.previous_cursor)
+        self.assertEqual([artist.pk for artist in page],
+            [artist.pk for artist in pages[0]])
+        self.failIf(page.has_previous())
+        self.assert_(page.has_next())
+
+        self.assertRaises(InvalidCursor, paginate_by_cursor,
+            Artist.objects.all(), ("name", "pk"), 3, after="garbage")
+
+    def test_descending(self):
+        descending = []
+        page = paginate_by_cursor(Artist.objects.all(), ("-name", "-pk"), 4)
+        descending.extend(page)
+        page = paginate_by_cursor(Artist.objects.all(), ("-name", "-pk"), 4,
+            after=page.next_cursor)
+        descending.extend(page)
+        self.failIf(page.has_next())
+        self.assertEqual([(artist.name, artist.pk) for artist in descending],
+            list(reversed(self.names)))
+
+    def test_iter(self):
+        for chunk_size in (1, 3, 7, 10):
+            self.assertEqual([(artist.name, artist.pk) for artist in
+                iter_by_cursor(Artist.objects.all(), ("name", "pk"),
+                chunk_size)], self.names)
+        self.assertEqual([artist.pk for artist in iter_by_cursor(
+            Artist.objects.all(), ("-name", "-pk"), 2)],
+            [pk for name, pk in reversed(self.names)])
+
+    def test_view(self):
+        settings.ITEMS_PER_PAGE, old_per_page = 3, getattr(settings,
+            "ITEMS_PER_PAGE", 20)
+        try:
+            response = self.client.get("/artists/")
+            page = response.context["cursor_page"]
+            self.assertEqual(len(page), 3)
+            self.assertContains(response, "?after=%s" % page.next_cursor)
+            response = self.client.get("/artists/", {"after": page.next_cursor})
+            self.assertEqual([artist.pk for artist in
+                response.context["queryset"]],
+                [pk for name, pk in self.names[3:6]])
+            # empty cursors are ignored
+            for params in ({"after": ""}, {"before": ""}):
+                response = self.client.get("/artists/", params)
+                self.assertEqual([artist.pk for artist in
+                    response.context["queryset"]],
+                    [pk for name, pk in self.names[:3]])
+            response = self.client.get("/artists/", {"after": "garbage"})
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get("/artists/",
+                {"after": encode_cursor(["A05", "x"])})
+            self.assertEqual(response.status_code, 400)
+        finally:
+            settings.ITEMS_PER_PAGE = old_per_page
+
+
+class CountsTest(TestCase):
+    urls = "jamendo.urls"
+
+    def setUp(self):
+        for uid in range(1, 6):
+            Artist.objects.create(uid=uid, name=u"artist %d" % uid,
+                url=u"http://www.jamendo.com/artist/%d" % uid)
+
+    def test_cached_count(self):
+        count, queries = logged_queries(get_count, Artist.objects.all())
+        self.assertEqual((int(count), count.exact), (5, True))
+        self.assertEqual(len(queries), 1)
+        count, queries = logged_queries(get_count, Artist.objects.all())
+        self.assertEqual((int(count), len(queries)), (5, 0))
+
+        # writes start a new generation
+        Artist.objects.get(uid=5).delete()
+        self.assertEqual(int(get_count(Artist.objects.all())), 4)
+        Artist.objects.filter(uid=4).delete()
+        self.assertEqual(int(get_count(Artist.objects.all())), 3)
+        Artist.objects.filter(uid=3).update(name=u"other")
+        DumpImporter(verbosity=0).run(sample_dump())
+        self.assertEqual(int(get_count(Artist.objects.all())), 5)
+
+    def test_capped_count(self):
+        count = get_count(Artist.objects.filter(name__icontains="artist"),
+            exact=False, cap=10)
+        self.assertEqual((int(count), count.exact), (5, True))
+        count = get_count(Artist.objects.filter(name__icontains="artist"),
+            exact=False, cap=3)
+        self.failIf(count.exact)
+        self.assertEqual(int(count), 3)
+        self.assertEqual(unicode(count), u"more than 3")
+
+    def test_counted_queryset(self):
+        queryset = counted(Artist.objects.all(), get_count(Artist.objects.all()))
+        count, queries = logged_queries(queryset.count)
+        self.assertEqual((count, len(queries)), (5, 0))
+        self.assertEqual(queryset.filter(uid__lt=3).count(), 2)
+
+    def test_view(self):
+        response = self.client.get("/artists/", {"name": "artist"})
+        self.assertEqual(int(response.context["list_count"]), 5)
+        self.assertContains(response, "5 artists")
+
+
+class SearchTest(TestCase):
+    urls = "jamendo.urls"
+
+    def setUp(self):
+        for uid, name in enumerate((u"Both", u"Both Ways", u"Nobody",
+            u"Bothered Both", u"B\xe9la")):
+            Artist.objects.create(uid=uid + 1, name=name,
+                url=u"http://www.jamendo.com/artist/%d" % uid)
+
+    def names(self, query):
+        return [artist.name for artist in search(Artist.objects.all(), query)]
+
+    def test_search(self):
+        self.assertEqual(self.names(u"both")[-1], u"Both Ways")
+        self.assertEqual(set(self.names(u"both")),
+            set([u"Both", u"Both Ways", u"Bothered Both"]))
+        self.assertEqual(self.names(u"nobody"), [u"Nobody"])
+        self.assertEqual(self.names(u"nothing"), [])
+
+    def test_indexed(self):
+        if not isinstance(get_backend(), SqliteSearchBackend):
+            return
+        # rows written by bulk inserts, updates and deletes are indexed too
+        DumpImporter(verbosity=0).run(sample_dump())
+        self.assertEqual(self.names(u"nobody"), [u"Nobody", u"Nobody"])
+        Artist.objects.filter(uid=3).update(name=u"Somebody")
+        self.assertEqual(self.names(u"nobody"), [u"Nobody"])
+        Artist.objects.filter(uid=339).delete()
+        self.assertEqual(self.names(u"nobody"), [])
+        # prefixes and accents
+        self.assertEqual(self.names(u"bel"), [u"B\xe9la"])
+        self.assertEqual(self.names(u'bo" * (-'), self.names(u"bo"))
+
+    def test_view(self):
+        response = self.client.get("/artists/", {"name": "both"})
+        self.assertEqual(len(response.context["queryset"]), 3)
+        self.assertEqual(int(response.context["list_count"]), 3)
+        self.assertEqual(response.context["cursor_page"], None)
+
+
+class AutocompleteTest(TestCase):
+    urls = "jamendo.urls"
+
+    def setUp(self):
+        for uid, name, album_count in ((1, u"Both", 1), (2, u"Both Ways", 5),
+            (3, u"Nobody", 2), (4, u"B\xe9la", 3)):
+            Artist.objects.create(uid=uid, name=name, album_count=album_count,
+                url=u"http://www.jamendo.com/artist/%d" % uid)
+
+    def names(self, index, prefix):
+        return [name for pk, name in index.lookup(prefix)]
+
+    def test_lookup(self):
+        index = ModelPrefixIndex(Artist, "album_count")
+        self.assertEqual(normalize(u"  B\xe9la  Fleck "), u"bela fleck")
+        # the most popular first
+        self.assertEqual(self.names(index, u"b"), [u"Both Ways", u"B\xe9la",
+            u"Both"])
+        self.assertEqual(self.names(index, u"both w"), [u"Both Ways"])
+        self.assertEqual(self.names(index, u"WAY"), [u"Both Ways"])
+        self.assertEqual(self.names(index, u"bel"), [u"B\xe9la"])
+        self.assertEqual(self.names(index, u"x"), [])
+        self.assertEqual(self.names(index, u" "), [])
+
+    def test_no_queries(self):
+        index = ModelPrefixIndex(Artist, "album_count")
+        index.refresh()
+        self.assertEqual(len(logged_queries(self.names, index, u"bo")[1]), 0)
+
+    def test_refresh(self):
+        index = ModelPrefixIndex(Artist, "album_count", refresh_interval=0)
+        self.assertEqual(self.names(index, u"nob"), [u"Nobody"])
+        artist = Artist.objects.get(uid=3)
+        artist.name = u"Somebody"
+        artist.save()
+        # stale lookups answer from the current lists, refreshed later
+        later = []
+        index.refresh_later = lambda: later.append(True)
+        names, queries = logged_queries(self.names, index, u"nob")
+        self.assertEqual((names, len(queries), later), ([u"Nobody"], 0,
+            [True]))
+        index.refresh()
+        self.assertEqual(self.names(index, u"nob"), [])
+        self.assertEqual(self.names(index, u"some"), [u"Somebody"])
+        self.assertEqual(len(index.lookup(u"b")), 3)
+
+    def test_tags(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        index = TagPrefixIndex(refresh_interval=0)
+        index.refresh_later = lambda: None
+        self.assertEqual(self.names(index, u"ro"), [u"rock"])
+        self.assertEqual(self.names(index, u"po"), [])
+        track = Track.objects.get(uid=242)
+        track.tags = u"pop"
+        Artist.objects.get(uid=338).tags = u"pop"
+        index.refresh()
+        self.assertEqual(index.lookup(u"po"), [(Tag.objects.get(
+            name=u"pop").pk, u"pop")])
+        # weighted by the cloud counts: a track, its album and an artist
+        self.assertEqual(index.data[1][Tag.objects.get(name=u"pop").pk],
+            (u"pop", 3))
+
+    def test_view(self):
+        response = self.client.get("/autocomplete/artists/", {"q": u"bo"})
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual([item["name"] for item in
+            simplejson.loads(response.content)], [u"Both Ways", u"Both"])
+
+
+class ConditionalGetTest(TestCase):
+    urls = "jamendo.urls"
+
+    def setUp(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+
+    def test_show(self):
+        response = self.client.get("/albums/juid/33/")
+        etag = response["ETag"]
+        self.assertTrue(response.has_header("Last-Modified"))
+        response = self.client.get("/albums/juid/33/",
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, "")
+
+        album = Album.objects.get(uid=33)
+        album.name = u"Renamed"
+        album.save()
+        response = self.client.get("/albums/juid/33/",
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_show_other_process(self):
+        # as written by processes with their own caches: no new generation
+        for url, related in (("/albums/juid/33/", Track.objects.filter(
+            uid=242)), ("/artists/juid/338/", City.objects.all()),
+            ("/artists/juid/339/", Artist.objects.filter(uid=339))):
+            etag = self.client.get(url)["ETag"]
+            self.assertEqual(self.client.get(url,
+                HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            related.update(modified_at=datetime.now())
+            self.assertEqual(self.client.get(url,
+                HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_list(self):
+        etag = self.client.get("/artists/")["ETag"]
+        self.assertEqual(self.client.get("/artists/",
+            HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get("/artists/", {"name": "both"},
+            HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        Artist.objects.get(uid=338).delete()
+        self.assertEqual(self.client.get("/artists/",
+            HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_list_other_process(self):
+        etag = self.client.get("/artists/")["ETag"]
+        # as written by a process with its own cache: no new generation
+        Artist.objects.filter(uid=339).update(modified_at=datetime.now())
+        self.assertEqual(self.client.get("/artists/",
+            HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_response_cache(self):
+        responses.RESPONSE_CACHE = True
+        try:
+            content = self.client.get("/albums/juid/33/").content
+            response, queries = logged_queries(self.client.get,
+                "/albums/juid/33/")
+            self.assertEqual(response.content, content)
+            # only the one reading modified_at
+            self.assertEqual(len(queries), 1)
+
+            Track.objects.filter(uid=242).update(name=u"Renamed")
+            invalidate_responses(Track)
+            self.assertContains(self.client.get("/albums/juid/33/"),
+                u"Renamed")
+        finally:
+            responses.RESPONSE_CACHE = False
+
+
+class FeedsTest(TestCase):
+    urls = "jamendo.urls"
+
+    def setUp(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        self.artist = Artist.objects.get(uid=338)
+        for uid in range(40, 45):
+            Album.objects.create(uid=uid, name=u"album %d" % (84 - uid),
+                url=u"http://www.jamendo.com/album/%d" % uid,
+                filename=u"album", artist=self.artist)
+
+    def test_stream(self):
+        response = self.client.get("/feeds/albumsfor/%d/" % self.artist.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/atom+xml")
+        # the content is an iterator, it can be read only once
+        content = response.content
+        titles = [unicode(album).encode("utf-8") for album in
+            Album.objects.filter(artist=self.artist).order_by("name", "pk")]
+        positions = [content.index("<title>%s</title>" % title)
+            for title in titles]
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(content.count("<entry"), 6)
+        self.assert_(content.endswith("</feed>"))
+
+        self.artist.tags = u"french rock"
+        content = self.client.get("/feeds/artists/").content
+        self.assert_('<category term="french">' in content)
+
+        feed_dict = {"albumsfor": AlbumsForFeed}
+        self.assertRaises(Http404, feed, None, "albumsfor/0", feed_dict)
+        self.assertRaises(Http404, feed, None, "albumsfor", feed_dict)
+        self.assertRaises(Http404, feed, None, "nothing", feed_dict)
+
+    def test_conditional_get(self):
+        url = "/feeds/albumsfor/%d/" % self.artist.pk
+        response = self.client.get(url)
+        content, etag = response.content, response["ETag"]
+        updated = Album.objects.filter(artist=self.artist).latest(
+            "modified_at").modified_at
+        self.assert_("<updated>%s</updated>" % updated.strftime(
+            "%Y-%m-%dT%H:%M:%SZ") in content)
+        self.assertEqual(self.client.get(url,
+            HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # the document is cached
+        response, queries = logged_queries(self.client.get, url)
+        self.assertEqual(response.content, content)
+        # site, artist, feed updated
+        self.assertEqual(len(queries), 3)
+
+        album = Album.objects.get(uid=40)
+        album.name = u"Renamed"
+        album.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assert_("Renamed" in response.content)
+
+    def test_item_cache(self):
+        genre = Genre.objects.create(code=u"polka", name=u"Polka")
+        feed_instance = AlbumsForFeed("albumsfor", None)
+        album = Album.objects.get(uid=40)
+        content = feed_instance.render_item("jamendo/albums/feed.html", album)
+        Album.objects.filter(pk=album.pk).update(duration=3600)
+        album = Album.objects.get(pk=album.pk)
+        # same modified_at, still cached
+        self.assertEqual(feed_instance.render_item("jamendo/albums/feed.html",
+            album), content)
+        album.save()
+        self.assert_("60:00" in feed_instance.render_item(
+            "jamendo/albums/feed.html", album))
+
+        # genres are not part of the album row
+        Album.objects.filter(pk=album.pk).update(genre=genre)
+        album = Album.objects.get(pk=album.pk)
+        self.assert_("60:00" in feed_instance.render_item(
+            "jamendo/albums/feed.html", album))
+        self.failIf("Polka" in feed_instance.render_item(
+            "jamendo/albums/feed.html", album))
+        genre.save()
+        self.assert_("Polka" in feed_instance.render_item(
+            "jamendo/albums/feed.html", album))
+
+    def test_entries(self):
+        feedgen = AlbumsForFeed("albumsfor", None).get_feed(
+            str(self.artist.pk))
+        pieces = list(feedgen.iter_write("utf-8"))
+        # head, one piece per album and the end
+        self.assertEqual(len(pieces), 8)
+        self.assert_("<entry" not in pieces[0])
+        for piece in pieces[1:-1]:
+            self.assertEqual(piece.count("<entry"), 1)
+        self.assertEqual(pieces[-1], "</feed>")
+
+        # same document as the non streaming feed
+        plain = AlbumsForFeed("albumsfor", None).get_feed(str(self.artist.pk),
+            stream=False)
+        output = StringIO()
+        plain.write(output, "utf-8")
+        document = output.getvalue()
+        self.assertEqual(document[document.index("<entry"):],
+            "".join(pieces[1:]))
+
+    def test_invalid_entry(self):
+        now = datetime.now()
+        feedgen = StreamingAtomFeed(u"urn:feed", u"Feed", updated=now)
+        # no feed author, so entries must have one
+        feedgen.set_items([
+            dict(atom_id=u"urn:1", title=u"one", updated=now,
+                content=u"one", authors=[{"name": u"Both"}]),
+            dict(atom_id=u"urn:2", title=u"two", updated=now),
+        ])
+        pieces = []
+        def write():
+            for piece in feedgen.iter_write("utf-8"):
+                pieces.append(piece)
+        self.assertRaises(ValidationError, write)
+        document = "".join(pieces)
+        self.assertEqual(document.count("<entry"), 1)
+        self.assert_(document.endswith("</feed>"))
+        minidom.parseString(document)
+
+
+class ShowQueriesTest(TestCase):
+    urls = "jamendo.urls"
+
+    def setUp(self):
+        DumpImporter(verbosity=0).run(sample_dump())
+        # warm the ContentType cache, so it does not count
+        self.client.get("/albums/juid/33/")
+        self.client.get("/artists/juid/338/")
+
+    def get_queries(self, url):
+        response, queries = logged_queries(self.client.get, url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def add_tracks(self, album, count):
+        for numalbum in range(count):
+            track = Track.objects.create(name=u"extra %d" % numalbum,
+                url=u"http://www.jamendo.com/track/0", album=album,
+                artist=album.artist, numalbum=numalbum + 3, filename=u"extra")
+            track.tags = u"extra"
+
+    def test_album(self):
+        album = Album.objects.get(uid=33)
+        queries = self.get_queries("/albums/juid/33/")
+        # modified_at (for the ETag), album with artist, license and genre,
+        # tracks, tags
+        self.assertEqual(queries, 4)
+        self.add_tracks(album, 10)
+        self.assertEqual(self.get_queries("/albums/juid/33/"), queries)
+        response = self.client.get("/albums/juid/33/")
+        self.assertContains(response, "extra 9")
+        self.assertContains(response, ">rock<")
+
+    def test_artist(self):
+        queries = self.get_queries("/artists/juid/338/")
+        # modified_at (for the ETag), artist with its city, state and
+        # country, albums, tags
+        self.assertEqual(queries, 4)
+        artist = Artist.objects.get(uid=338)
+        for uid in range(40, 45):
+            Album.objects.create(uid=uid, name=u"album %d" % uid,
+                url=u"http://www.jamendo.com/album/%d" % uid,
+                filename=u"album", artist=artist)
+        artist.tags = u"french rock"
+        self.assertEqual(self.get_queries("/artists/juid/338/"), queries)
+        response = self.client.get("/artists/juid/338/")
+        self.assertContains(response, "album 44")
+        self.assertContains(response, "id=33+40+41+42+43+44&amp;")
+        self.assertContains(response, ">french<")
@@ -3,15 +3,17 @@
 
 from django.conf.urls.defaults import patterns, url
 
+from jamendo.models import Album, Track
 from jamendo.views import ArtistsList, ArtistShow, AlbumsList, AlbumShow,\
     TagsCloud, TagShow, CountriesList, CountryShow, LicensesList, LicenseShow,\
-    CitiesList, CityShow
+    CitiesList, CityShow, Autocomplete, ArtistsNearby
 from jamendo.feeds import ArtistsFeed, AlbumsFeed, AlbumsForFeed
 
 
 urlpatterns = patterns("jamendo.views",
     # artists urls
     url(r"^artists/$", ArtistsList(), name="jamendo_artists"),
+    url(r"^artists/nearby/$", ArtistsNearby(), name="jamendo_artists_nearby"),
     url(r"^artists/(?P<pk>\d+)/$", ArtistShow(), name="jamendo_artist"),
     url(r"^artists/juid/(?P<juid>\d+)/$", ArtistShow(), name="jamendo_artist_juid"),
     url(r"^artists/mbgid/(?P<mbgid>[-\d\w]+)/$", ArtistShow(), name="jamendo_artist_mbgid"),
@@ -24,6 +26,8 @@ urlpatterns = patterns("jamendo.views",
 
     # tags urls
     url(r"^tags_cloud/$", TagsCloud(), name="jamendo_tagscloud"),
+    url(r"^tags_cloud/albums/$", TagsCloud(Album), name="jamendo_tagscloud_albums"),
+    url(r"^tags_cloud/tracks/$", TagsCloud(Track), name="jamendo_tagscloud_tracks"),
     url(r"^tags/(?P<tag>\w+)/$", TagShow(), name="jamendo_tag"),
     
     # countries urls
@@ -40,10 +44,13 @@ urlpatterns = patterns("jamendo.views",
     url(r"^licenses/$", LicensesList(), name="jamendo_licenses"),
     url(r"^licenses/(?P<pk>\d+)/$", LicenseShow(), name="jamendo_license"),
     url(r"^licenses/juid/(?P<juid>\d+)/$", LicenseShow(), name="jamendo_license_juid"),
+
+    # autocomplete urls
+    url(r"^autocomplete/(?P<kind>artists|albums|tags)/$", Autocomplete(), name="jamendo_autocomplete"),
 )
 
 urlpatterns += patterns("",
-    (r"^feeds/(.*)/$", "django.contrib.syndication.views.feed", {
+    (r"^feeds/(.*)/$", "jamendo.feeds.feed", {
         "feed_dict": {"artists": ArtistsFeed, "albums": AlbumsFeed, "albumsfor": AlbumsForFeed}
     }),
 )
@@ -1,21 +1,43 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from django.http import HttpResponseNotAllowed, HttpResponseBadRequest, Http404
+from django.http import HttpResponse, HttpResponseNotAllowed,\
+    HttpResponseBadRequest, Http404
 from django.template import RequestContext
 from django.utils.translation import ugettext_lazy as _
 from django.shortcuts import render_to_response, get_object_or_404
 from django.conf import settings
+from django.utils import simplejson
+from django.db.models import Max
+from django.db.models.query import QuerySet
+from django.views.decorators.http import condition
 
 from tagging.models import Tag, TaggedItem
-from jamendo.models import Artist, Album, License, Country, Track, City
+from jamendo.models import Artist, Album, License, Country, Track, City,\
+    State, Genre, CloudTag
 from jamendo.forms import NameSearchForm
+from jamendo.pagination import paginate_by_cursor, InvalidCursor
+from jamendo.counts import get_count, counted, ListCount
+from jamendo.clouds import get_cloud
+from jamendo.search import search
+from jamendo.autocomplete import autocomplete, INDEX_FACTORIES
+from jamendo.geo import nearby, nearest, in_box
+from jamendo.tags import with_tags
+from jamendo.responses import get_validators, cacheable, get_cached_response,\
+    set_cached_response, latest_modified_at
+
+
+# paginate lists with cursors (see jamendo.pagination) instead of offsets
+CURSOR_PAGINATION = getattr(settings, "JAMENDO_CURSOR_PAGINATION", True)
 
 
 class BaseView(object):
     """
     Base class for all class-based views
     """
+    # models whose writes change the page, see jamendo.responses
+    depends_on = ()
+
     def __init__(self, *args, **kwargs):
         super(BaseView, self).__init__(*args, **kwargs)
     
@@ -24,7 +46,34 @@ class BaseView(object):
         Simple request-method-based view dispatcher
         """
         view = getattr(self, request.method.upper(), "GET")
-        return view(request, *args, **kwargs)
+        if request.method not in ("GET", "HEAD"):
+            return view(request, *args, **kwargs)
+        validators = self.get_validators(request, *args, **kwargs)
+        if validators is None:
+            return view(request, *args, **kwargs)
+
+        def cached_view(request, *args, **kwargs):
+            if not cacheable(request):
+                return view(request, *args, **kwargs)
+            response = get_cached_response(validators.etag)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                set_cached_response(validators.etag, response)
+            return response
+        # unchanged pages are answered with a 304 without rendering them
+        return condition(lambda *args, **kwargs: validators.etag,
+            lambda *args, **kwargs: validators.last_modified)(cached_view)(
+            request, *args, **kwargs)
+
+    def get_validators(self, request, *args, **kwargs):
+        """
+        Returns the Validators (ETag and Last-Modified) of the page, or None
+        if it has none.
+        """
+        if not self.depends_on:
+            return None
+        return get_validators(request, self.__class__.__name__,
+            self.depends_on)
 
     def GET(self, request, *args, **kwargs):
         return HttpResponseNotAllowed()
@@ -42,6 +91,11 @@ class BaseView(object):
         return {}
 
 class ListView(BaseView):
+    # fields identifying a row in the list ordering, cursor pagination is
+    # used for lists that set them (if JAMENDO_CURSOR_PAGINATION is on)
+    cursor_fields = None
+    # if True, the tags of the listed rows are read along with them
+    prefetch_tags = False
 
     def __init__(self, *args, **kwargs):
         super(ListView, self).__init__(*args, **kwargs)
@@ -49,12 +103,69 @@ class ListView(BaseView):
     def get_queryset(self, request):
         raise NotImplementedError
 
+    def get_validators(self, request, *args, **kwargs):
+        # the list model, unless depends_on tells otherwise
+        models = self.depends_on or (self.get_queryset(request).model, )
+        return get_validators(request, self.__class__.__name__, models,
+            latest_modified_at(models))
+
+    def search(self, request, queryset):
+        """
+        Returns the rows of queryset matching the searched name, best first,
+        or all of them by name if there is no search.
+        """
+        if request.GET.get("name"):
+            return search(queryset, request.GET.get("name"))
+        return queryset.order_by("name")
+
+    def get_count(self, request, queryset):
+        """
+        Returns a ListCount for queryset, only exact for unfiltered lists.
+        """
+        if not isinstance(queryset, QuerySet):
+            return None
+        return get_count(queryset, exact=not request.GET.get("name"))
+
+    def get_page(self, request, queryset):
+        """
+        Returns the CursorPage asked for with the after or before cursor.
+        """
+        per_page = getattr(settings, "ITEMS_PER_PAGE", 20)
+        page = paginate_by_cursor(queryset, self.cursor_fields, per_page,
+            after=request.GET.get("after"), before=request.GET.get("before"))
+        for direction, cursor in (("after", page.next_cursor),
+            ("before", page.previous_cursor)):
+            query = request.GET.copy()
+            query.pop("after", None)
+            query.pop("before", None)
+            query[direction] = cursor
+            setattr(page, "%s_query" % direction, query.urlencode())
+        return page
+
     def GET(self, request, *args, **kwargs):
         self.form = NameSearchForm(request.GET)
         
         params_dict = self.get_params_dict()
+        queryset = self.get_queryset(request)
+        count = self.get_count(request, queryset)
+        page = None
+        # searches are ordered by relevance, so they are paginated by offset
+        if CURSOR_PAGINATION and self.cursor_fields and \
+            not request.GET.get("name"):
+            try:
+                page = self.get_page(request, queryset)
+            except InvalidCursor:
+                return HttpResponseBadRequest()
+            queryset = page.object_list
+        elif count is not None:
+            # so autopaginate does not count the rows again
+            queryset = counted(queryset, count)
+        if self.prefetch_tags:
+            queryset = with_tags(queryset)
         params_dict.update({
-            "queryset": self.get_queryset(request),
+            "queryset": queryset,
+            "list_count": count,
+            "cursor_page": page,
             "form": self.form
         })
         
@@ -62,18 +173,69 @@ class ListView(BaseView):
             context_instance=RequestContext(request))
 
 class ShowView(BaseView):
+    # foreign keys fetched along with the instance, in the same query
+    select_related = ()
+    # (name, function) tuples: function(instance) returns related rows that
+    # are read once, before rendering, into a list available to templates as
+    # name and to the instance as _prefetched_<name>
+    prefetch = ()
+    # relations to the rows shown along with the instance (ie: "track" for
+    # the tracks of an album) whose latest modified_at is part of the
+    # validators, so writes other processes did not tell this one about
+    # still change them
+    related = ()
 
     def __init__(self, model, *args, **kwargs):
         super(ShowView, self).__init__(*args, **kwargs)
         self.model = model
 
-    def get_instance(self, *args, **kwargs):
+    def get_queryset(self):
+        if self.select_related:
+            return self.model.objects.select_related(*self.select_related)
+        return self.model.objects.all()
+
+    def get_lookup(self, **kwargs):
+        """
+        Returns the lookup of the shown row in the url kwargs. Raises
+        KeyError if there is none.
+        """
         if "pk" in kwargs:
-            self.instance = self.model.objects.get(pk=kwargs["pk"])
+            return {"pk": kwargs["pk"]}
         elif "juid" in kwargs:
-            self.instance = self.model.objects.get(uid=kwargs["juid"])
+            return {"uid": kwargs["juid"]}
         elif "mbgid" in kwargs:
-            self.instance = self.model.objects.get(mbgid=kwargs["mbgid"])
+            return {"mbgid": kwargs["mbgid"]}
+        raise KeyError("pk")
+
+    def get_instance(self, *args, **kwargs):
+        self.instance = self.get_queryset().get(**self.get_lookup(**kwargs))
+
+    def get_validators(self, request, *args, **kwargs):
+        # modified_at is read alone, with the related ones in the same
+        # query, so 304s do not read the whole row
+        modified_at = None
+        if "modified_at" in [field.name for field in self.model._meta.fields]:
+            dates = {"modified_at": Max("modified_at")}
+            for index, relation in enumerate(self.related):
+                dates["related_%d" % index] = Max("%s__modified_at" % relation)
+            try:
+                values = self.model.objects.filter(**self.get_lookup(
+                    **kwargs)).aggregate(**dates)
+            except (KeyError, ValueError):
+                return None
+            if values["modified_at"] is None:
+                return None
+            modified_at = max([value for value in values.values()
+                if value is not None])
+        return get_validators(request, self.__class__.__name__,
+            self.depends_on or (self.model, ), modified_at)
+
+    def get_prefetched(self):
+        prefetched = {}
+        for name, function in self.prefetch:
+            prefetched[name] = list(function(self.instance))
+            setattr(self.instance, "_prefetched_%s" % name, prefetched[name])
+        return prefetched
 
     def GET(self, request, *args, **kwargs):
         try:
@@ -86,31 +248,44 @@ class ShowView(BaseView):
         if not self.instance:
             return HttpResponseBadRequest()
         
+        self.prefetched = self.get_prefetched()
         params_dict = self.get_params_dict()
+        params_dict.update(self.prefetched)
         params_dict.update({"instance": self.instance})
         
         return render_to_response(self.get_template_paths(), params_dict,
             context_instance=RequestContext(request))
 
 class ArtistsList(ListView):
-    
+    cursor_fields = ("name", "pk")
+    depends_on = (Artist, Album)
+
     def __init__(self, *args, **kwargs):
         super(ArtistsList, self).__init__(*args, **kwargs)
 
     def get_queryset(self, request):
-        if request.GET.get("name"):
-            qs = Artist.objects.filter(name__icontains=request.GET.get("name"))
-        else:
-            qs = Artist.objects.all()
-        qs = qs.order_by("name")
+        qs = self.search(request, Artist.objects.all())
         return qs
 
     def get_template_paths(self):
         templates_list = ("jamendo/artists/list.html", )
         return templates_list
 
+def _artist_albums(artist):
+    albums = artist.album_set.order_by("-release_date", "name")
+    for album in albums:
+        album.artist = artist
+        yield album
+
 class ArtistShow(ShowView):
-    
+    select_related = ("city__state__country", )
+    depends_on = (Artist, Album, City, State, Country, Tag, TaggedItem)
+    related = ("album", "city", "city__state", "country")
+    prefetch = (
+        ("albums", _artist_albums),
+        ("tags", lambda artist: Tag.objects.get_for_object(artist)),
+    )
+
     def __init__(self, *args, **kwargs):
         super(ArtistShow, self).__init__(Artist, *args, **kwargs)
 
@@ -119,28 +294,37 @@ class ArtistShow(ShowView):
         return templates_list
 
     def get_params_dict(self):
-        albums_qs = self.instance.album_set.order_by("-release_date", "name")
-        return {"albums_list": albums_qs}
+        return {"albums_list": self.prefetched["albums"]}
 
 class AlbumsList(ListView):
-    
+    cursor_fields = ("name", "pk")
+    depends_on = (Album, Artist)
+
     def __init__(self, *args, **kwargs):
         super(AlbumsList, self).__init__(*args, **kwargs)
 
     def get_queryset(self, request):
-        if request.GET.get("name"):
-            qs = Album.objects.filter(name__icontains=request.GET.get("name"))
-        else:
-            qs = Album.objects.all()
-        qs = qs.select_related("artist").order_by("name")
+        qs = self.search(request, Album.objects.select_related("artist"))
         return qs
 
     def get_template_paths(self):
         templates_list = ("jamendo/albums/list.html", )
         return templates_list
 
+def _album_tracks(album):
+    for track in album.track_set.all():
+        track.album = album
+        yield track
+
 class AlbumShow(ShowView):
-    
+    select_related = ("artist", "license", "genre")
+    depends_on = (Album, Artist, Track, License, Genre, Tag, TaggedItem)
+    related = ("artist", "track", "license", "genre")
+    prefetch = (
+        ("tracks", _album_tracks),
+        ("tags", lambda album: album.get_tags()),
+    )
+
     def __init__(self, *args, **kwargs):
         super(AlbumShow, self).__init__(Album, *args, **kwargs)
 
@@ -149,14 +333,15 @@ class AlbumShow(ShowView):
         return templates_list
 
 class TagsCloud(ListView):
+    depends_on = (CloudTag, )
     
-    def __init__(self, *args, **kwargs):
+    def __init__(self, model=Artist, *args, **kwargs):
         super(TagsCloud, self).__init__(*args, **kwargs)
+        self.model = model
 
     def get_queryset(self, request):
-        # this qs will return a QuerySet of dict items like this:
-        # {'count': 21, 'font_size': 2, 'id': 2262, 'name': u'0'}
-        qs = Tag.objects.cloud_for_model(Artist)
+        # CloudTag rows, with name, count and font_size, see jamendo.clouds
+        qs = get_cloud(self.model)
         return qs
 
     def get_template_paths(self):
@@ -164,6 +349,7 @@ class TagsCloud(ListView):
         return templates_list
 
 class TagShow(ShowView):
+    depends_on = (Tag, TaggedItem, Artist)
 
     def __init__(self, *args, **kwargs):
         super(TagShow, self).__init__(Tag, *args, **kwargs)
@@ -172,8 +358,11 @@ class TagShow(ShowView):
         templates_list = ("jamendo/tags/show.html", )
         return templates_list
 
+    def get_lookup(self, **kwargs):
+        return {"name": kwargs["tag"]}
+
     def get_instance(self, *args, **kwargs):
-        self.instance = get_object_or_404(Tag, name=kwargs["tag"])
+        self.instance = get_object_or_404(Tag, **self.get_lookup(**kwargs))
 
     def get_params_dict(self):
         artists_qs = TaggedItem.objects.get_by_model(Artist, (self.instance, )
@@ -181,16 +370,18 @@ class TagShow(ShowView):
         return {"artists": artists_qs}
 
 class CountriesList(ListView):
-    
+    cursor_fields = ("name", "pk")
+    depends_on = (Country, )
+
     def __init__(self, *args, **kwargs):
         super(CountriesList, self).__init__(*args, **kwargs)
 
     def get_queryset(self, request):
         if request.GET.get("name"):
-            qs = Country.objects.filter(name__icontains=request.GET.get("name"))
+            qs = Country.objects.all()
         else:
             qs = Country.objects.exclude(code=u"")
-        qs = qs.order_by("name")
+        qs = self.search(request, qs)
         return qs
 
     def get_template_paths(self):
@@ -198,6 +389,7 @@ class CountriesList(ListView):
         return templates_list
 
 class CountryShow(ShowView):
+    depends_on = (Country, Artist)
     
     def __init__(self, *args, **kwargs):
         super(CountryShow, self).__init__(Country, *args, **kwargs)
@@ -207,25 +399,25 @@ class CountryShow(ShowView):
         return templates_list
 
     def get_params_dict(self):
+        # a range of the (country, name) index, counted beforehand
         artists_qs = Artist.objects.filter(
-                city__state__country=self.instance.code
-            ).distinct().order_by("name")
+                country=self.instance.code
+            ).order_by("name")
+        artists_qs = counted(artists_qs, ListCount(self.instance.artist_count))
         return {"artists": artists_qs}
 
-    def get_instance(self, *args, **kwargs):
-        self.instance = self.model.objects.get(code=kwargs["code"])
+    def get_lookup(self, **kwargs):
+        return {"code": kwargs["code"]}
 
 class CitiesList(ListView):
-    
+    cursor_fields = ("name", "pk")
+    depends_on = (City, State, Country)
+
     def __init__(self, *args, **kwargs):
         super(CitiesList, self).__init__(*args, **kwargs)
 
     def get_queryset(self, request):
-        if request.GET.get("name"):
-            qs = City.objects.filter(name__icontains=request.GET.get("name"))
-        else:
-            qs = City.objects.all()
-        qs = qs.order_by("name")
+        qs = self.search(request, City.objects.all())
         return qs
 
     def get_template_paths(self):
@@ -233,6 +425,7 @@ class CitiesList(ListView):
         return templates_list
 
 class CityShow(ShowView):
+    depends_on = (City, State, Country, Artist)
     
     def __init__(self, *args, **kwargs):
         super(CityShow, self).__init__(City, *args, **kwargs)
@@ -251,16 +444,14 @@ class CityShow(ShowView):
         print self.instance
 
 class LicensesList(ListView):
-    
+    cursor_fields = ("name", "pk")
+    depends_on = (License, )
+
     def __init__(self, *args, **kwargs):
         super(LicensesList, self).__init__(*args, **kwargs)
 
     def get_queryset(self, request):
-        if request.GET.get("name"):
-            qs = License.objects.filter(name__icontains=request.GET.get("name"))
-        else:
-            qs = License.objects.all()
-        qs = qs.order_by("name")
+        qs = self.search(request, License.objects.all())
         return qs
 
     def get_template_paths(self):
@@ -268,6 +459,7 @@ class LicensesList(ListView):
         return templates_list
 
 class LicenseShow(ShowView):
+    depends_on = (License, Album)
     
     def __init__(self, *args, **kwargs):
         super(LicenseShow, self).__init__(License, *args, **kwargs)
@@ -283,4 +475,114 @@ class LicenseShow(ShowView):
         if "pk" in kwargs:
             self.instance = self.model.objects.get(pk=kwargs["pk"])
         elif "juid" in kwargs:
-            self.instance = self.model.objects.get(uid=kwargs["juid"])
\ No newline at end of file
+            self.instance = self.model.objects.get(uid=kwargs["juid"])
+
+class Autocomplete(BaseView):
+    """
+    Names of artists, albums or tags starting by ?q=, as a json list of
+    {"id": pk, "name": name}, from the in-memory jamendo.autocomplete
+    indexes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Autocomplete, self).__init__(*args, **kwargs)
+
+    def GET(self, request, *args, **kwargs):
+        return self.JSON(request, *args, **kwargs)
+
+    def JSON(self, request, *args, **kwargs):
+        kind = kwargs["kind"]
+        if kind not in INDEX_FACTORIES:
+            raise Http404
+        try:
+            limit = min(int(request.GET.get("limit", 10)), 50)
+        except ValueError:
+            return HttpResponseBadRequest()
+        results = [{"id": pk, "name": name} for pk, name in
+            autocomplete(kind, request.GET.get("q", u""), limit)]
+        return HttpResponse(simplejson.dumps(results),
+            mimetype="application/json")
+
+class ArtistsNearby(BaseView):
+    """
+    Artists near ?lat=&lon=, the nearest first: the ?limit= nearest ones, or
+    those at most ?radius= km away. With ?bbox=south,west,north,east, the
+    artists inside that box instead. With ?format=json they are given as a
+    json list of {"id", "name", "latitude", "longitude", "url"} (and
+    "distance", in km, unless bbox is given). See jamendo.geo.
+    """
+    max_limit = 100
+    max_box_limit = 500
+
+    def __init__(self, *args, **kwargs):
+        super(ArtistsNearby, self).__init__(*args, **kwargs)
+
+    def get_template_paths(self):
+        templates_list = ("jamendo/artists/nearby.html", )
+        return templates_list
+
+    def get_limit(self, request, default, maximum):
+        """
+        Returns the ?limit= of the request, at most maximum. Raises
+        ValueError if it is not a positive number.
+        """
+        limit = int(request.GET.get("limit", default))
+        if limit < 1:
+            raise ValueError(limit)
+        return min(limit, maximum)
+
+    def get_artists(self, request):
+        """
+        Returns the list of artists asked for. Raises ValueError if the
+        request parameters are not valid.
+        """
+        queryset = Artist.objects.all()
+        if request.GET.get("bbox"):
+            south, west, north, east = [float(value) for value in
+                request.GET["bbox"].split(",")]
+            if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and
+                -180 <= east <= 180):
+                raise ValueError(request.GET["bbox"])
+            limit = self.get_limit(request, self.max_box_limit,
+                self.max_box_limit)
+            return list(in_box(queryset, south, west, north,
+                east).order_by("-album_count", "pk")[:limit])
+
+        latitude = float(request.GET["lat"])
+        longitude = float(request.GET["lon"])
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError((latitude, longitude))
+        limit = self.get_limit(request, 20, self.max_limit)
+        if request.GET.get("radius"):
+            radius = float(request.GET["radius"])
+            # also false for nan
+            if not radius > 0:
+                raise ValueError(radius)
+            return nearby(queryset, latitude, longitude, radius, limit)
+        return nearest(queryset, latitude, longitude, limit)
+
+    def GET(self, request, *args, **kwargs):
+        if request.GET.get("format") == "json":
+            return self.JSON(request, *args, **kwargs)
+        try:
+            artists = self.get_artists(request)
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest()
+        return render_to_response(self.get_template_paths(),
+            {"artists": artists}, context_instance=RequestContext(request))
+
+    def JSON(self, request, *args, **kwargs):
+        try:
+            artists = self.get_artists(request)
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest()
+        results = []
+        for artist in artists:
+            result = {"id": artist.pk, "name": artist.name,
+                "latitude": float(artist.latitude),
+                "longitude": float(artist.longitude), "url": artist.url}
+            if hasattr(artist, "distance"):
+                result["distance"] = round(artist.distance, 3)
+            results.append(result)
+        return HttpResponse(simplejson.dumps(results),
+            mimetype="application/json")